@@ -7,126 +7,289 @@
 #
 
 import argparse
+import datetime
 import logging
 import os
-import concurrent.futures
-import multiprocessing
 
 from dotenv import load_dotenv
-from tqdm import tqdm
-from skylark import crud, feature, scraper_db
-
-load_dotenv()
-
-parser = argparse.ArgumentParser(
-    description='This script is a program that netkeiba.com scraping.')
-
-parser.add_argument('--temp',
-                    action='store',
-                    nargs='?',
-                    const=None,
-                    default='./temp',
-                    type=str,
-                    choices=None,
-                    help='temp directory(default: ./temp/)',
-                    metavar=None)
-
-parser.add_argument('--race-list-file',
-                    action='store',
-                    nargs='?',
-                    const=None,
-                    default='race_list.txt',
-                    type=str,
-                    choices=None,
-                    help='race list file(default: race_list.txt)',
-                    metavar=None)
-
-parser.add_argument('--period-of-months',
-                    action='store',
-                    nargs='?',
-                    const=None,
-                    default=12,
-                    type=int,
-                    choices=None,
-                    help='period of months(default: 12)',
-                    metavar=None)
-
-parser.add_argument('--rebuild-all-tables',
-                    action='store_true',
-                    default=False,
-                    help='Rebuild all tables(default: False)',)
-
-parser.add_argument('-Rf', '--rebuild-feature',
-                    action='store_true',
-                    default=False,
-                    help='Rebuild feature table(default: False)',)
-
-parser.add_argument('-U', '--update-race-list',
-                    action='store_true',
-                    default=False,
-                    help='Update race list(default: False)',)
-
-parser.add_argument('-S', '--scraping',
-                    action='store_true',
-                    default=False,
-                    help='scraping mode(default: False)',)
-
-parser.add_argument('-F', '--feature',
-                    action='store_true',
-                    default=False,
-                    help='feature mode(default: False)',)
-
-parser.add_argument('--debug',
-                    action='store_true',
-                    default=False,
-                    help='Debug mode(default: False)',)
-
-parser.add_argument('race_id',
-                    action='store',
-                    nargs='*',
-                    const=None,
-                    default=None,
-                    type=str,
-                    choices=None,
-                    help='Race ID',
-                    metavar=None)
-
-args = parser.parse_args()
-
-# create logger
-logger = logging.getLogger(__name__)
-formatter = logging.Formatter('[%(asctime)s][%(funcName)s:%(lineno)d][%(levelname)s] %(message)s')
-logger.setLevel(logging.DEBUG)
-
-console = logging.StreamHandler()
-if args.debug == True:
-    console.setLevel(logging.DEBUG)
-else:
-    console.setLevel(logging.INFO)
-
-console.setFormatter(formatter)
-logger.addHandler(console)
-
-db_config: dict = {
-    "protocol": "mysql+pymysql",
-    "username": os.getenv("MYSQL_USERNAME","skylark"),
-    "password": os.getenv("MYSQL_PASSWORD","skylarkpw!"),
-    "hostname": os.getenv("MYSQL_HOSTNAME","localhost"),
-    "port"    : int(os.getenv("MYSQL_PORT", 3306)),
-    "dbname"  : os.getenv("MYSQL_DATABASE","skylark"),
-    "charset" : "utf8mb4"
-}
-
-sqlalchemy_db_url: str = "{protocol:s}://{username:s}:{password:s}@{hostname:s}:{port:d}/{dbname:s}?charset={charset:s}".\
-    format(**db_config)
-
-def process_feature(args_tuple):
-    sqlalchemy_db_url, args, logger, race_result = args_tuple
-    db_crud = crud.SkylarkCrud(sqlalchemy_db_url, logger=logger)
-    skylark_feature = feature.SkylarkFeature(args=args, logger=logger)
-    skylark_feature.initialize(db_crud, race_id=race_result.race_id, horse_number=race_result.horse_number)
+# 重い依存(SQLAlchemy, httpx, pyquery, numpy, playwright)はモードごとに main() の中で読み込む
+# ProcessPoolExecutor のワーカーが app.py を再importするため、import時には引数の解析もDB接続URLの作成もしない
+from skylark.util import SkylarkUtil
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='This script is a program that netkeiba.com scraping.')
+
+    parser.add_argument('--temp',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default='./temp',
+                        type=str,
+                        choices=None,
+                        help='temp directory(default: ./temp/)',
+                        metavar=None)
+
+    parser.add_argument('--sqlite',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default=None,
+                        type=str,
+                        choices=None,
+                        help='use SQLite database file instead of MySQL(default: DATABASE_URL or MYSQL_*)',
+                        metavar='PATH')
+
+    parser.add_argument('--race-list-file',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default='race_list.txt',
+                        type=str,
+                        choices=None,
+                        help='race list file(default: race_list.txt)',
+                        metavar=None)
+
+    parser.add_argument('--ignore-race-file',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default='ignore_race_list.txt',
+                        type=str,
+                        choices=None,
+                        help='race IDs not to scrape, one per line(default: ignore_race_list.txt)',
+                        metavar=None)
+
+    parser.add_argument('--period-of-months',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default=12,
+                        type=int,
+                        choices=None,
+                        help='period of months(default: 12)',
+                        metavar=None)
+
+    parser.add_argument('--rebuild-all-tables',
+                        action='store_true',
+                        default=False,
+                        help='Rebuild all tables(default: False)',)
+
+    parser.add_argument('-Rf', '--rebuild-feature',
+                        action='store_true',
+                        default=False,
+                        help='Rebuild feature table(default: False)',)
+
+    parser.add_argument('-U', '--update-race-list',
+                        action='store_true',
+                        default=False,
+                        help='Update race list(default: False)',)
+
+    parser.add_argument('-S', '--scraping',
+                        action='store_true',
+                        default=False,
+                        help='scraping mode(default: False)',)
+
+    parser.add_argument('--reingest',
+                        action='store_true',
+                        default=False,
+                        help='scrape races already stored in the database again(default: False)',)
+
+    parser.add_argument('--backfill',
+                        action='store_true',
+                        default=False,
+                        help='scraping mode writes TSV files and bulk loads them(default: False)',)
+
+    parser.add_argument('--crawl-state',
+                        action='store_true',
+                        default=False,
+                        help='use crawl state table instead of race list file(default: False)',)
+
+    parser.add_argument('--max-attempts',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default=3,
+                        type=int,
+                        choices=None,
+                        help='max download attempts per race in crawl state mode(default: 3)',
+                        metavar=None)
+
+    parser.add_argument('--shard',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default=None,
+                        type=SkylarkUtil.parseShard,
+                        choices=None,
+                        help='scrape only shard K of N of the race list(e.g. 3/8)',
+                        metavar='K/N')
+
+    parser.add_argument('--shard-by',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default='hash',
+                        type=str,
+                        choices=['hash', 'meeting'],
+                        help='partition races by race_id hash or by meeting(year, place, kai, day) so that each meeting stays in one shard(default: hash)',
+                        metavar=None)
+
+    parser.add_argument('--merge-shards',
+                        action='store_true',
+                        default=False,
+                        help='merge shard caches into temp directory and load their backfill files(default: False)',)
+
+    parser.add_argument('-F', '--feature',
+                        action='store_true',
+                        default=False,
+                        help='feature mode(default: False)',)
+
+    parser.add_argument('--rebuild-speed-figure',
+                        action='store_true',
+                        default=False,
+                        help='Recompute par times and speed figures of all results with -F(default: False)',)
+
+    parser.add_argument('--form-window',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default=100,
+                        type=int,
+                        choices=None,
+                        help='number of recent rides for jockey/trainer/owner form(default: 100)',
+                        metavar=None)
+
+    parser.add_argument('--history-cache-size',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default=1024,
+                        type=int,
+                        choices=None,
+                        help='number of horse histories cached per feature worker(default: 1024)',
+                        metavar=None)
+
+    parser.add_argument('--feature-chunksize',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default=64,
+                        type=int,
+                        choices=None,
+                        help='number of horses sent to a feature worker at once(default: 64)',
+                        metavar=None)
+
+    parser.add_argument('--race-card',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default=None,
+                        type=lambda value: datetime.datetime.strptime(value, "%Y%m%d").date(),
+                        choices=None,
+                        help='download all race cards of kaisai date(YYYYMMDD)',
+                        metavar='YYYYMMDD')
+
+    parser.add_argument('--explain',
+                        action='store_true',
+                        default=False,
+                        help='Show execution plans of feature queries for race_id(default: False)',)
+
+    parser.add_argument('--backtest',
+                        action='store_true',
+                        default=False,
+                        help='Backtest box bets of all ticket types against payoff table(default: False)',)
+
+    parser.add_argument('--predictions',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default=None,
+                        type=str,
+                        choices=None,
+                        help='CSV file of race_id,horse_number,score for backtest(default: popularity)',
+                        metavar=None)
+
+    parser.add_argument('--box-max',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default=6,
+                        type=int,
+                        choices=None,
+                        help='max number of horses in a backtest box(default: 6)',
+                        metavar=None)
+
+    parser.add_argument('--min-bets',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default=100,
+                        type=int,
+                        choices=None,
+                        help='min number of races bet to report a backtest strategy(default: 100)',
+                        metavar=None)
+
+    parser.add_argument('--snapshot',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default=None,
+                        type=str,
+                        choices=None,
+                        help='export all tables to SQLite file for analytics, updating races by date after the first export',
+                        metavar='PATH')
+
+    parser.add_argument('--snapshot-days',
+                        action='store',
+                        nargs='?',
+                        const=None,
+                        default=7,
+                        type=int,
+                        choices=None,
+                        help='days before the last exported race date to export again(default: 7)',
+                        metavar=None)
+
+    parser.add_argument('--rebuild-snapshot',
+                        action='store_true',
+                        default=False,
+                        help='export all races to snapshot instead of updating it(default: False)',)
+
+    parser.add_argument('--debug',
+                        action='store_true',
+                        default=False,
+                        help='Debug mode(default: False)',)
+
+    parser.add_argument('race_id',
+                        action='store',
+                        nargs='*',
+                        const=None,
+                        default=None,
+                        type=str,
+                        choices=None,
+                        help='Race ID',
+                        metavar=None)
+
+    return parser.parse_args(argv)
+
+def create_logger(debug: bool = False) -> logging.Logger:
+    logger = logging.getLogger(__name__)
+    formatter = logging.Formatter('[%(asctime)s][%(funcName)s:%(lineno)d][%(levelname)s] %(message)s')
+    logger.setLevel(logging.DEBUG)
+
+    console = logging.StreamHandler()
+    if debug == True:
+        console.setLevel(logging.DEBUG)
+    else:
+        console.setLevel(logging.INFO)
+
+    console.setFormatter(formatter)
+    logger.addHandler(console)
+    return logger
 
 def main(args: argparse.Namespace, logger: logging.Logger, sqlalchemy_db_url: str):
+    from skylark import crud
+
     args.temp = os.path.normcase(args.temp)
     # tempディレクトリ作成
     if os.path.isdir(args.temp) == False:
@@ -139,42 +302,114 @@ def main(args: argparse.Namespace, logger: logging.Logger, sqlalchemy_db_url: st
 
         if args.rebuild_feature == True:
             db_crud.drop_table("feature_tbl")
+            db_crud.drop_table("form_feature_tbl")
 
         db_crud.create_tables()
+        db_crud.migrate()
+
+        if args.explain == True:
+            for race_id in args.race_id:
+                race_info = db_crud.get_race_info(int(race_id))
+                race_result = db_crud.get_race_result(int(race_id), 1)
+                if race_info is None or race_result is None:
+                    logger.warning("race not found: %s", race_id)
+                    continue
+
+                plans = db_crud.explain_feature_queries(race_result.horse_id, race_info.date, race_info.distance)
+                for name, rows in plans.items():
+                    for row in rows:
+                        logger.info("%s: %s", name, row)
 
         if args.update_race_list == True:
+            from skylark import scraper_db
             instance = scraper_db.SkylarkScraperDb(sqlalchemy_db_url, args = args, logger = logger)
             if args.update_race_list == True:
                 logger.info("make race URL list")
                 instance.make_race_url_list(period = args.period_of_months)
                 instance.export_race_url_list()
+                if args.crawl_state == True:
+                    instance.enqueue_race_url_list()
 
         if args.scraping == True:
+            from skylark import scraper_db
             instance = scraper_db.SkylarkScraperDb(sqlalchemy_db_url, args = args, logger = logger)
             if len(args.race_id) > 0:
                 instance.set_race_url_list(args.race_id)
-            else:
+            elif args.crawl_state == False:
                 instance.import_race_url_list()
 
+            if args.shard is not None:
+                if args.crawl_state == True:
+                    logger.warning("crawl state mode: races are partitioned by claims, --shard selects only the cache segment")
+                else:
+                    instance.shard_race_url_list()
+
             logger.info("Start download race data")
             instance.download()
             logger.info("End download race data")
 
+        if args.merge_shards == True:
+            from skylark import scraper_db
+            instance = scraper_db.SkylarkScraperDb(sqlalchemy_db_url, args = args, logger = logger)
+            logger.info("Start merge shards")
+            instance.merge_shards()
+            logger.info("End merge shards")
+
+        if args.race_card is not None:
+            from skylark import scraper_race
+            instance = scraper_race.SkylarkScraperRace(sqlalchemy_db_url, args = args, logger = logger)
+            logger.info("Start download race card: %s", args.race_card)
+            instance.download_race_card(args.race_card)
+            logger.info("End download race card")
+
+        if args.backtest == True:
+            from skylark import backtest
+            logger.info("Start backtest")
+            instance = backtest.SkylarkBacktest(args=args, logger=logger)
+            instance.load(db_crud, predictions_file=args.predictions)
+            instance.report(instance.sweep())
+            logger.info("End backtest")
+
         if args.feature == True or args.rebuild_feature == True:
+            from skylark import feature, feature_executor, speed_figure
+
             race_result_list = db_crud.get_race_results()
             if not race_result_list:
                 logger.warning("Failed to retrieve race results.")
                 return
 
+            logger.info("Start speed figure")
+            speed_figure.SkylarkSpeedFigure(logger=logger).update(db_crud, rebuild=args.rebuild_speed_figure)
+
+            logger.info("Start form feature")
+            feature.SkylarkFormFeature(args=args, logger=logger).calculate(db_crud)
+
             logger.info("Start feature")
-            max_workers = min(8, multiprocessing.cpu_count())
-            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
-                args_iter = ((sqlalchemy_db_url, args, logger, race_result) for race_result in race_result_list)
-                list(tqdm(executor.map(process_feature, args_iter), total=len(race_result_list)))
+            # 同じ馬のレースを同じワーカーでまとめて処理し、キャッシュを効かせる
+            horse_race_keys: dict[int, list] = {}
+            for race_result in race_result_list:
+                horse_race_keys.setdefault(race_result.horse_id, []).append((race_result.race_id, race_result.horse_number))
+
+            instance = feature_executor.SkylarkFeatureExecutor(
+                args=args,
+                logger=logger,
+                db_url=sqlalchemy_db_url,
+                chunksize=args.feature_chunksize
+            )
+            instance.run(list(horse_race_keys.values()))
             logger.info("End feature")
 
+        if args.snapshot is not None:
+            from skylark import snapshot
+            logger.info("Start snapshot: %s", args.snapshot)
+            instance = snapshot.SkylarkSnapshot(sqlalchemy_db_url, logger=logger, days=args.snapshot_days)
+            instance.export(args.snapshot, rebuild=args.rebuild_snapshot)
+            logger.info("End snapshot")
+
     except Exception as ex:
         logger.error(ex,exc_info=True)
 
 if __name__ == "__main__":
-    main(args, logger, sqlalchemy_db_url)
+    load_dotenv()
+    args = parse_args()
+    main(args, create_logger(args.debug), SkylarkUtil.getDatabaseUrl(args.sqlite))
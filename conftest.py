@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+# tests から skylark をインポートできるように、このディレクトリを pytest の rootdir にする
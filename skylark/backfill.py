@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from argparse import Namespace
+import datetime
+import json
+from logging import Logger
+import os
+import shutil
+import threading
+
+from sqlalchemy import (
+    JSON, BigInteger, Column, Date, Float, Integer, MetaData, Table, Time, insert, select, text, true
+)
+from sqlalchemy.dialects import mysql, sqlite
+
+from skylark.crud import SkylarkCrud, get_update_column_names
+from skylark.models import Horse, Jockey, Trainer, Owner, RaceInfo, RaceResult, RaceSummary, Payoff
+
+class SkylarkBackfill:
+    """
+    過去データの一括取り込み
+    解析結果をテーブルごとのTSVファイルに書き出し、ステージングテーブルに一括ロードした後、
+    1回の INSERT ... SELECT で本テーブルにマージする
+    """
+
+    # データセットのキー -> モデル(外部キーの参照順)
+    model_list: dict = {
+        "race_info": RaceInfo,
+        "horse": Horse,
+        "jockey": Jockey,
+        "trainer": Trainer,
+        "owner": Owner,
+        "result": RaceResult,
+        "payoff": Payoff,
+        "summary": RaceSummary,
+    }
+
+    # SQLiteで executemany する行数
+    chunk_size: int = 10000
+
+    def __init__(self, db_url: str, args: Namespace, logger: Logger, directory: str | None = None):
+        self.db_url = db_url
+        self.args = args
+        self.logger = logger
+
+        self.directory = directory or os.path.join(args.temp, "backfill")
+        if os.path.isdir(self.directory) == False:
+            os.makedirs(self.directory, exist_ok=True)
+
+        self.files: dict = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def filepath(self, key: str, directory: str | None = None) -> str:
+        return os.path.join(directory or self.directory, self.model_list[key].__tablename__ + ".tsv")
+
+    def merge(self, directory: str) -> None:
+        """
+        別のディレクトリ(シャード)に書き出したTSVファイルを追記します。
+        """
+        self.close()
+
+        for key in self.model_list:
+            filepath = self.filepath(key, directory)
+            if os.path.isfile(filepath) == False:
+                continue
+
+            with open(filepath, "rb") as src, open(self.filepath(key), "ab") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(filepath)
+
+    @classmethod
+    def read_race_ids(cls, directory: str) -> set[int]:
+        """
+        ロード前のTSVファイルに書き出したレースIDを返します。
+        """
+        filepath = os.path.join(directory, cls.model_list["race_info"].__tablename__ + ".tsv")
+        if os.path.isfile(filepath) == False:
+            return set()
+
+        with open(filepath, "r", encoding="utf-8", newline="\n") as file:
+            return {int(line.split("\t", 1)[0]) for line in file if line.strip() != ""}
+
+    @staticmethod
+    def escape(value) -> str:
+        """
+        LOAD DATA の既定の書式(タブ区切り、バックスラッシュでエスケープ、NULLは\\N)に変換します。
+        """
+        if value is None:
+            return "\\N"
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, ensure_ascii=False, sort_keys=True)
+        return (
+            str(value)
+            .replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r")
+        )
+
+    @staticmethod
+    def unescape(value: str) -> str | None:
+        if value == "\\N":
+            return None
+
+        result = []
+        idx = 0
+        while idx < len(value):
+            char = value[idx]
+            if char == "\\" and idx + 1 < len(value):
+                idx += 1
+                char = {"t": "\t", "n": "\n", "r": "\r"}.get(value[idx], value[idx])
+            result.append(char)
+            idx += 1
+        return "".join(result)
+
+    @staticmethod
+    def convert(column: Column, value: str | None):
+        """
+        TSVの文字列を列の型に合わせて変換します。
+        """
+        if value is None:
+            return None
+
+        if isinstance(column.type, (Integer, BigInteger)):
+            return int(value)
+        if isinstance(column.type, Float):
+            return float(value)
+        if isinstance(column.type, Date):
+            return datetime.date.fromisoformat(value)
+        if isinstance(column.type, JSON):
+            return json.loads(value)
+        if isinstance(column.type, Time):
+            hour, minute, second = (value.split(":") + ["0"])[:3]
+            second = float(second)
+            return datetime.time(int(hour), int(minute), int(second), round((second % 1) * 1000000))
+        return value
+
+    def write(self, dataset: dict) -> None:
+        """
+        parse_race_html の結果をTSVファイルに追記します。
+        """
+        with self.lock:
+            for key, model in self.model_list.items():
+                rows = dataset.get(key)
+                if not rows:
+                    continue
+                if isinstance(rows, dict):
+                    rows = [rows]
+
+                file = self.files.get(key)
+                if file is None:
+                    file = self.files[key] = open(self.filepath(key), "a", encoding="utf-8", newline="\n")
+
+                column_names = [column.name for column in model.__table__.columns]
+                for row in rows:
+                    file.write("\t".join(self.escape(row.get(name)) for name in column_names) + "\n")
+
+    def close(self) -> None:
+        with self.lock:
+            for file in self.files.values():
+                file.close()
+            self.files = {}
+
+    def load(self) -> None:
+        """
+        TSVファイルをステージングテーブルに一括ロードし、本テーブルにマージします。
+        """
+        self.close()
+
+        connect_args = {"local_infile": True} if self.db_url.startswith("mysql") else {}
+        db_crud = SkylarkCrud(self.db_url, logger=self.logger, shared=False, connect_args=connect_args)
+        try:
+            dialect_name = db_crud.engine.dialect.name
+
+            for key, model in self.model_list.items():
+                filepath = self.filepath(key)
+                if os.path.isfile(filepath) == False:
+                    continue
+
+                table = model.__table__
+                stage = Table(
+                    table.name + "_stage",
+                    MetaData(),
+                    *[Column(column.name, column.type) for column in table.columns]
+                )
+                column_names = [column.name for column in table.columns]
+
+                with db_crud.engine.begin() as connection:
+                    stage.drop(connection, checkfirst=True)
+                    stage.create(connection)
+
+                    if dialect_name == "mysql":
+                        connection.execute(
+                            text(
+                                f"LOAD DATA LOCAL INFILE :filepath INTO TABLE {stage.name} "
+                                "CHARACTER SET utf8mb4 "
+                                "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+                                "LINES TERMINATED BY '\\n' "
+                                f"({', '.join(column_names)})"
+                            ),
+                            {"filepath": os.path.abspath(filepath)}
+                        )
+
+                        stmt = mysql.insert(table).from_select(column_names, select(stage))
+                        stmt = stmt.on_duplicate_key_update(**{
+                            name: stmt.inserted[name] for name in get_update_column_names(table)
+                        })
+                    else:
+                        with open(filepath, "r", encoding="utf-8", newline="\n") as file:
+                            rows = []
+                            for line in file:
+                                values = line.rstrip("\n").split("\t")
+                                rows.append({
+                                    column.name: self.convert(column, self.unescape(value))
+                                    for column, value in zip(stage.columns, values)
+                                })
+                                if len(rows) >= self.chunk_size:
+                                    connection.execute(insert(stage), rows)
+                                    rows = []
+                            if len(rows) > 0:
+                                connection.execute(insert(stage), rows)
+
+                        # INSERT ... SELECT ... ON CONFLICT は構文の曖昧さを避けるため WHERE が必要
+                        stmt = sqlite.insert(table).from_select(column_names, select(stage).where(true()))
+                        stmt = stmt.on_conflict_do_update(
+                            index_elements=[column.name for column in table.primary_key.columns],
+                            set_={name: stmt.excluded[name] for name in get_update_column_names(table)}
+                        )
+
+                    result = connection.execute(stmt)
+                    self.logger.info("backfill: %s, %d rows", table.name, result.rowcount)
+
+                    stage.drop(connection)
+
+                os.remove(filepath)
+        finally:
+            db_crud.close()
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from argparse import Namespace
+import csv
+from logging import Logger
+
+import numpy as np
+
+from skylark.crud import SkylarkCrud
+from skylark.util import SkylarkUtil
+
+class SkylarkBacktest:
+    """
+    払戻金と予想をnumpy配列に一度だけ読み込み、券種ごとのボックス買いを全期間まとめて評価する
+    予想ファイルがない場合は人気順を予想として使う
+    戦略は (券種, ボックスの頭数, 予想1位の単勝オッズの範囲) の組み合わせ
+    """
+
+    # 券種(SkylarkUtil.ticket_type_list の順) -> (組の頭数, 順序あり)
+    ticket_shape_list: tuple = (
+        (1, False),  # 単勝
+        (1, False),  # 複勝
+        (2, False),  # 枠連
+        (2, False),  # 馬連
+        (2, False),  # ワイド
+        (2, True),   # 馬単
+        (3, False),  # 三連複
+        (3, True),   # 三連単
+    )
+
+    # 予想1位の単勝オッズで絞り込む範囲の境界
+    odds_bound_list: tuple = (1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 20.0, 50.0, np.inf)
+
+    # 1点あたりの購入金額
+    stake: int = 100
+
+    # 予想順位の初期値(予想なし、頭数外)
+    rank_none: int = 99
+
+    def __init__(self, args: Namespace, logger: Logger):
+        self.args = args
+        self.logger = logger
+        self.box_max: int = getattr(args, "box_max", 6)
+        self.min_bets: int = getattr(args, "min_bets", 100)
+
+    def load(self, db_crud: SkylarkCrud, predictions_file: str | None = None) -> None:
+        """
+        レース結果、予想、払戻金を配列に変換します。
+        """
+        rows = db_crud.get_race_results_for_backtest()
+        if len(rows) == 0:
+            raise ValueError("race_result_tbl is empty")
+
+        race_id, horse_number, bracket_number, odds, popularity = zip(*rows)
+        race_id = np.array(race_id, dtype=np.int64)
+        horse_number = np.array(horse_number, dtype=np.int64)
+        bracket_number = np.array([value or 0 for value in bracket_number], dtype=np.int64)
+        odds = np.array([np.nan if value is None else value for value in odds], dtype=np.float64)
+        popularity = np.array([np.nan if value is None else value for value in popularity], dtype=np.float64)
+
+        # レースの番号(開催日順)
+        unique_race_id, first_index, inverse = np.unique(race_id, return_index=True, return_inverse=True)
+        order = np.argsort(first_index)
+        position = np.empty(len(order), dtype=np.int64)
+        position[order] = np.arange(len(order))
+        race_index = position[inverse]
+        self.race_ids = unique_race_id[order]
+        race_count = len(self.race_ids)
+
+        # 予想スコア(大きいほど上位)
+        if predictions_file is None:
+            score = -popularity
+        else:
+            score = self.load_predictions(predictions_file, race_id, horse_number)
+        valid = np.isfinite(score)
+        score = np.where(valid, score, -np.inf)
+
+        # レース内の予想順位
+        order = np.lexsort((-score, race_index))
+        sorted_race = race_index[order]
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - np.searchsorted(sorted_race, sorted_race, side="left") + 1
+        rank = np.where(valid, rank, self.rank_none)
+
+        self.field_size = np.bincount(race_index, weights=valid, minlength=race_count).astype(np.int64)
+
+        # [レース, 馬番] -> 予想順位 (0列目は空き枠用に0)
+        self.rank_table = np.full((race_count, SkylarkUtil.combination_mask + 1), self.rank_none, dtype=np.int64)
+        self.rank_table[race_index, horse_number] = rank
+        self.rank_table[:, 0] = 0
+
+        # [レース, 枠番] -> 枠内の予想1位、2位の順位 (枠連用)
+        self.bracket_rank_table = np.full((2, race_count, 9), self.rank_none, dtype=np.int64)
+        order = np.lexsort((rank, bracket_number, race_index))
+        group = (race_index * 9 + bracket_number)[order]
+        nth = np.arange(len(order)) - np.searchsorted(group, group, side="left")
+        for idx in range(2):
+            selected = order[nth == idx]
+            self.bracket_rank_table[idx, race_index[selected], bracket_number[selected]] = rank[selected]
+        self.bracket_rank_table[:, :, 0] = 0
+
+        # [レース, 予想順位-1] -> 枠番 (ボックスの頭数ごとの枠連の点数計算用)
+        self.bracket_of_rank = np.zeros((race_count, self.box_max), dtype=np.int64)
+        selected = rank <= self.box_max
+        self.bracket_of_rank[race_index[selected], rank[selected] - 1] = bracket_number[selected]
+
+        # 予想1位の単勝オッズ
+        self.top_odds = np.full(race_count, np.nan)
+        selected = rank == 1
+        self.top_odds[race_index[selected]] = odds[selected]
+
+        self.load_payoffs(db_crud)
+
+        self.logger.info("backtest: %d races, %d payoffs", race_count, len(self.payoff))
+
+    def load_predictions(self, filepath: str, race_id: np.ndarray, horse_number: np.ndarray) -> np.ndarray:
+        """
+        race_id,horse_number,score 形式のCSVを読み込み、レース結果の行の順に並べます。
+        """
+        keys = []
+        values = []
+        with open(filepath, "r", newline="") as file:
+            for row in csv.DictReader(file):
+                keys.append(int(row["race_id"]) * 32 + int(row["horse_number"]))
+                values.append(float(row["score"]))
+
+        keys = np.array(keys, dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        order = np.argsort(keys)
+        keys = keys[order]
+        values = values[order]
+
+        target = race_id * 32 + horse_number
+        position = np.clip(np.searchsorted(keys, target), 0, max(len(keys) - 1, 0))
+        if len(keys) == 0:
+            return np.full(len(target), np.nan)
+        return np.where(keys[position] == target, values[position], np.nan)
+
+    def load_payoffs(self, db_crud: SkylarkCrud) -> None:
+        rows = db_crud.get_payoffs_for_backtest()
+
+        # combination_key が未設定の行だけ組番の文字列から変換する(種類が少ないため変換結果を使い回す)
+        combination_keys: dict[str, int] = {}
+        for row in rows:
+            if row[4] is None and row[2] not in combination_keys:
+                combination_keys[row[2]] = SkylarkUtil.encodeCombination(row[2])
+
+        race_id = np.array([row[0] for row in rows], dtype=np.int64)
+        ticket_type = np.array([row[1] for row in rows], dtype=np.int64)
+        combination_key = np.array([
+            combination_keys[row[2]] if row[4] is None else row[4]
+            for row in rows
+        ], dtype=np.int64)
+        payoff = np.array([row[3] for row in rows], dtype=np.float64)
+
+        # レース結果のあるレースに絞り込む
+        sorter = np.argsort(self.race_ids)
+        position = np.clip(np.searchsorted(self.race_ids, race_id, sorter=sorter), 0, len(self.race_ids) - 1)
+        selected = self.race_ids[sorter[position]] == race_id
+
+        self.payoff_race = sorter[position][selected]
+        self.payoff_type = ticket_type[selected]
+        self.payoff = payoff[selected]
+        combination_key = combination_key[selected]
+
+        # 組番の馬がすべてボックスに入る最小の頭数(=組番の中で最も低い予想順位)
+        slots = [
+            (combination_key >> (SkylarkUtil.combination_bits * idx)) & SkylarkUtil.combination_mask
+            for idx in range(3)
+        ]
+        self.payoff_rank = np.max([self.rank_table[self.payoff_race, slot] for slot in slots], axis=0)
+
+        # 枠連は枠番の組なので、同じ枠なら枠内2位、違う枠なら各枠の1位で判定する
+        bracket = self.payoff_type == SkylarkUtil.convertToTicketType2Int("枠連")
+        same = slots[0] == slots[1]
+        slots = [np.minimum(slot, 8) for slot in slots]
+        first = self.bracket_rank_table[0]
+        second = self.bracket_rank_table[1]
+        self.payoff_rank = np.where(
+            bracket,
+            np.where(
+                same,
+                second[self.payoff_race, slots[0]],
+                np.maximum(first[self.payoff_race, slots[0]], first[self.payoff_race, slots[1]])
+            ),
+            self.payoff_rank
+        )
+
+    def tickets(self, ticket_type: int, box: int) -> np.ndarray:
+        """
+        ボックス買いの点数をレースごとに返します。
+        """
+        count, ordered = self.ticket_shape_list[ticket_type]
+        box_size = np.minimum(box, self.field_size)
+
+        if ticket_type == SkylarkUtil.convertToTicketType2Int("枠連"):
+            # 選んだ馬の枠の組み合わせ(同じ枠に2頭以上なら同枠の組も含む)
+            horses = np.zeros((len(self.race_ids), 9), dtype=np.int64)
+            for idx in range(box):
+                horses[np.arange(len(self.race_ids)), self.bracket_of_rank[:, idx]] += (box_size > idx)
+            distinct = (horses[:, 1:] > 0).sum(axis=1)
+            return distinct * (distinct - 1) // 2 + (horses[:, 1:] >= 2).sum(axis=1)
+
+        result = np.ones(len(self.race_ids), dtype=np.int64)
+        for idx in range(count):
+            result *= np.maximum(box_size - idx, 0)
+        if ordered == False:
+            result //= [1, 1, 2, 6][count]
+        return result
+
+    def evaluate(self, ticket_type: int, box: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        (払戻金, 購入金額) をレースごとに返します。発売のないレースは購入金額0
+        """
+        race_count = len(self.race_ids)
+        is_type = self.payoff_type == ticket_type
+        hit = is_type & (self.payoff_rank <= box)
+
+        returns = np.bincount(self.payoff_race[hit], weights=self.payoff[hit], minlength=race_count)
+        sold = np.bincount(self.payoff_race[is_type], minlength=race_count) > 0
+        cost = np.where(sold, self.tickets(ticket_type, box) * self.stake, 0).astype(np.float64)
+
+        return (np.where(cost > 0, returns, 0.0), cost)
+
+    @staticmethod
+    def drawdown(profit: np.ndarray) -> np.ndarray:
+        """
+        戦略(行)ごとの最大ドローダウンを返します。
+        """
+        cumulative = np.cumsum(profit, axis=1)
+        peak = np.maximum.accumulate(np.maximum(cumulative, 0), axis=1)
+        return np.max(peak - cumulative, axis=1)
+
+    def sweep(self) -> list[dict]:
+        """
+        券種 x ボックスの頭数 x オッズ範囲 の全組み合わせを評価します。
+        """
+        bounds = [
+            (low, high)
+            for low_idx, low in enumerate(self.odds_bound_list)
+            for high in self.odds_bound_list[low_idx + 1:]
+        ]
+        top_odds = np.nan_to_num(self.top_odds, nan=-1.0)
+        masks = np.array([(top_odds >= low) & (top_odds < high) for low, high in bounds], dtype=np.float64)
+
+        result_list = []
+        for ticket_type, (count, _) in enumerate(self.ticket_shape_list):
+            for box in range(count, self.box_max + 1):
+                returns, cost = self.evaluate(ticket_type, box)
+
+                total_return = masks @ returns
+                total_cost = masks @ cost
+                bets = masks @ (cost > 0)
+                hits = masks @ ((cost > 0) & (returns > 0))
+                # 累積は戦略数 x レース数になるため単精度で計算する
+                drawdown = self.drawdown((masks * (returns - cost)).astype(np.float32))
+
+                for idx, (low, high) in enumerate(bounds):
+                    if bets[idx] < self.min_bets:
+                        continue
+                    result_list.append({
+                        "ticket_type": SkylarkUtil.ticket_type_list[ticket_type],
+                        "box": box,
+                        "odds_low": low,
+                        "odds_high": high,
+                        "bets": int(bets[idx]),
+                        "hit_rate": float(hits[idx] / bets[idx]),
+                        "roi": float(total_return[idx] / total_cost[idx]),
+                        "profit": float(total_return[idx] - total_cost[idx]),
+                        "max_drawdown": float(drawdown[idx]),
+                    })
+
+        return sorted(result_list, key=lambda result: result["roi"], reverse=True)
+
+    def report(self, result_list: list[dict], top: int = 20) -> None:
+        self.logger.info("backtest: %d strategies", len(result_list))
+        for result in result_list[:top]:
+            self.logger.info(
+                "%s box %d, odds [%.1f, %.1f): bets %d, hit %.3f, roi %.3f, profit %d, max drawdown %d",
+                result["ticket_type"],
+                result["box"],
+                result["odds_low"],
+                result["odds_high"],
+                result["bets"],
+                result["hit_rate"],
+                result["roi"],
+                result["profit"],
+                result["max_drawdown"]
+            )
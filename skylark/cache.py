@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import threading
+import time
+from logging import Logger
+from typing import Any, Callable
+
+
+class SkylarkCache:
+    """
+    プロセス内で共有するTTL付きキャッシュ
+    種別(kind)ごとにTTLを持ち、cache_dirを指定した場合はディスクにも保存する
+    期限切れの項目は参照時に削除し、メモリ上の項目数は maxsize を上限にLRUで削除する
+    """
+
+    # 種別ごとのTTL(秒)
+    default_ttl: dict[str, float] = {
+        "race_dates": 60 * 60,
+        "race_list": 6 * 60 * 60,
+        # 出馬表(オッズ以外は発走まで変わらない)
+        "race_information": 10 * 60,
+        # 単勝オッズ(race_id ごと)
+        "odds": 10,
+    }
+
+    def __init__(self, logger: Logger, ttl: dict[str, float] | None = None, cache_dir: str | None = None,
+                 maxsize: int = 1024):
+        self.logger = logger
+        self.ttl: dict[str, float] = dict(self.default_ttl)
+        if ttl:
+            self.ttl.update(ttl)
+        self.maxsize = maxsize
+
+        self.cache_dir = cache_dir
+        if self.cache_dir and os.path.isdir(self.cache_dir) == False:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        # (kind, key) -> (expires_at, value)、参照順
+        self.entries: OrderedDict[tuple[str, str], tuple[float, Any]] = OrderedDict()
+        self.lock = threading.Lock()
+        # 同一キーの同時取得を1回にまとめるためのロック
+        self.fetch_locks: dict[tuple[str, str], threading.Lock] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.clear()
+
+    def get(self, kind: str, key) -> tuple[bool, Any]:
+        """
+        キャッシュを参照し (hit, value) を返します。
+        """
+        entry_key = (kind, str(key))
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(entry_key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(entry_key)
+                    return True, entry[1]
+                del self.entries[entry_key]
+                self.fetch_locks.pop(entry_key, None)
+
+        entry = self._load(entry_key)
+        if entry is not None and entry[0] > now:
+            with self.lock:
+                self._store(entry_key, entry)
+            return True, entry[1]
+
+        return False, None
+
+    def set(self, kind: str, key, value) -> None:
+        entry_key = (kind, str(key))
+        entry = (time.time() + self.ttl.get(kind, 0), value)
+
+        with self.lock:
+            self._store(entry_key, entry)
+        self._save(entry_key, entry)
+
+    def _store(self, entry_key: tuple[str, str], entry: tuple[float, Any]) -> None:
+        """
+        メモリ上に保存し、期限切れの項目と maxsize を超えた古い項目を削除します。(self.lock を取得して呼ぶ)
+        """
+        self.entries[entry_key] = entry
+        self.entries.move_to_end(entry_key)
+
+        now = time.time()
+        for expired_key in [key for key, (expires_at, _) in self.entries.items() if expires_at <= now]:
+            del self.entries[expired_key]
+            self.fetch_locks.pop(expired_key, None)
+
+        while len(self.entries) > self.maxsize:
+            evicted_key, _ = self.entries.popitem(last=False)
+            self.fetch_locks.pop(evicted_key, None)
+
+    def get_or_fetch(self, kind: str, key, fetch: Callable[[], Any]) -> Any:
+        """
+        キャッシュがあれば返し、なければ fetch() の結果を保存して返します。
+        """
+        hit, value = self.get(kind, key)
+        if hit:
+            return value
+
+        entry_key = (kind, str(key))
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(entry_key, threading.Lock())
+
+        try:
+            with fetch_lock:
+                # 待っている間に他のセッションが取得済みの場合
+                hit, value = self.get(kind, key)
+                if hit:
+                    return value
+
+                self.logger.debug("cache miss: %s, %s", kind, key)
+                value = fetch()
+                self.set(kind, key, value)
+                return value
+        finally:
+            # 取得後はロックを残さない(待っていたセッションは同じロックを参照済み)
+            with self.lock:
+                if self.fetch_locks.get(entry_key) is fetch_lock:
+                    del self.fetch_locks[entry_key]
+
+    def invalidate(self, kind: str, key=None) -> None:
+        with self.lock:
+            if key is None:
+                entry_keys = [entry_key for entry_key in self.entries if entry_key[0] == kind]
+            else:
+                entry_keys = [(kind, str(key))]
+
+            for entry_key in entry_keys:
+                self.entries.pop(entry_key, None)
+                self.fetch_locks.pop(entry_key, None)
+                self._remove(entry_key)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.fetch_locks.clear()
+
+    def _filepath(self, entry_key: tuple[str, str]) -> str | None:
+        if not self.cache_dir:
+            return None
+        digest = hashlib.sha1(entry_key[1].encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{entry_key[0]}.{digest}.pkl")
+
+    def _load(self, entry_key: tuple[str, str]) -> tuple[float, Any] | None:
+        filepath = self._filepath(entry_key)
+        if filepath is None or os.path.isfile(filepath) == False:
+            return None
+
+        try:
+            with open(filepath, "rb") as fp:
+                return pickle.load(fp)
+        except Exception as ex:
+            self.logger.warning(ex)
+        return None
+
+    def _save(self, entry_key: tuple[str, str], entry: tuple[float, Any]) -> None:
+        filepath = self._filepath(entry_key)
+        if filepath is None:
+            return
+
+        try:
+            # 書き込み途中のファイルを読まないように置き換える
+            temp_filepath = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_filepath, "wb") as fp:
+                pickle.dump(entry, fp)
+            os.replace(temp_filepath, filepath)
+        except Exception as ex:
+            self.logger.warning(ex)
+
+    def _remove(self, entry_key: tuple[str, str]) -> None:
+        filepath = self._filepath(entry_key)
+        if filepath is not None and os.path.isfile(filepath):
+            try:
+                os.remove(filepath)
+            except Exception as ex:
+                self.logger.warning(ex)
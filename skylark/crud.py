@@ -5,33 +5,210 @@
 # This software is released under the MIT License.
 #
 
+import atexit
+import datetime
 from logging import Logger
-from sqlalchemy import create_engine, desc, func
-from sqlalchemy.orm import sessionmaker
+import os
+import threading
+from typing import Iterator
+from sqlalchemy import Engine, bindparam, create_engine, desc, event, func, insert, inspect, make_url, or_, select, update
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.orm import Query, Session, sessionmaker
+from sqlalchemy.schema import CreateColumn
 
-from skylark.models import Base, Feature, Horse, Jockey, Trainer, Owner, RaceInfo, RaceResult, Payoff
+from skylark.models import Base, CrawlState, Feature, IgnoreRace, FormFeature, Horse, Jockey, Trainer, Owner, RaceInfo, RaceResult, RaceEntry, RaceSummary, Payoff, OddsSnapshot, SchemaMigration
+from skylark.race_summary import SkylarkRaceSummary
+from skylark.util import SkylarkUtil
+
+def get_update_column_names(table, column_names=None) -> list[str]:
+    """
+    UPSERTで更新する列名を返します。
+    主キーと取り込み後に計算する列(info の derived)は除き、column_names を指定した場合は渡された列のみにします。
+    """
+    return [
+        column.name for column in table.columns
+        if column.primary_key == False
+        and column.info.get("derived", False) == False
+        and (column_names is None or column.name in column_names)
+    ]
+
+def make_upsert_statement(dialect_name: str, model, column_names=None):
+    """
+    方言ごとのUPSERT文を作成します。未対応の方言では None を返します。
+    """
+    table = model.__table__
+    update_column_names = get_update_column_names(table, column_names)
+
+    if dialect_name == "mysql":
+        stmt = mysql.insert(model)
+        if len(update_column_names) == 0:
+            return stmt.prefix_with("IGNORE")
+        return stmt.on_duplicate_key_update(**{name: stmt.inserted[name] for name in update_column_names})
+
+    if dialect_name == "sqlite":
+        stmt = sqlite.insert(model)
+        primary_keys = [column.name for column in table.primary_key.columns]
+        if len(update_column_names) == 0:
+            return stmt.on_conflict_do_nothing(index_elements=primary_keys)
+        return stmt.on_conflict_do_update(
+            index_elements=primary_keys,
+            set_={name: stmt.excluded[name] for name in update_column_names}
+        )
+
+    return None
+
+# URLごとにプロセス内で共有するエンジン
+engine_registry: dict[str, Engine] = {}
+engine_registry_lock = threading.Lock()
+
+def get_engine_options(pool_size: int | None = None, max_overflow: int | None = None,
+                       pool_recycle: int | None = None, pool_pre_ping: bool | None = None, **kwargs) -> dict:
+    """
+    接続プールの設定を返します。未指定の値は環境変数から取得します。
+    """
+    return kwargs | {
+        "pool_size": pool_size if pool_size is not None else int(os.getenv("DB_POOL_SIZE", 4)),
+        "max_overflow": max_overflow if max_overflow is not None else int(os.getenv("DB_MAX_OVERFLOW", 0)),
+        # 生存確認は pre-ping ではなく、サーバのタイムアウトより短い周期での再接続で行う
+        "pool_recycle": pool_recycle if pool_recycle is not None else int(os.getenv("DB_POOL_RECYCLE", 3600)),
+        "pool_pre_ping": pool_pre_ping if pool_pre_ping is not None else os.getenv("DB_POOL_PRE_PING", "false").lower() == "true",
+    }
+
+def adjust_engine_options(db_url: str, options: dict) -> dict:
+    """
+    SQLite のメモリDBは1接続を共有するプールを使うため、プールの大きさの指定を外します。
+    """
+    url = make_url(db_url)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {key: value for key, value in options.items() if key not in ("pool_size", "max_overflow")}
+    return options
+
+def is_readonly_url(db_url) -> bool:
+    """
+    読み取り専用で開く SQLite のURL(sqlite:///file:PATH?mode=ro&uri=true, immutable=1 も可)かどうかを返します。
+    """
+    url = make_url(db_url)
+    return url.get_backend_name() == "sqlite" and (url.query.get("mode") == "ro" or url.query.get("immutable") == "1")
+
+def get_sqlite_pragmas(readonly: bool = False) -> dict:
+    """
+    SQLite の接続ごとに設定する PRAGMA を返します。未指定の値は環境変数から取得します。
+    読み取り専用の場合はファイルに書き込む journal_mode, synchronous を設定しません。
+    """
+    pragmas = {} if readonly else {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+    }
+    return pragmas | {
+        "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", 30000)),
+        # 負の値は KiB 単位
+        "cache_size": -int(os.getenv("SQLITE_CACHE_SIZE_MB", 256)) * 1024,
+        "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE_MB", 1024)) * 1024 * 1024,
+        "temp_store": "MEMORY",
+    }
+
+def set_sqlite_pragmas(dbapi_connection, connection_record, readonly: bool = False) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in get_sqlite_pragmas(readonly).items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+def set_sqlite_readonly_pragmas(dbapi_connection, connection_record) -> None:
+    set_sqlite_pragmas(dbapi_connection, connection_record, readonly=True)
+
+def configure_engine(engine: Engine) -> Engine:
+    """
+    SQLite の場合は接続時に PRAGMA を設定します。(非同期エンジンは sync_engine を渡す)
+    """
+    if engine.dialect.name == "sqlite":
+        if is_readonly_url(engine.url):
+            event.listen(engine, "connect", set_sqlite_readonly_pragmas)
+        else:
+            event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
+def make_engine(db_url: str, **engine_options) -> Engine:
+    return configure_engine(create_engine(db_url, **adjust_engine_options(db_url, get_engine_options(**engine_options))))
+
+def get_engine(db_url: str, **engine_options) -> Engine:
+    """
+    URLごとに共有するエンジンを返します。初回のみ作成します。
+    """
+    with engine_registry_lock:
+        engine = engine_registry.get(db_url)
+        if engine is None:
+            engine = make_engine(db_url, **engine_options)
+            engine_registry[db_url] = engine
+        return engine
+
+def dispose_engines() -> None:
+    with engine_registry_lock:
+        for engine in engine_registry.values():
+            engine.dispose()
+        engine_registry.clear()
+
+def reset_engines_after_fork() -> None:
+    # 親プロセスの接続を子プロセスで使わないように手放す
+    for engine in engine_registry.values():
+        engine.dispose(close=False)
+    engine_registry.clear()
+
+atexit.register(dispose_engines)
+os.register_at_fork(after_in_child=reset_engines_after_fork)
+
+def make_insert_ignore_statement(dialect_name: str, model):
+    """
+    主キーが重複する行を無視するINSERT文を作成します。
+    """
+    if dialect_name == "mysql":
+        return insert(model).prefix_with("IGNORE")
+    if dialect_name == "sqlite":
+        return insert(model).prefix_with("OR IGNORE")
+    return insert(model)
+
+def speed_figure_column():
+    """
+    speed_figure(有料)がない場合は自前のスピード指数を使う列
+    """
+    return func.coalesce(RaceResult.speed_figure, RaceResult.computed_speed_figure).label("speed_figure")
 
 class SkylarkCrud:
-    def __init__(self, db_url: str, logger: Logger):
+    def __init__(self, db_url: str, logger: Logger, shared: bool = True, **engine_options):
         # Create the engine and session
-        self.engine = create_engine(
-            db_url,
-            pool_size=1,
-            max_overflow=0,
-            pool_recycle=3600,
-            pool_pre_ping=True
-        )
+        if shared:
+            self.engine = get_engine(db_url, **engine_options)
+        else:
+            self.engine = make_engine(db_url, **engine_options)
+        self.shared = shared
+        # スナップショットなど読み取り専用のDBではテーブルの作成と移行を行わない
+        self.readonly = is_readonly_url(db_url)
         self.session = sessionmaker(bind=self.engine)
         # Set the logger
         self.logger: Logger = logger
 
+    def __enter__(self):
+        return self
+
     def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        """
+        専有のエンジンを破棄します。共有のエンジンはプロセス終了時に破棄されます。
+        """
+        if self.shared:
+            return
+
         try:
             self.engine.dispose()
         except Exception as ex:
             self.logger.error(f"{ex}")
 
     def create_tables(self):
+        if self.readonly == True:
+            return
         Base.metadata.create_all(self.engine)
 
     def create_table(self, table_name: str):
@@ -44,6 +221,244 @@ class SkylarkCrud:
         except Exception as ex:
             self.logger.error(f"{ex}")
 
+    def migrate(self) -> None:
+        """
+        既存テーブルに不足している列とインデックスを追加(構成が変わったインデックスは作り直し)し、未適用のデータ移行を実行します。
+        データ移行は schema_migration_tbl に記録し、2回目以降の起動では実行しません。
+        """
+        if self.readonly == True:
+            return
+
+        with self.engine.begin() as connection:
+            inspector = inspect(connection)
+            table_names = inspector.get_table_names()
+
+            for table in Base.metadata.sorted_tables:
+                if table.name not in table_names:
+                    continue
+
+                column_names = [column["name"] for column in inspector.get_columns(table.name)]
+                for column in table.columns:
+                    if column.name not in column_names:
+                        self.logger.info("add column: %s.%s", table.name, column.name)
+                        ddl = CreateColumn(column).compile(dialect=self.engine.dialect)
+                        connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+
+                # 列の構成が変わったインデックスは作り直す
+                index_columns = {index["name"]: index["column_names"] for index in inspector.get_indexes(table.name)}
+                for index in table.indexes:
+                    column_names = [column.name for column in index.columns]
+                    if index.name not in index_columns:
+                        self.logger.info("create index: %s.%s", table.name, index.name)
+                    elif index_columns[index.name] != column_names:
+                        self.logger.info("recreate index: %s.%s(%s)", table.name, index.name, ", ".join(column_names))
+                        index.drop(connection)
+                    else:
+                        continue
+                    index.create(connection)
+
+            if SchemaMigration.__tablename__ not in table_names:
+                SchemaMigration.__table__.create(connection)
+
+        # 追加順に実行する(名前は変更しないこと)
+        migration_list = [
+            ("race_result_race_date", self.migrate_race_date),
+            ("payoff_combination_key", self.migrate_combination_key),
+            ("race_result_finishing_time_sec", lambda connection: self.backfill_by_value(
+                connection, RaceResult.finishing_time, RaceResult.finishing_time_sec,
+                lambda value: {"finishing_time_sec": SkylarkUtil.parseFinishingTime(value)}
+            )),
+            ("race_result_corners", lambda connection: self.backfill_by_value(
+                connection, RaceResult.passing_rank, RaceResult.corner_4,
+                lambda value: dict(zip(["corner_1", "corner_2", "corner_3", "corner_4"], SkylarkUtil.parseCorners(value)))
+            )),
+            ("race_result_margin_length", lambda connection: self.backfill_by_value(
+                connection, RaceResult.margin, RaceResult.margin_length,
+                lambda value: {"margin_length": SkylarkUtil.parseMargin(value)}
+            )),
+            ("race_result_margin_length_blank", self.migrate_margin_length_blank),
+            # 集計は自身のセッションでチャンクごとにコミットする
+            ("race_summary", lambda connection: self.fill_race_summaries()),
+        ]
+
+        with self.engine.connect() as connection:
+            applied_names = set(connection.execute(select(SchemaMigration.name)).scalars().all())
+
+        for name, migration in migration_list:
+            if name in applied_names:
+                continue
+
+            self.logger.info("data migration: %s", name)
+            with self.engine.begin() as connection:
+                migration(connection)
+                connection.execute(insert(SchemaMigration).values(name=name, applied_at=datetime.datetime.now()))
+
+        if self.engine.dialect.name == "sqlite":
+            # 追加したインデックスの統計を必要なものだけ更新する
+            with self.engine.begin() as connection:
+                connection.exec_driver_sql("PRAGMA optimize")
+
+    def migrate_race_date(self, connection) -> None:
+        """
+        race_result_tbl.race_date を race_info_tbl.date から埋めます。
+        """
+        result = connection.execute(
+            update(RaceResult)
+            .where(RaceResult.race_date.is_(None))
+            .values(race_date=select(RaceInfo.date).where(RaceInfo.id == RaceResult.race_id).scalar_subquery())
+        )
+        if result.rowcount > 0:
+            self.logger.info("race_date backfilled: %d rows", result.rowcount)
+
+    def migrate_margin_length_blank(self, connection) -> None:
+        """
+        着差が空欄の行の race_result_tbl.margin_length を、1着は0、それ以外(取消、中止など)は NULL にします。
+        """
+        result = connection.execute(
+            update(RaceResult)
+            .where(RaceResult.margin == "", or_(RaceResult.order_of_finish.is_(None), RaceResult.order_of_finish != 1))
+            .values(margin_length=None)
+        )
+        if result.rowcount > 0:
+            self.logger.info("margin_length cleared: %d rows", result.rowcount)
+
+        connection.execute(
+            update(RaceResult)
+            .where(RaceResult.order_of_finish == 1, RaceResult.margin_length.is_(None))
+            .values(margin_length=0.0)
+        )
+
+    def migrate_combination_key(self, connection) -> None:
+        """
+        payoff_tbl.combination_key を horse_numbers から埋めます。(組番の種類ごとに1回更新)
+        """
+        horse_numbers_list = connection.execute(
+            select(Payoff.horse_numbers).where(Payoff.combination_key.is_(None)).distinct()
+        ).scalars().all()
+        if len(horse_numbers_list) > 0:
+            connection.execute(
+                update(Payoff)
+                .where(Payoff.combination_key.is_(None), Payoff.horse_numbers == bindparam("value"))
+                .values(combination_key=bindparam("key")),
+                [
+                    {"value": horse_numbers, "key": SkylarkUtil.encodeCombination(horse_numbers)}
+                    for horse_numbers in horse_numbers_list
+                ]
+            )
+            self.logger.info("combination_key backfilled: %d combinations", len(horse_numbers_list))
+
+    def backfill_by_value(self, connection, source, target, convert) -> None:
+        """
+        target が NULL の行の source の値ごとに convert の結果で更新します。
+        変換結果が NULL になる値は対象外
+        """
+        value_list = connection.execute(
+            select(source).where(target.is_(None), source.isnot(None)).distinct()
+        ).scalars().all()
+
+        dataset_list = []
+        for value in value_list:
+            dataset = convert(value)
+            if dataset.get(target.key) is not None:
+                dataset_list.append({"source_value": value} | {"value_" + key: val for key, val in dataset.items()})
+        if len(dataset_list) == 0:
+            return
+
+        table = source.class_.__table__
+        connection.execute(
+            table.update()
+            .where(table.c[target.key].is_(None), table.c[source.key] == bindparam("source_value"))
+            .values({key[len("value_"):]: bindparam(key) for key in dataset_list[0] if key.startswith("value_")}),
+            dataset_list
+        )
+        self.logger.info("%s backfilled: %d values", target.key, len(dataset_list))
+
+    def fill_race_summaries(self, chunk_size: int = 1000) -> None:
+        """
+        race_summary_tbl に行のないレースの集計を race_result_tbl から作成します。
+        """
+        with self.session() as session:
+            race_ids = session.execute(
+                select(RaceInfo.id)
+                .where(
+                    ~select(RaceSummary.race_id).where(RaceSummary.race_id == RaceInfo.id).exists(),
+                    select(RaceResult.race_id).where(RaceResult.race_id == RaceInfo.id).exists()
+                )
+                .order_by(RaceInfo.id)
+            ).scalars().all()
+
+        for idx in range(0, len(race_ids), chunk_size):
+            chunk = race_ids[idx:idx + chunk_size]
+            with self.session() as session:
+                try:
+                    rows = session.execute(
+                        select(RaceResult.__table__)
+                        .where(RaceResult.race_id.in_(chunk))
+                        .order_by(RaceResult.race_id, RaceResult.horse_number)
+                    ).mappings().all()
+
+                    dataset_result: dict[int, list] = {}
+                    for row in rows:
+                        dataset_result.setdefault(row["race_id"], []).append(row)
+
+                    self.upsert_rows(session, RaceSummary, [
+                        SkylarkRaceSummary.make(race_id, result) for race_id, result in dataset_result.items()
+                    ])
+                    session.commit()
+                except Exception as ex:
+                    session.rollback()
+                    raise ex
+
+            self.logger.info("race_summary filled: %d/%d races", min(idx + chunk_size, len(race_ids)), len(race_ids))
+
+    def explain_feature_queries(self, horse_id: int, date, distance: int) -> dict[str, list]:
+        """
+        特徴量計算のクエリの実行計画を取得します。
+        race_result_tbl を全件走査するクエリがあれば警告します。
+        """
+        plans: dict[str, list] = {}
+
+        with self.session() as session:
+            queries: dict[str, Query] = {
+                "speed_figure": self.query_horse_history(session, [speed_figure_column()], horse_id, date)
+                    .filter(speed_figure_column().isnot(None))
+                    .limit(5),
+                "winner": self.query_horse_history(session, [RaceResult.order_of_finish], horse_id, date)
+                    .filter(RaceResult.order_of_finish.between(1, 3))
+                    .limit(5),
+                "disavesr": self.query_horse_history(session, [speed_figure_column()], horse_id, date, join_race_info=True)
+                    .filter(RaceInfo.distance == distance, speed_figure_column().isnot(None))
+                    .limit(100),
+                "distance": self.query_horse_history(session, [RaceInfo.distance], horse_id, date, join_race_info=True)
+                    .limit(100),
+                "earning_money": self.query_horse_history(session, [RaceResult.earning_money], horse_id, date)
+                    .limit(100),
+            }
+
+            dialect = session.get_bind().dialect
+            prefix = "EXPLAIN QUERY PLAN" if dialect.name == "sqlite" else "EXPLAIN"
+
+            for name, query in queries.items():
+                compiled = query.statement.compile(dialect=dialect)
+                if compiled.positional:
+                    params = tuple(compiled.params[key] for key in compiled.positiontup or [])
+                else:
+                    params = compiled.params
+
+                rows = session.connection().exec_driver_sql(f"{prefix} {compiled}", params).mappings().all()
+                plans[name] = [dict(row) for row in rows]
+
+                for row in plans[name]:
+                    full_scan = (
+                        row.get("table") == RaceResult.__tablename__ and row.get("type") == "ALL"
+                    ) or (
+                        str(row.get("detail", "")).startswith(f"SCAN {RaceResult.__tablename__}")
+                    )
+                    if full_scan:
+                        self.logger.warning("full scan: %s, %s", name, row)
+
+        return plans
+
     def drop_tables(self):
         Base.metadata.drop_all(self.engine)
 
@@ -57,6 +472,146 @@ class SkylarkCrud:
         except Exception as ex:
             self.logger.error(f"{ex}")
 
+    def upsert_rows(self, session: Session, model, dataset_list: list) -> None:
+        """
+        複数行を1文でまとめてUPSERTします。(コミットは呼び出し側で行う)
+        """
+        if len(dataset_list) == 0:
+            return
+
+        # 渡されていない列(計算済みの列など)は既存の値を残す
+        stmt = make_upsert_statement(session.get_bind().dialect.name, model, set(dataset_list[0].keys()))
+        if stmt is not None:
+            session.execute(stmt, dataset_list)
+        else:
+            for dataset in dataset_list:
+                session.merge(model(**dataset))
+
+    def get_entity_names(self, model, id_column: str, name_column: str) -> dict:
+        """
+        馬、騎手、調教師、馬主のIDと名前の対応を全件取得します。
+        """
+        with self.session() as session:
+            try:
+                rows = session.query(getattr(model, id_column), getattr(model, name_column)).all()
+                return {row[0]: row[1] for row in rows}
+            except Exception as ex:
+                self.logger.error(ex)
+        return {}
+
+    def get_ignore_race_ids(self) -> set[int]:
+        with self.session() as session:
+            try:
+                return {row[0] for row in session.query(IgnoreRace.race_id).all()}
+            except Exception as ex:
+                self.logger.error(ex)
+        return set()
+
+    def get_ingested_race_ids(self, race_ids: list[int], chunk_size: int = 1000) -> set[int]:
+        """
+        指定したレースのうち、レース情報と結果が保存済みのものを chunk_size 件ずつの IN で取得します。
+        """
+        race_ids = sorted(set(race_ids))
+        ingested_race_ids: set[int] = set()
+
+        with self.session() as session:
+            try:
+                for idx in range(0, len(race_ids), chunk_size):
+                    rows = session.query(RaceInfo.id).filter(
+                        RaceInfo.id.in_(race_ids[idx:idx + chunk_size]),
+                        select(RaceResult.race_id).where(RaceResult.race_id == RaceInfo.id).exists()
+                    ).all()
+                    ingested_race_ids.update(row[0] for row in rows)
+                return ingested_race_ids
+            except Exception as ex:
+                self.logger.error(ex)
+        return set()
+
+    def enqueue_crawl_races(self, race_ids: list[int], chunk_size: int = 10000) -> None:
+        """
+        未登録のレースIDをクロール対象として登録します。
+        """
+        with self.session() as session:
+            try:
+                stmt = make_insert_ignore_statement(session.get_bind().dialect.name, CrawlState)
+                for idx in range(0, len(race_ids), chunk_size):
+                    session.execute(stmt, [
+                        {"race_id": race_id, "status": "pending", "attempts": 0}
+                        for race_id in race_ids[idx:idx + chunk_size]
+                    ])
+                session.commit()
+            except Exception as ex:
+                session.rollback()
+                raise ex
+
+    def reset_crawl_claims(self, timeout: int) -> int:
+        """
+        一定時間完了しない取得中のレースを未取得に戻します。(異常終了したプロセスの分)
+        """
+        with self.session() as session:
+            try:
+                result = session.execute(
+                    update(CrawlState)
+                    .where(
+                        CrawlState.status == "claimed",
+                        CrawlState.claimed_at < datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+                    )
+                    .values(status="pending", claim_token=None)
+                )
+                session.commit()
+                return result.rowcount
+            except Exception as ex:
+                session.rollback()
+                raise ex
+
+    def update_crawl_status(self, race_ids: list[int], status: str, chunk_size: int = 10000) -> int:
+        """
+        parsed(TSVに書き出し済み)のレースの状態を変更します。
+        """
+        race_ids = sorted(race_ids)
+        count = 0
+        with self.session() as session:
+            try:
+                for idx in range(0, len(race_ids), chunk_size):
+                    result = session.execute(
+                        update(CrawlState)
+                        .where(CrawlState.status == "parsed", CrawlState.race_id.in_(race_ids[idx:idx + chunk_size]))
+                        .values(status=status, claim_token=None)
+                    )
+                    count += result.rowcount
+                session.commit()
+            except Exception as ex:
+                session.rollback()
+                raise ex
+        return count
+
+    def reset_parsed_crawl_races(self, pending_race_ids: set[int]) -> tuple[int, int]:
+        """
+        前回までのプロセスが parsed のまま残したレースを、保存済みなら done に、
+        ロード待ちのTSV(pending_race_ids)にもなければ pending に戻します。(ロード前の異常終了の分)
+        """
+        with self.session() as session:
+            race_ids = [row[0] for row in session.query(CrawlState.race_id).filter(CrawlState.status == "parsed").all()]
+        if len(race_ids) == 0:
+            return (0, 0)
+
+        ingested_race_ids = self.get_ingested_race_ids(race_ids)
+        done = self.update_crawl_status([race_id for race_id in race_ids if race_id in ingested_race_ids], "done")
+        pending = self.update_crawl_status([
+            race_id for race_id in race_ids
+            if race_id not in ingested_race_ids and race_id not in pending_race_ids
+        ], "pending")
+        return (done, pending)
+
+    def get_crawl_status_counts(self) -> dict[str, int]:
+        with self.session() as session:
+            try:
+                rows = session.query(CrawlState.status, func.count()).group_by(CrawlState.status).all()
+                return {row[0]: row[1] for row in rows}
+            except Exception as ex:
+                self.logger.error(ex)
+        return {}
+
     def get_horse(self, horse_id) -> Horse|None:
         with self.session() as session:
             try:
@@ -200,6 +755,25 @@ class SkylarkCrud:
                 session.rollback()
                 raise ex
 
+    def upsert_race_entries(self, dataset_race_info: list, dataset_horse: list, dataset_jockey: list,
+                            dataset_trainer: list, dataset_entry: list) -> None:
+        """
+        出馬表(レース情報、馬、騎手、調教師、出走馬)を1トランザクションで保存します。
+        """
+        with self.session() as session:
+            try:
+                # 出馬表のレース情報は結果の取り込み時の値を上書きしないよう、未登録の場合のみ追加する
+                if len(dataset_race_info) > 0:
+                    session.execute(make_insert_ignore_statement(session.get_bind().dialect.name, RaceInfo), dataset_race_info)
+                self.upsert_rows(session, Horse, dataset_horse)
+                self.upsert_rows(session, Jockey, dataset_jockey)
+                self.upsert_rows(session, Trainer, dataset_trainer)
+                self.upsert_rows(session, RaceEntry, dataset_entry)
+                session.commit()
+            except Exception as ex:
+                session.rollback()
+                raise ex
+
     def get_race_results(self) -> list[RaceResult] | None:
         with self.session() as session:
             try:
@@ -257,6 +831,21 @@ class SkylarkCrud:
                 session.rollback()
                 raise ex
 
+    def insert_odds_snapshots(self, dataset_list: list) -> None:
+        """
+        オッズのスナップショットをまとめて挿入します。
+        """
+        if len(dataset_list) == 0:
+            return
+
+        with self.session() as session:
+            try:
+                session.execute(insert(OddsSnapshot), dataset_list)
+                session.commit()
+            except Exception as ex:
+                session.rollback()
+                raise ex
+
     def insert_features(self, dataset_list: list) -> None:
         with self.session() as session:
             try:
@@ -268,26 +857,254 @@ class SkylarkCrud:
                 session.rollback()
                 raise ex
 
-    def get_speed_figure_last(self, horse_id: int, date) -> float|None:
+    def upsert_form_features(self, dataset_list: list) -> None:
+        with self.session() as session:
+            try:
+                self.upsert_rows(session, FormFeature, dataset_list)
+                session.commit()
+            except Exception as ex:
+                session.rollback()
+                raise ex
+
+    def iter_race_results_by_date(self, days_per_chunk: int = 28) -> Iterator:
+        """
+        全レース結果を開催日順に逐次取得します。
+        取得は開催日の範囲ごとに分けて行い、取得の合間は接続を保持しません。
+        """
+        with self.session() as session:
+            dates = [row[0] for row in session.query(RaceInfo.date).distinct().order_by(RaceInfo.date)]
+
+        for idx in range(0, len(dates), days_per_chunk):
+            chunk = dates[idx:idx + days_per_chunk]
+            with self.session() as session:
+                rows = session.execute(
+                    select(
+                        RaceResult.race_id,
+                        RaceResult.horse_id,
+                        RaceResult.jockey_id,
+                        RaceResult.trainer_id,
+                        RaceResult.owner_id,
+                        RaceResult.order_of_finish,
+                        RaceInfo.date,
+                        RaceInfo.track_surface,
+                        RaceInfo.distance
+                    )
+                    .join(RaceInfo, RaceResult.race_id == RaceInfo.id)
+                    .where(RaceInfo.date.between(chunk[0], chunk[-1]))
+                    .order_by(RaceInfo.date, RaceResult.race_id, RaceResult.horse_number)
+                ).all()
+
+            yield from rows
+
+    def get_race_results_for_backtest(self) -> list:
+        """
+        全レースの馬番、枠番、単勝オッズ、人気を開催日順に取得します。
+        """
+        with self.session() as session:
+            try:
+                return session.execute(
+                    select(
+                        RaceResult.race_id,
+                        RaceResult.horse_number,
+                        RaceResult.bracket_number,
+                        RaceResult.odds,
+                        RaceResult.popularity
+                    )
+                    .join(RaceInfo, RaceResult.race_id == RaceInfo.id)
+                    .order_by(RaceInfo.date, RaceResult.race_id, RaceResult.horse_number)
+                ).all()
+            except Exception as ex:
+                self.logger.error(ex)
+        return []
+
+    def get_payoff(self, race_id: int, ticket_type: int, horse_numbers: list[int], ordered: bool = False) -> Payoff|None:
+        """
+        馬番(枠連は枠番)の組から払戻金を取得します。順序なしの券種は馬番の順不同
+        """
+        with self.session() as session:
+            try:
+                return session.query(Payoff).filter_by(
+                    race_id=race_id,
+                    ticket_type=ticket_type,
+                    combination_key=SkylarkUtil.encodeHorseNumbers(horse_numbers, ordered)
+                ).first()
+            except Exception as ex:
+                self.logger.error(ex)
+        return None
+
+    def get_payoffs_for_backtest(self) -> list:
+        with self.session() as session:
+            try:
+                return session.execute(
+                    select(Payoff.race_id, Payoff.ticket_type, Payoff.horse_numbers, Payoff.payoff, Payoff.combination_key)
+                ).all()
+            except Exception as ex:
+                self.logger.error(ex)
+        return []
+
+    def get_horse_history(self, horse_id: int) -> list:
+        """
+        特定の馬の全レース結果を新しい順に取得します。
+        """
         assert horse_id > 0
 
         with self.session() as session:
             try:
-                result = (
-                    session.query(RaceResult.speed_figure)
+                return (
+                    session.query(
+                        RaceResult.race_id,
+                        RaceResult.race_date,
+                        RaceResult.order_of_finish,
+                        speed_figure_column(),
+                        RaceResult.earning_money,
+                        RaceInfo.distance
+                    )
                     .join(RaceInfo, RaceResult.race_id == RaceInfo.id)
-                    .filter(
-                        RaceResult.horse_id == horse_id,
-                        RaceInfo.date < date,
-                        RaceResult.speed_figure.isnot(None)
+                    .filter(RaceResult.horse_id == horse_id)
+                    .order_by(desc(RaceResult.race_date))
+                    .all()
+                )
+            except Exception as ex:
+                self.logger.error(ex)
+        return []
+
+    def get_past_performances(self, horse_ids: list[int], date, limit: int) -> list:
+        """
+        複数の馬の指定日より前のレース結果を、馬ごとに新しい順で最大 limit 件ずつ1回のクエリで取得します。
+        """
+        if len(horse_ids) == 0:
+            return []
+
+        ranked = (
+            select(
+                RaceResult.race_id,
+                RaceResult.horse_id,
+                RaceResult.race_date,
+                RaceResult.horse_number,
+                RaceResult.order_of_finish,
+                RaceResult.popularity,
+                RaceResult.odds,
+                RaceResult.jockey_id,
+                RaceResult.basis_weight,
+                RaceResult.finishing_time_sec,
+                RaceResult.margin,
+                RaceResult.passing_rank,
+                RaceResult.last_phase,
+                RaceResult.horse_weight,
+                speed_figure_column(),
+                func.row_number().over(
+                    partition_by=RaceResult.horse_id,
+                    order_by=(desc(RaceResult.race_date), desc(RaceResult.race_id))
+                ).label("row_number")
+            )
+            .where(
+                RaceResult.horse_id.in_(horse_ids),
+                RaceResult.race_date < date
+            )
+            .subquery()
+        )
+
+        with self.session() as session:
+            try:
+                return session.execute(
+                    select(
+                        ranked.c.horse_id,
+                        ranked.c.race_id,
+                        ranked.c.race_date,
+                        RaceInfo.place_detail,
+                        RaceInfo.race_name,
+                        RaceInfo.track_surface,
+                        RaceInfo.distance,
+                        RaceInfo.track_condition,
+                        ranked.c.horse_number,
+                        ranked.c.order_of_finish,
+                        ranked.c.popularity,
+                        ranked.c.odds,
+                        Jockey.jockey_name,
+                        ranked.c.basis_weight,
+                        ranked.c.finishing_time_sec,
+                        ranked.c.margin,
+                        ranked.c.passing_rank,
+                        ranked.c.last_phase,
+                        ranked.c.horse_weight,
+                        ranked.c.speed_figure
+                    )
+                    .join(RaceInfo, ranked.c.race_id == RaceInfo.id)
+                    .outerjoin(Jockey, ranked.c.jockey_id == Jockey.jockey_id)
+                    .where(ranked.c.row_number <= limit)
+                    .order_by(ranked.c.horse_id, ranked.c.row_number)
+                ).all()
+            except Exception as ex:
+                self.logger.error(ex)
+        return []
+
+    def get_race_runners(self, race_id: int) -> tuple:
+        """
+        レースの開催日と出走馬(馬番, 馬ID, 馬名)を取得します。結果がない場合は出馬表から取得します。
+        """
+        with self.session() as session:
+            try:
+                race_date = session.query(RaceInfo.date).filter(RaceInfo.id == race_id).scalar()
+                for model in (RaceResult, RaceEntry):
+                    rows = (
+                        session.query(model.horse_number, model.horse_id, Horse.horse_name)
+                        .outerjoin(Horse, model.horse_id == Horse.horse_id)
+                        .filter(model.race_id == race_id)
+                        .order_by(model.horse_number)
+                        .all()
                     )
-                    .order_by(desc(RaceInfo.date))
+                    if len(rows) > 0:
+                        return race_date, rows
+                return race_date, []
+            except Exception as ex:
+                self.logger.error(ex)
+        return None, []
+
+    def get_data_version(self) -> tuple | None:
+        """
+        結果の取り込みで変わる値(取り込み済みレース数と最大レースID)を取得します。
+        race_summary_tbl は結果の取り込み時に1レース1行で書き込まれるため、結果の全件数より軽く数えられます。
+        """
+        with self.session() as session:
+            try:
+                row = session.query(func.count(), func.max(RaceSummary.race_id)).one()
+                return tuple(row)
+            except Exception as ex:
+                self.logger.error(ex)
+        return None
+
+    def query_horse_history(self, session: Session, columns: list, horse_id: int, date, join_race_info: bool = False) -> Query:
+        """
+        特定の馬の指定日より前のレース結果を新しい順に取得するクエリを作成します。
+        idx_horse_date を使うため race_date で絞り込みます。
+        """
+        query = session.query(*columns).select_from(RaceResult)
+        if join_race_info:
+            query = query.join(RaceInfo, RaceResult.race_id == RaceInfo.id)
+
+        return (
+            query
+            .filter(
+                RaceResult.horse_id == horse_id,
+                RaceResult.race_date < date
+            )
+            .order_by(desc(RaceResult.race_date))
+        )
+
+    def get_speed_figure_last(self, horse_id: int, date) -> float|None:
+        assert horse_id > 0
+
+        with self.session() as session:
+            try:
+                result = (
+                    self.query_horse_history(session, [speed_figure_column()], horse_id, date)
+                    .filter(speed_figure_column().isnot(None))
                     .limit(1)
                     .scalar()
                 )
                 return result
             except Exception as ex:
-                print(ex)
+                self.logger.error(ex)
         return None
 
     def get_speed_figure_avg(self, horse_id: int, date, limit: int) -> float|None:
@@ -296,14 +1113,8 @@ class SkylarkCrud:
         with self.session() as session:
             try:
                 subquery = (
-                    session.query(RaceResult.speed_figure)
-                    .join(RaceInfo, RaceResult.race_id == RaceInfo.id)
-                    .filter(
-                        RaceResult.horse_id == horse_id,
-                        RaceInfo.date < date,
-                        RaceResult.speed_figure.isnot(None)
-                    )
-                    .order_by(desc(RaceInfo.date))
+                    self.query_horse_history(session, [speed_figure_column()], horse_id, date)
+                    .filter(speed_figure_column().isnot(None))
                     .limit(limit)
                     .subquery()
                 )
@@ -320,15 +1131,11 @@ class SkylarkCrud:
         with self.session() as session:
             try:
                 subquery = (
-                    session.query(RaceResult.order_of_finish)
-                    .join(RaceInfo, RaceResult.race_id == RaceInfo.id)
+                    self.query_horse_history(session, [RaceResult.order_of_finish], horse_id, date)
                     .filter(
-                        RaceResult.horse_id == horse_id,
                         RaceResult.order_of_finish.between(1, 3),
-                        RaceInfo.date < date,
-                        RaceResult.speed_figure.isnot(None)
+                        speed_figure_column().isnot(None)
                     )
-                    .order_by(desc(RaceInfo.date))
                     .limit(limit)
                     .subquery()
                 )
@@ -348,15 +1155,11 @@ class SkylarkCrud:
         with self.session() as session:
             try:
                 subquery = (
-                    session.query(RaceResult.speed_figure)
-                    .join(RaceInfo, RaceResult.race_id == RaceInfo.id)
+                    self.query_horse_history(session, [speed_figure_column()], horse_id, date, join_race_info=True)
                     .filter(
-                        RaceResult.horse_id == horse_id,
-                        RaceInfo.date < date,
                         RaceInfo.distance == distance,
-                        RaceResult.speed_figure.isnot(None)
+                        speed_figure_column().isnot(None)
                     )
-                    .order_by(desc(RaceInfo.date))
                     .limit(limit)
                     .subquery()
                 )
@@ -376,13 +1179,7 @@ class SkylarkCrud:
         with self.session() as session:
             try:
                 subquery = (
-                    session.query(RaceInfo.distance)
-                    .join(RaceResult, RaceInfo.id == RaceResult.race_id)
-                    .filter(
-                        RaceResult.horse_id == horse_id,
-                        RaceInfo.date < date
-                    )
-                    .order_by(desc(RaceInfo.date))
+                    self.query_horse_history(session, [RaceInfo.distance], horse_id, date, join_race_info=True)
                     .limit(limit)
                     .subquery()
                 )
@@ -402,13 +1199,7 @@ class SkylarkCrud:
         with self.session() as session:
             try:
                 subquery = (
-                    session.query(RaceResult.earning_money)
-                    .join(RaceInfo, RaceResult.race_id == RaceInfo.id)
-                    .filter(
-                        RaceResult.horse_id == horse_id,
-                        RaceInfo.date < date
-                    )
-                    .order_by(desc(RaceInfo.date))
+                    self.query_horse_history(session, [RaceResult.earning_money], horse_id, date)
                     .limit(limit)
                     .subquery()
                 )
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import datetime
+from logging import Logger
+import uuid
+from sqlalchemy import or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from skylark.crud import adjust_engine_options, configure_engine, make_upsert_statement
+from skylark.models import CrawlState, Horse, Jockey, Trainer, Owner, RaceInfo, RaceResult, RaceSummary, Payoff
+
+class SkylarkCrudAsync:
+    """
+    SkylarkCrud の非同期版
+    mysql+pymysql は mysql+aiomysql に、sqlite は sqlite+aiosqlite に置き換えて接続する
+    """
+
+    driver_list: dict[str, str] = {
+        "mysql+pymysql": "mysql+aiomysql",
+        "mysql": "mysql+aiomysql",
+        "sqlite": "sqlite+aiosqlite",
+    }
+
+    def __init__(self, db_url: str, logger: Logger, pool_size: int = 4, max_overflow: int = 0):
+        # Create the engine and session
+        db_url = self.convert_url(db_url)
+        self.engine = create_async_engine(
+            db_url,
+            **adjust_engine_options(db_url, {
+                "pool_size": pool_size,
+                "max_overflow": max_overflow,
+                "pool_recycle": 3600
+            })
+        )
+        configure_engine(self.engine.sync_engine)
+        self.session = async_sessionmaker(bind=self.engine, expire_on_commit=False)
+        # Set the logger
+        self.logger: Logger = logger
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.dispose()
+
+    @classmethod
+    def convert_url(cls, db_url: str) -> str:
+        scheme, separator, rest = db_url.partition("://")
+        return cls.driver_list.get(scheme, scheme) + separator + rest
+
+    async def dispose(self) -> None:
+        try:
+            await self.engine.dispose()
+        except Exception as ex:
+            self.logger.error(f"{ex}")
+
+    async def upsert_rows(self, session: AsyncSession, model, dataset_list: list) -> None:
+        """
+        複数行を1文でまとめてUPSERTします。(コミットは呼び出し側で行う)
+        """
+        if len(dataset_list) == 0:
+            return
+
+        # 渡されていない列(計算済みの列など)は既存の値を残す
+        stmt = make_upsert_statement(self.engine.dialect.name, model, set(dataset_list[0].keys()))
+        if stmt is not None:
+            await session.execute(stmt, dataset_list)
+        else:
+            for dataset in dataset_list:
+                await session.merge(model(**dataset))
+
+    async def upsert_race(self, dataset_info: dict, dataset_horse: list, dataset_jockey: list, dataset_trainer: list,
+                          dataset_owner: list, dataset_result: list, dataset_payoff: list,
+                          dataset_summary: dict | None = None) -> None:
+        """
+        1レース分の結果を1トランザクションで保存します。
+        """
+        async with self.session() as session:
+            try:
+                await self.upsert_rows(session, RaceInfo, [dataset_info])
+                await self.upsert_rows(session, Horse, dataset_horse)
+                await self.upsert_rows(session, Jockey, dataset_jockey)
+                await self.upsert_rows(session, Trainer, dataset_trainer)
+                await self.upsert_rows(session, Owner, dataset_owner)
+                await self.upsert_rows(session, RaceResult, dataset_result)
+                await self.upsert_rows(session, Payoff, dataset_payoff)
+                if dataset_summary is not None:
+                    await self.upsert_rows(session, RaceSummary, [dataset_summary])
+                await session.commit()
+            except Exception as ex:
+                await session.rollback()
+                raise ex
+
+    async def claim_crawl_races(self, limit: int, max_attempts: int) -> list[int]:
+        """
+        未取得または再試行可能なレースを取得中にして返します。
+        状態を条件に更新するため、複数のプロセスが同じレースを取得することはありません。
+        """
+        claim_token = uuid.uuid4().hex
+        claimable = or_(
+            CrawlState.status == "pending",
+            (CrawlState.status == "failed") & (CrawlState.attempts < max_attempts)
+        )
+
+        async with self.session() as session:
+            try:
+                # 他のプロセスに先に取得された場合は候補を選び直す
+                while True:
+                    result = await session.execute(
+                        select(CrawlState.race_id)
+                        .where(claimable)
+                        .order_by(CrawlState.race_id)
+                        .limit(limit)
+                    )
+                    race_ids = [row[0] for row in result]
+                    if len(race_ids) == 0:
+                        return []
+
+                    await session.execute(
+                        update(CrawlState)
+                        .where(CrawlState.race_id.in_(race_ids), claimable)
+                        .values(
+                            status="claimed",
+                            claim_token=claim_token,
+                            claimed_at=datetime.datetime.now(),
+                            attempts=CrawlState.attempts + 1
+                        )
+                    )
+                    await session.commit()
+
+                    result = await session.execute(
+                        select(CrawlState.race_id)
+                        .where(CrawlState.claim_token == claim_token, CrawlState.status == "claimed")
+                        .order_by(CrawlState.race_id)
+                    )
+                    claimed_ids = [row[0] for row in result]
+                    if len(claimed_ids) > 0:
+                        return claimed_ids
+            except Exception as ex:
+                await session.rollback()
+                raise ex
+
+    async def update_crawl_race(self, race_id: int, status: str, last_error: str | None = None,
+                                fetched_at: datetime.datetime | None = None,
+                                parsed_at: datetime.datetime | None = None) -> None:
+        values: dict = {"status": status, "claim_token": None}
+        if last_error is not None:
+            values["last_error"] = last_error[:4096]
+        if fetched_at is not None:
+            values["fetched_at"] = fetched_at
+        if parsed_at is not None:
+            values["parsed_at"] = parsed_at
+
+        async with self.session() as session:
+            try:
+                await session.execute(update(CrawlState).where(CrawlState.race_id == race_id).values(**values))
+                await session.commit()
+            except Exception as ex:
+                await session.rollback()
+                raise ex
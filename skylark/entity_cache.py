@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from logging import Logger
+import threading
+
+from skylark.crud import SkylarkCrud
+from skylark.models import Horse, Jockey, Trainer, Owner
+
+class SkylarkEntityCache:
+    """
+    登録済みの馬、騎手、調教師、馬主の(ID, 名前)を保持し、
+    新規または名前が変わったものだけを書き込み対象にする
+    """
+
+    # データセットのキー -> (モデル, ID列, 名前列)
+    entity_list: dict = {
+        "horse": (Horse, "horse_id", "horse_name"),
+        "jockey": (Jockey, "jockey_id", "jockey_name"),
+        "trainer": (Trainer, "trainer_id", "trainer_name"),
+        "owner": (Owner, "owner_id", "owner_name"),
+    }
+
+    def __init__(self, logger: Logger):
+        self.logger = logger
+        self.names: dict[str, dict] = {key: {} for key in self.entity_list}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def load(self, db_crud: SkylarkCrud) -> None:
+        """
+        DBに登録済みの全件を読み込みます。
+        """
+        for key, (model, id_column, name_column) in self.entity_list.items():
+            names = db_crud.get_entity_names(model, id_column, name_column)
+            with self.lock:
+                self.names[key] = names
+            self.logger.info("entity cache: %s, %d rows", key, len(names))
+
+    def filter(self, key: str, dataset_list: list) -> list:
+        """
+        未登録または名前が変わった行のみを返します。(同じIDは1行にまとめる)
+        """
+        _, id_column, name_column = self.entity_list[key]
+        result: dict = {}
+        with self.lock:
+            names = self.names[key]
+            for dataset in dataset_list:
+                entity_id = dataset[id_column]
+                if entity_id in names and names[entity_id] == dataset[name_column]:
+                    continue
+                result[entity_id] = dataset
+        return list(result.values())
+
+    def update(self, key: str, dataset_list: list) -> None:
+        """
+        書き込みが完了した行を登録済みにします。
+        """
+        _, id_column, name_column = self.entity_list[key]
+        with self.lock:
+            names = self.names[key]
+            for dataset in dataset_list:
+                names[dataset[id_column]] = dataset[name_column]
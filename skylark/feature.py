@@ -6,17 +6,54 @@
 #
 
 import json
+from collections import OrderedDict, deque
 from skylark.crud import SkylarkCrud
+from skylark.util import SkylarkUtil
+
+
+class HorseHistoryCache():
+    """
+    馬ごとの全レース結果を保持するLRUキャッシュ
+    """
+    def __init__(self, maxsize: int = 1024):
+        assert maxsize > 0
+
+        self.maxsize = maxsize
+        self.histories: OrderedDict[int, list] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, db_crud: SkylarkCrud, horse_id: int) -> list:
+        history = self.histories.get(horse_id)
+        if history is not None:
+            self.histories.move_to_end(horse_id)
+            self.hits += 1
+            return history
+
+        self.misses += 1
+        history = db_crud.get_horse_history(horse_id)
+        self.histories[horse_id] = history
+        if len(self.histories) > self.maxsize:
+            self.histories.popitem(last=False)
+        return history
 
 
 class SkylarkFeature():
-    def __init__(self, args, logger):
-        self.args         = args
-        self.logger       = logger
+    def __init__(self, args, logger, history_cache: HorseHistoryCache | None = None):
+        self.args          = args
+        self.logger        = logger
+        self.history_cache = history_cache if history_cache is not None else HorseHistoryCache()
 
     def __enter__(self):
         return self
 
+    @staticmethod
+    def average(values: list) -> float|None:
+        values = [value for value in values if value is not None]
+        if len(values) == 0:
+            return None
+        return sum(values) / len(values)
+
     def initialize(self, db_crud: SkylarkCrud, race_id, horse_number):
         assert race_id > 0 and horse_number > 0
 
@@ -28,18 +65,14 @@ class SkylarkFeature():
         if race_result is None:
             return
 
-        order_of_finish = db_crud.get_order_of_finish(race_id, horse_number)
-
-        horse_id = db_crud.get_horse_id(race_id, horse_number)
+        horse_id = race_result.horse_id
 
         if horse_id is None:
             return
 
-        jockey_id = db_crud.get_jockey_id(race_id, horse_number)
+        jockey_id = race_result.jockey_id
 
-        trainer_id = db_crud.get_trainer_id(race_id, horse_number)
-
-        #owner_id = db_crud.get_owner_id(race_id, horse_number)
+        trainer_id = race_result.trainer_id
 
         # 安全に取得
         date = getattr(race_info, "date", None)
@@ -47,22 +80,26 @@ class SkylarkFeature():
         if not isinstance(distance, int):
             distance = None
 
-        speed_figure_last = db_crud.get_speed_figure_last(horse_id, date)
+        # 開催日より前の成績(新しい順)
+        history = [row for row in self.history_cache.get(db_crud, horse_id) if row.race_date is not None and row.race_date < date]
+        speed_figures = [row for row in history if row.speed_figure is not None]
+
+        speed_figure_last = speed_figures[0].speed_figure if speed_figures else None
 
-        speed_figure_avg = db_crud.get_speed_figure_avg(horse_id, date, 5)
+        speed_figure_avg = self.average([row.speed_figure for row in speed_figures[:5]])
 
-        winner_avg = db_crud.get_winner_avg(horse_id, date, 5)
+        winner_avg = self.average([row.order_of_finish for row in speed_figures if 1 <= (row.order_of_finish or 0) <= 3][:5])
 
         disavesr = None
         if distance is not None:
-            disavesr = db_crud.get_disavesr(horse_id, date, distance, 100)
+            disavesr = self.average([row.speed_figure for row in speed_figures if row.distance == distance][:100])
 
-        distance_avg = db_crud.get_distance_avg(horse_id, date, 100)
+        distance_avg = self.average([row.distance for row in history[:100]])
 
         #if distance_avg is not None:
         #    print((race_info.distance - distance_avg) / distance_avg)
 
-        earnings_per_share = db_crud.get_earnings_per_share(horse_id, date, 100)
+        earnings_per_share = self.average([row.earning_money for row in history[:100]])
 
         calculation_result = {
             "sppeed_figure_last": speed_figure_last,
@@ -82,3 +119,129 @@ class SkylarkFeature():
                 "calculation_result_json": json.dumps(calculation_result, ensure_ascii=False, sort_keys=True),
             }
         ])
+
+
+class FormAccumulator():
+    """
+    キーごとに直近window件の成績(1着、3着以内)を保持する累積器
+    """
+    def __init__(self, window: int):
+        assert window > 0
+
+        self.window = window
+        self.results: dict[tuple, deque] = {}
+        self.wins: dict[tuple, int] = {}
+        self.places: dict[tuple, int] = {}
+
+    def add(self, key: tuple, order_of_finish: int) -> None:
+        results = self.results.get(key)
+        if results is None:
+            results = self.results[key] = deque()
+            self.wins[key] = 0
+            self.places[key] = 0
+
+        # 窓から外れる成績を差し引く
+        if len(results) == self.window:
+            win, place = results.popleft()
+            self.wins[key] -= win
+            self.places[key] -= place
+
+        win = 1 if order_of_finish == 1 else 0
+        place = 1 if 1 <= order_of_finish <= 3 else 0
+        results.append((win, place))
+        self.wins[key] += win
+        self.places[key] += place
+
+    def get(self, key: tuple) -> tuple[int, float|None, float|None]:
+        """
+        (騎乗数, 勝率, 複勝率) を返します。
+        """
+        results = self.results.get(key)
+        if not results:
+            return 0, None, None
+
+        count = len(results)
+        return count, self.wins[key] / count, self.places[key] / count
+
+
+class SkylarkFormFeature():
+    """
+    騎手、調教師、馬主の直近成績を全レース結果の1回の走査で計算する
+    同じ開催日のレースには前日までの成績を使う
+    """
+    entity_list = ("jockey", "trainer", "owner")
+
+    def __init__(self, args, logger, batch_size: int = 5000):
+        self.args         = args
+        self.logger       = logger
+        self.window: int  = args.form_window
+        self.batch_size   = batch_size
+
+    def __enter__(self):
+        return self
+
+    def make_keys(self, row) -> dict[str, tuple]:
+        distance_band = SkylarkUtil.convertToDistanceBand(row.distance) if row.distance else None
+
+        keys = {}
+        for entity in self.entity_list:
+            entity_id = getattr(row, f"{entity}_id")
+            keys[entity] = (entity, entity_id)
+            keys[f"{entity}_surface"] = (entity, entity_id, "surface", row.track_surface)
+            keys[f"{entity}_distance"] = (entity, entity_id, "distance", distance_band)
+        return keys
+
+    def update(self, accumulator: FormAccumulator, rows: list) -> None:
+        for row in rows:
+            if row.order_of_finish is None:
+                # 取消、除外など
+                continue
+            for key in self.make_keys(row).values():
+                accumulator.add(key, row.order_of_finish)
+
+    def make_dataset(self, accumulator: FormAccumulator, row) -> dict:
+        calculation_result = {}
+        for name, key in self.make_keys(row).items():
+            rides, win_rate, place_rate = accumulator.get(key)
+            if name in self.entity_list:
+                calculation_result[f"{name}_rides"] = rides
+            calculation_result[f"{name}_win_rate"] = win_rate
+            calculation_result[f"{name}_place_rate"] = place_rate
+
+        return {
+            "horse_id": row.horse_id,
+            "race_id": row.race_id,
+            "jockey_id": row.jockey_id,
+            "trainer_id": row.trainer_id,
+            "owner_id": row.owner_id,
+            "calculation_result_json": json.dumps(calculation_result, ensure_ascii=False, sort_keys=True),
+        }
+
+    def calculate(self, db_crud: SkylarkCrud) -> int:
+        accumulator = FormAccumulator(self.window)
+        dataset_list: list = []
+        pending_rows: list = []
+        current_date = None
+        count = 0
+
+        for row in db_crud.iter_race_results_by_date():
+            if row.date != current_date:
+                # 開催日が変わったら前日までの成績を累積器に反映
+                self.update(accumulator, pending_rows)
+                pending_rows = []
+                current_date = row.date
+
+            dataset_list.append(self.make_dataset(accumulator, row))
+            pending_rows.append(row)
+
+            if len(dataset_list) >= self.batch_size:
+                db_crud.upsert_form_features(dataset_list)
+                count += len(dataset_list)
+                dataset_list = []
+
+        if len(dataset_list) > 0:
+            db_crud.upsert_form_features(dataset_list)
+            count += len(dataset_list)
+
+        self.logger.info("form feature: %d rows", count)
+        return count
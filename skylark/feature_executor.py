@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from argparse import Namespace
+import concurrent.futures
+import logging
+from logging import Logger
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
+
+from tqdm import tqdm
+
+from skylark.crud import SkylarkCrud
+from skylark.feature import HorseHistoryCache, SkylarkFeature
+
+# ワーカープロセスごとの状態(initialize_worker で作成)
+worker_feature: SkylarkFeature | None = None
+worker_crud: SkylarkCrud | None = None
+
+def initialize_worker(log_queue, logger_name: str, log_level: int, db_url: str, args: Namespace) -> None:
+    """
+    ワーカープロセスの起動時に1回だけ呼ばれます。ログは親プロセスのキューに送ります。
+    """
+    global worker_feature, worker_crud
+
+    logger = logging.getLogger(logger_name)
+    # fork で引き継いだハンドラーに出力すると親と二重になるため、キューのみにする
+    logger.handlers.clear()
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(log_level)
+    logger.propagate = False
+
+    worker_crud = SkylarkCrud(db_url, logger=logger)
+    worker_feature = SkylarkFeature(
+        args=args,
+        logger=logger,
+        history_cache=HorseHistoryCache(maxsize=args.history_cache_size)
+    )
+
+def process_feature(race_keys: list) -> tuple[int, list]:
+    """
+    1頭分のレースの特徴量を計算し、(処理件数, 失敗したレースとエラー内容)を返します。
+    """
+    errors: list = []
+    for race_id, horse_number in race_keys:
+        try:
+            worker_feature.initialize(worker_crud, race_id=race_id, horse_number=horse_number)
+        except Exception as ex:
+            worker_feature.logger.error("feature failed: %s-%s", race_id, horse_number, exc_info=True)
+            errors.append((race_id, horse_number, repr(ex)))
+    return len(race_keys), errors
+
+class SkylarkFeatureExecutor():
+    """
+    特徴量の計算をプロセスプールで実行する
+    引数とDB接続はワーカーの起動時に1回だけ渡し、同じ馬のレースをまとめたタスクを chunksize 件ずつ送る
+    """
+
+    def __init__(self, args: Namespace, logger: Logger, db_url: str, max_workers: int | None = None,
+                 chunksize: int = 64, max_errors: int = 100):
+        self.args = args
+        self.logger = logger
+        self.db_url = db_url
+        self.max_workers = max_workers or min(8, multiprocessing.cpu_count())
+        self.chunksize = chunksize
+        self.max_errors = max_errors
+
+    def run(self, horse_race_keys: list[list]) -> list:
+        """
+        馬ごとのレースのリストを処理し、失敗したレースの (race_id, horse_number, エラー内容) を返します。
+        """
+        context = multiprocessing.get_context()
+        log_queue = context.Queue()
+        listener = QueueListener(log_queue, *self.logger.handlers, respect_handler_level=True)
+        listener.start()
+
+        rows = 0
+        errors: list = []
+        try:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=context,
+                initializer=initialize_worker,
+                initargs=(log_queue, self.logger.name, self.logger.getEffectiveLevel(), self.db_url, self.args)
+            ) as executor:
+                results = executor.map(process_feature, horse_race_keys, chunksize=self.chunksize)
+                for count, task_errors in tqdm(results, total=len(horse_race_keys)):
+                    rows += count
+                    errors.extend(task_errors)
+        finally:
+            listener.stop()
+
+        if len(errors) > 0:
+            for race_id, horse_number, error in errors[:self.max_errors]:
+                self.logger.warning("failed: %s-%s, %s", race_id, horse_number, error)
+            self.logger.warning("feature: %d/%d rows failed", len(errors), rows)
+        else:
+            self.logger.info("feature: %d rows", rows)
+
+        return errors
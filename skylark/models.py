@@ -6,7 +6,7 @@
 #
 
 from sqlalchemy import (
-    JSON, Column, Integer, BigInteger, String, Float, Text, Time, Date,
+    JSON, Column, Integer, BigInteger, SmallInteger, String, Float, Text, Time, Date, DateTime,
     ForeignKey, Index
 )
 from sqlalchemy.ext.declarative import declarative_base
@@ -35,6 +35,7 @@ class RaceInfo(Base):
     __table_args__ = (
         Index('idx_race_name', 'race_name'),
         Index('idx_date_post_time', 'date', 'post_time'),
+        Index('idx_date_id', 'date', 'id', 'distance'),
     )
 
 class Horse(Base):
@@ -82,9 +83,24 @@ class RaceResult(Base):
     trainer_id = Column(BigInteger, ForeignKey('trainer_tbl.trainer_id'), nullable=False)
     owner_id = Column(String(32), ForeignKey('owner_tbl.owner_id'), nullable=False)
     earning_money = Column(Float)
+    # race_info_tbl.date の複製(馬ごとの履歴をJOINなしで日付順に引くため)
+    race_date = Column(Date)
+    # 取り込み時に数値に変換した値
+    finishing_time_sec = Column(Float)
+    corner_1 = Column(SmallInteger)
+    corner_2 = Column(SmallInteger)
+    corner_3 = Column(SmallInteger)
+    corner_4 = Column(SmallInteger)
+    margin_length = Column(Float)
+    # speed_figure がない場合に使う自前のスピード指数(SkylarkSpeedFigure で計算)
+    # 取り込み時のUPSERTでは上書きしない
+    computed_speed_figure = Column(Float, info={"derived": True})
 
     # インデックス
     __table_args__ = (
+        Index('idx_horse_race', 'horse_id', 'race_id'),
+        # speed_figure_column() の COALESCE もインデックスのみで読めるように両方の指数を含める
+        Index('idx_horse_date', 'horse_id', 'race_date', 'speed_figure', 'computed_speed_figure'),
         Index('idx_race_horse', 'race_id', 'horse_id'),
         Index('idx_race_jockey', 'race_id', 'jockey_id'),
         Index('idx_race_trainer', 'race_id', 'trainer_id'),
@@ -98,6 +114,75 @@ class Payoff(Base):
     horse_numbers = Column(String(16), primary_key=True)
     payoff = Column(Integer, nullable=False)
     popularity = Column(Integer, nullable=False)
+    # horse_numbers を SkylarkUtil.encodeCombination で整数にしたもの
+    combination_key = Column(Integer)
+
+    # インデックス
+    __table_args__ = (
+        Index('idx_race_combination', 'race_id', 'ticket_type', 'combination_key'),
+    )
+
+class ParTime(Base):
+    __tablename__ = 'par_time_tbl'
+    # race_id の5,6桁目の競馬場コード(01:札幌 ... 10:小倉)
+    place_code = Column(Integer, primary_key=True, autoincrement=False)
+    track_surface = Column(String(8), primary_key=True)
+    distance = Column(Integer, primary_key=True, autoincrement=False)
+    track_condition = Column(String(8), primary_key=True)
+    # 走破タイムの合計と件数(SkylarkSpeedFigure.aggregate で毎回全件から集計し直す)
+    time_sum = Column(Float, nullable=False)
+    time_count = Column(Integer, nullable=False)
+    # 件数が少ない場合は条件を緩めた集計から求めた基準タイム
+    par_time = Column(Float)
+
+class RaceSummary(Base):
+    __tablename__ = 'race_summary_tbl'
+    race_id = Column(BigInteger, ForeignKey('race_info_tbl.id'), primary_key=True)
+    field_size = Column(Integer, nullable=False)
+    starters = Column(Integer, nullable=False)
+    favourite_horse_number = Column(Integer)
+    favourite_odds = Column(Float)
+    # 単勝オッズの逆数の合計(控除率を含む)
+    overround = Column(Float)
+    # {馬番: 単勝オッズから求めた勝率(合計1に正規化)}
+    implied_probability_json = Column(JSON(none_as_null=True), nullable=True)
+    winner_horse_number = Column(Integer)
+    second_horse_number = Column(Integer)
+    third_horse_number = Column(Integer)
+    winning_time = Column(Time)
+    # {馬番: 1コーナーの通過順位}
+    first_corner_json = Column(JSON(none_as_null=True), nullable=True)
+    first_corner_leader = Column(Integer)
+    last_3f_leader = Column(Integer)
+    last_3f_best = Column(Float)
+
+class RaceEntry(Base):
+    __tablename__ = 'race_entry_tbl'
+    race_id = Column(BigInteger, ForeignKey('race_info_tbl.id'), primary_key=True)
+    horse_number = Column(Integer, primary_key=True)
+    bracket_number = Column(Integer)
+    horse_id = Column(BigInteger, ForeignKey('horse_tbl.horse_id'), nullable=False)
+    basis_weight = Column(Float)
+    jockey_id = Column(BigInteger, ForeignKey('jockey_tbl.jockey_id'))
+    trainer_id = Column(BigInteger, ForeignKey('trainer_tbl.trainer_id'))
+    odds = Column(Float)
+    popularity = Column(Integer)
+    horse_weight = Column(Integer)
+    horse_weight_diff = Column(Integer)
+
+    # インデックス
+    __table_args__ = (
+        Index('idx_entry_horse', 'horse_id', 'race_id'),
+    )
+
+class OddsSnapshot(Base):
+    __tablename__ = 'odds_snapshot_tbl'
+    # 出走前のレースも対象のため race_info_tbl への外部キーは張らない
+    race_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    horse_number = Column(Integer, primary_key=True)
+    fetched_at = Column(DateTime, primary_key=True)
+    odds = Column(Float)
+    popularity = Column(Integer)
 
 class Feature(Base):
     __tablename__ = 'feature_tbl'
@@ -106,3 +191,41 @@ class Feature(Base):
     jockey_id = Column(BigInteger, ForeignKey('jockey_tbl.jockey_id'), nullable=False)
     trainer_id = Column(BigInteger, ForeignKey('trainer_tbl.trainer_id'), nullable=False)
     calculation_result_json = Column(JSON, nullable=True)
+
+class FormFeature(Base):
+    __tablename__ = 'form_feature_tbl'
+    horse_id = Column(BigInteger, ForeignKey('horse_tbl.horse_id'), primary_key=True)
+    race_id = Column(BigInteger, ForeignKey('race_info_tbl.id'), primary_key=True)
+    jockey_id = Column(BigInteger, ForeignKey('jockey_tbl.jockey_id'), nullable=False)
+    trainer_id = Column(BigInteger, ForeignKey('trainer_tbl.trainer_id'), nullable=False)
+    owner_id = Column(String(32), ForeignKey('owner_tbl.owner_id'), nullable=False)
+    calculation_result_json = Column(JSON, nullable=True)
+
+class CrawlState(Base):
+    __tablename__ = 'crawl_state_tbl'
+    # 状態: pending(未取得), claimed(取得中), parsed(TSVに書き出し済み、ロード待ち), done(完了), failed(失敗), skipped(対象外)
+    race_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    status = Column(String(16), nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text)
+    claim_token = Column(String(64))
+    claimed_at = Column(DateTime)
+    fetched_at = Column(DateTime)
+    parsed_at = Column(DateTime)
+
+    # インデックス
+    __table_args__ = (
+        Index('idx_status_race', 'status', 'race_id'),
+        Index('idx_claim_token', 'claim_token'),
+    )
+
+class IgnoreRace(Base):
+    __tablename__ = 'ignore_race_tbl'
+    race_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    reason = Column(String(256))
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migration_tbl'
+    # 適用済みのデータ移行(SkylarkCrud.migrate で1回だけ実行する)
+    name = Column(String(64), primary_key=True)
+    applied_at = Column(DateTime, nullable=False)
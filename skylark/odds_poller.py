@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import asyncio
+import datetime
+import os
+import threading
+from logging import Logger
+
+import httpx
+
+from skylark.crud import SkylarkCrud
+
+
+class SkylarkOddsPoller:
+    """
+    当日の全レースの単勝オッズを発走時刻まで監視し、変化したオッズのみを保存する
+    オッズは出馬表ページが内部で利用しているJSON APIから取得するため、ブラウザは起動しない
+    """
+
+    url_odds_api: str = "https://race.netkeiba.com/api/api_get_jra_odds.html"
+
+    # 発走までの残り秒数 -> 取得間隔(秒)
+    poll_interval_list: tuple = (
+        (60 * 60, 300),
+        (30 * 60, 120),
+        (10 * 60, 60),
+        (2 * 60, 20),
+        (0, 10),
+    )
+
+    # 発走後も締切確定まで取得を続ける秒数
+    post_time_grace: int = 3 * 60
+
+    def __init__(self, db_url: str, logger: Logger, max_concurrent_requests: int = 4):
+        self.db_crud = SkylarkCrud(db_url, logger=logger)
+        self.logger = logger
+        self.max_concurrent_requests = max_concurrent_requests
+
+        # race_id -> 発走日時
+        self.races: dict[int, datetime.datetime] = {}
+        # race_id -> {馬番: (オッズ, 人気)}
+        self.last_odds: dict[int, dict[int, tuple]] = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread: threading.Thread | None = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def add_race(self, race_id: int, post_datetime: datetime.datetime) -> None:
+        with self.lock:
+            self.races[race_id] = post_datetime
+
+    def get_odds(self, race_id: int) -> dict[int, tuple]:
+        """
+        最後に取得したオッズを返します。
+        """
+        with self.lock:
+            return dict(self.last_odds.get(race_id, {}))
+
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self) -> None:
+        if self.is_running():
+            return
+
+        self.db_crud.create_tables()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.run()), daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    @classmethod
+    def poll_interval(cls, seconds_to_post: float) -> int:
+        """
+        発走までの残り時間から取得間隔を決定します。
+        """
+        for threshold, interval in cls.poll_interval_list:
+            if seconds_to_post > threshold:
+                return interval
+        return cls.poll_interval_list[-1][1]
+
+    async def fetch_odds(self, client: httpx.AsyncClient, race_id: int) -> dict[int, tuple] | None:
+        response = await client.get(
+            self.url_odds_api,
+            params={"race_id": race_id, "type": 1, "action": "update"},
+            timeout=float(os.environ.get("HTTP_TIMEOUT", 5))
+        )
+        response.raise_for_status()
+
+        data = response.json().get("data") or {}
+        odds_list = (data.get("odds") or {}).get("1") or {}
+
+        odds_dict: dict[int, tuple] = {}
+        for horse_number, values in odds_list.items():
+            try:
+                odds = float(values[0])
+            except (ValueError, IndexError, TypeError):
+                odds = None
+
+            try:
+                popularity = int(values[2])
+            except (ValueError, IndexError, TypeError):
+                popularity = None
+
+            odds_dict[int(horse_number)] = (odds, popularity)
+
+        return odds_dict
+
+    def fetch_race_odds(self, race_id: int) -> dict[int, tuple] | None:
+        """
+        監視とは別に1レース分の単勝オッズを取得します。(画面表示用)
+        """
+        async def fetch() -> dict[int, tuple] | None:
+            async with httpx.AsyncClient(http2=True) as client:
+                return await self.fetch_odds(client, race_id)
+
+        return asyncio.run(fetch())
+
+    async def poll_race(self, client: httpx.AsyncClient, race_id: int, fetched_at: datetime.datetime) -> list[dict]:
+        """
+        オッズを取得し、前回から変化した馬番の行のみを返します。
+        """
+        try:
+            odds_dict = await self.fetch_odds(client, race_id)
+        except Exception as ex:
+            self.logger.warning("race_id: %d, %s", race_id, ex)
+            return []
+
+        if not odds_dict:
+            return []
+
+        with self.lock:
+            last_odds = self.last_odds.setdefault(race_id, {})
+            dataset_list = []
+            for horse_number, (odds, popularity) in odds_dict.items():
+                if last_odds.get(horse_number) == (odds, popularity):
+                    continue
+
+                last_odds[horse_number] = (odds, popularity)
+                dataset_list.append({
+                    "race_id": race_id,
+                    "horse_number": horse_number,
+                    "fetched_at": fetched_at,
+                    "odds": odds,
+                    "popularity": popularity
+                })
+
+        return dataset_list
+
+    async def run(self) -> None:
+        semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        next_poll: dict[int, datetime.datetime] = {}
+
+        async def limited_poll(race_id: int, fetched_at: datetime.datetime) -> list[dict]:
+            async with semaphore:
+                return await self.poll_race(client, race_id, fetched_at)
+
+        async with httpx.AsyncClient(http2=True) as client:
+            while self.stop_event.is_set() == False:
+                now = datetime.datetime.now().replace(microsecond=0)
+                grace = datetime.timedelta(seconds=self.post_time_grace)
+
+                with self.lock:
+                    # 締切後のレースは監視対象から外す
+                    for race_id in [race_id for race_id, post_datetime in self.races.items() if post_datetime + grace < now]:
+                        del self.races[race_id]
+                        next_poll.pop(race_id, None)
+                    races = dict(self.races)
+
+                if len(races) == 0:
+                    break
+
+                due_race_ids = [race_id for race_id in races if next_poll.get(race_id, now) <= now]
+                if len(due_race_ids) > 0:
+                    results = await asyncio.gather(*[limited_poll(race_id, now) for race_id in due_race_ids])
+                    dataset_list = [dataset for result in results for dataset in result]
+
+                    # 1巡分をまとめて保存
+                    if len(dataset_list) > 0:
+                        try:
+                            await asyncio.to_thread(self.db_crud.insert_odds_snapshots, dataset_list)
+                        except Exception as ex:
+                            self.logger.error(ex)
+
+                    self.logger.debug("odds polled: %d races, %d changes", len(due_race_ids), len(dataset_list))
+
+                    for race_id in due_race_ids:
+                        seconds_to_post = (races[race_id] - now).total_seconds()
+                        next_poll[race_id] = now + datetime.timedelta(seconds=self.poll_interval(seconds_to_post))
+
+                wait = min((next_poll[race_id] - datetime.datetime.now()).total_seconds() for race_id in races if race_id in next_poll)
+                await asyncio.to_thread(self.stop_event.wait, max(1.0, wait))
+
+        self.logger.info("odds poller stopped")
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from collections import OrderedDict
+import datetime
+from logging import Logger
+import threading
+import time
+
+from skylark.crud import SkylarkCrud
+
+class SkylarkPastPerformance:
+    """
+    出走馬の近走成績(馬柱)を取得する
+    1レース分の馬をまとめて1回のクエリで取得し、(馬ID, 基準日)をキーとするLRUに保持する
+    結果が取り込まれる(データのバージョンが変わる)とキャッシュを破棄する
+    """
+
+    def __init__(self, db_crud: SkylarkCrud, logger: Logger, limit: int = 5, maxsize: int = 4096,
+                 version_interval: float = 30.0):
+        self.db_crud = db_crud
+        self.logger = logger
+        self.limit = limit
+        self.maxsize = maxsize
+        # データのバージョンを確認する間隔(秒)
+        self.version_interval = version_interval
+
+        # (horse_id, date) -> 近走成績のリスト
+        self.entries: OrderedDict[tuple[int, datetime.date], list[dict]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked_at: float | None = None
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def check_version(self) -> None:
+        """
+        一定間隔でデータのバージョンを確認し、変わっていればキャッシュを破棄します。
+        """
+        now = time.monotonic()
+        if self.checked_at is not None and now - self.checked_at < self.version_interval:
+            return
+        self.checked_at = now
+
+        version = self.db_crud.get_data_version()
+        if version != self.version:
+            if self.version is not None:
+                self.logger.info("data version changed: %s -> %s", self.version, version)
+            self.version = version
+            self.clear()
+
+    def get_starts(self, horse_ids: list[int], date: datetime.date | None = None) -> dict[int, list[dict]]:
+        """
+        各馬の date より前の近走成績を新しい順に返します。キャッシュにない馬のみ1回のクエリで取得します。
+        """
+        if date is None:
+            date = datetime.date.today()
+        self.check_version()
+
+        result: dict[int, list[dict]] = {}
+        missing: list[int] = []
+        with self.lock:
+            for horse_id in horse_ids:
+                key = (horse_id, date)
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    result[horse_id] = self.entries[key]
+                else:
+                    missing.append(horse_id)
+
+        if len(missing) == 0:
+            return result
+
+        fetched: dict[int, list[dict]] = {horse_id: [] for horse_id in missing}
+        for row in self.db_crud.get_past_performances(missing, date, self.limit):
+            fetched[row.horse_id].append(row._asdict())
+
+        with self.lock:
+            for horse_id, starts in fetched.items():
+                self.entries[(horse_id, date)] = starts
+                self.entries.move_to_end((horse_id, date))
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        result.update(fetched)
+        return result
+
+    def get_card(self, race_id: int) -> list[dict]:
+        """
+        DBに保存済みのレースについて、馬番順に出走馬と近走成績を返します。
+        """
+        race_date, runners = self.db_crud.get_race_runners(race_id)
+        starts = self.get_starts([row.horse_id for row in runners], race_date)
+
+        return [
+            {
+                "horse_number": row.horse_number,
+                "horse_id": row.horse_id,
+                "horse_name": row.horse_name,
+                "starts": starts.get(row.horse_id, [])
+            }
+            for row in runners
+        ]
+
+    @staticmethod
+    def format_start(start: dict) -> str:
+        """
+        近走成績1走分を馬柱の1マス用の文字列にします。
+        """
+        order_of_finish = "中止" if start["order_of_finish"] is None else f"{start['order_of_finish']}着"
+        popularity = "" if start["popularity"] is None else f"({start['popularity']}人)"
+        course = f"{start['place_detail'] or ''} {start['track_surface'] or ''}{start['distance']} {start['track_condition'] or ''}"
+        speed_figure = "" if start["speed_figure"] is None else f" 指数{start['speed_figure']:.0f}"
+        return f"{start['race_date']} {course} {start['race_name']} {order_of_finish}{popularity} {start['jockey_name'] or ''}{speed_figure}"
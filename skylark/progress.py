@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from collections import deque
+import datetime
+from logging import Logger
+import time
+
+class SkylarkProgress:
+    """
+    処理件数、スループット、残り時間、失敗数を一定間隔でログに出力する
+    """
+
+    def __init__(self, logger: Logger, total: int | None = None, interval: float = 10.0, max_errors: int = 100):
+        self.logger = logger
+        self.total = total
+        self.interval = interval
+
+        self.counts: dict[str, int] = {"done": 0, "failed": 0, "skipped": 0}
+        # 直近の失敗(キー, エラー内容)
+        self.errors: deque = deque(maxlen=max_errors)
+
+        self.started_at = time.monotonic()
+        self.reported_at = self.started_at
+
+    def finished(self) -> int:
+        return sum(self.counts.values())
+
+    def add(self, status: str, key=None, error: str | None = None) -> None:
+        self.counts[status] = self.counts.get(status, 0) + 1
+        if status == "failed":
+            self.errors.append((key, error))
+
+        if time.monotonic() - self.reported_at >= self.interval:
+            self.report()
+
+    def report(self) -> None:
+        now = time.monotonic()
+        self.reported_at = now
+
+        finished = self.finished()
+        elapsed = max(now - self.started_at, 1e-6)
+        throughput = finished / elapsed
+
+        eta = "-"
+        if self.total is not None and throughput > 0:
+            eta = str(datetime.timedelta(seconds=int(max(self.total - finished, 0) / throughput)))
+
+        self.logger.info(
+            "progress: %d/%s, %.2f/s, eta %s, done %d, failed %d, skipped %d",
+            finished,
+            "-" if self.total is None else self.total,
+            throughput,
+            eta,
+            self.counts.get("done", 0),
+            self.counts.get("failed", 0),
+            self.counts.get("skipped", 0)
+        )
+
+    def summary(self) -> None:
+        self.report()
+        for key, error in self.errors:
+            self.logger.warning("failed: %s, %s", key, error)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from skylark.util import SkylarkUtil
+
+class SkylarkRaceSummary:
+    """
+    1レース分の結果行からレース単位の集計(頭数、オッズ、着順、通過順位、上り)を作成する
+    """
+
+    @staticmethod
+    def make(race_id: int, dataset_result: list) -> dict:
+        """
+        race_result_tbl の列名をキーとする行のリストから race_summary_tbl の1行を作成します。
+        """
+        starters = [row for row in dataset_result if row["order_of_finish"] is not None]
+
+        # 単勝オッズ
+        odds_list = {row["horse_number"]: row["odds"] for row in dataset_result if row["odds"]}
+        favourite_horse_number = None
+        favourite_odds = None
+        overround = None
+        implied_probability = None
+        if len(odds_list) > 0:
+            favourite_horse_number = min(odds_list, key=lambda horse_number: (odds_list[horse_number], horse_number))
+            favourite_odds = odds_list[favourite_horse_number]
+            overround = sum(1.0 / odds for odds in odds_list.values())
+            implied_probability = {
+                str(horse_number): round(1.0 / odds / overround, 4)
+                for horse_number, odds in sorted(odds_list.items())
+            }
+
+        # 着順(同着は馬番順)
+        finish_list = sorted(starters, key=lambda row: (row["order_of_finish"], row["horse_number"]))
+        placed = [row["horse_number"] for row in finish_list[:3]] + [None] * 3
+
+        # 1コーナーの通過順位
+        first_corner = {}
+        for row in dataset_result:
+            passing_rank = SkylarkUtil.parsePassingRank(row["passing_rank"])
+            if len(passing_rank) > 0:
+                first_corner[str(row["horse_number"])] = passing_rank[0]
+        first_corner_leader = None
+        if len(first_corner) > 0:
+            first_corner_leader = int(min(first_corner, key=lambda horse_number: (first_corner[horse_number], int(horse_number))))
+
+        # 上り3F最速
+        last_phase_list = [row for row in starters if row["last_phase"] is not None]
+        last_3f_leader = None
+        last_3f_best = None
+        if len(last_phase_list) > 0:
+            row = min(last_phase_list, key=lambda row: (row["last_phase"], row["horse_number"]))
+            last_3f_leader = row["horse_number"]
+            last_3f_best = row["last_phase"]
+
+        return {
+            "race_id": race_id,
+            "field_size": len(dataset_result),
+            "starters": len(starters),
+            "favourite_horse_number": favourite_horse_number,
+            "favourite_odds": favourite_odds,
+            "overround": overround,
+            "implied_probability_json": implied_probability,
+            "winner_horse_number": placed[0],
+            "second_horse_number": placed[1],
+            "third_horse_number": placed[2],
+            "winning_time": finish_list[0]["finishing_time"] if len(finish_list) > 0 else None,
+            "first_corner_json": first_corner if len(first_corner) > 0 else None,
+            "first_corner_leader": first_corner_leader,
+            "last_3f_leader": last_3f_leader,
+            "last_3f_best": last_3f_best,
+        }
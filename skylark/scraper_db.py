@@ -7,19 +7,36 @@
 
 from argparse import Namespace
 import asyncio
+import datetime
 from logging import Logger
 import os
 import re
+import shutil
+import signal
 import time
+import zlib
 import zstandard as zstd
 
 import httpx
 from pyquery import PyQuery as pq
 
+from skylark.backfill import SkylarkBackfill
 from skylark.crud import SkylarkCrud
+from skylark.crud_async import SkylarkCrudAsync
+from skylark.entity_cache import SkylarkEntityCache
+from skylark.progress import SkylarkProgress
+from skylark.race_summary import SkylarkRaceSummary
 from skylark.util import SkylarkUtil
 
 class SkylarkScraperDb:
+    # 結果ページが壊れているため取り込まないレースID
+    default_ignore_race_id: tuple = (
+        200808020398,
+        200808020399,
+        202204010808,
+        202209040704
+    )
+
     def __init__(self, db_url: str, args: Namespace, logger: Logger):
         self.db_url = db_url
         self.args = args
@@ -31,13 +48,35 @@ class SkylarkScraperDb:
         self.cookies = httpx.Cookies()
         self.race_url_list = []
 
-        # 無視するレースID
-        self.ignore_race_id: list[int] = [
-            200808020398,
-            200808020399,
-            202204010808,
-            202209040704
-        ]
+        # ダウンロード中のみ使用するDB接続(download_all で作成し、終了時に破棄する)
+        self.db_crud: SkylarkCrudAsync | None = None
+
+        # 登録済みの馬、騎手、調教師、馬主
+        self.entity_cache = SkylarkEntityCache(logger=logger)
+
+        # シャード(K/N)ごとにキャッシュの書き出し先を分ける
+        self.shard: tuple[int, int] | None = getattr(args, "shard", None)
+        self.cache_dir: str = args.temp
+        if self.shard is not None:
+            self.cache_dir = os.path.join(args.temp, "shard-%d-of-%d" % self.shard)
+            if os.path.isdir(self.cache_dir) == False:
+                os.makedirs(self.cache_dir, exist_ok=True)
+
+        # 一括取り込みモードではDBに書かずにTSVに書き出す
+        self.backfill: SkylarkBackfill | None = None
+        if getattr(args, "backfill", False) == True:
+            self.backfill = SkylarkBackfill(
+                db_url,
+                args=args,
+                logger=logger,
+                directory=os.path.join(self.cache_dir, "backfill")
+            )
+
+        # クロール状態テーブルからレースを取得するか
+        self.crawl_state: bool = getattr(args, "crawl_state", False) == True
+
+        # 無視するレースID(load_ignore_race_id でファイルとテーブルの分を追加する)
+        self.ignore_race_id: set[int] = set(self.default_ignore_race_id)
 
     def __enter__(self):
         return self
@@ -61,6 +100,113 @@ class SkylarkScraperDb:
         with open(filepath, "w") as file:
             [file.write(path+"\n") for path in self.race_url_list]
 
+    # レース結果URLリストをクロール状態テーブルに登録
+    def enqueue_race_url_list(self):
+        pattern = re.compile(r"^/race/([0-9]+)/$")
+        race_ids = []
+        for url_path in self.race_url_list:
+            matchese: re.Match|None = pattern.match(url_path)
+            if matchese:
+                race_ids.append(int(matchese.group(1)))
+
+        with SkylarkCrud(self.db_url, logger=self.logger) as db_crud:
+            db_crud.enqueue_crawl_races(race_ids)
+            self.logger.info("crawl state: %s", db_crud.get_crawl_status_counts())
+
+    # 無視するレースIDをファイルとテーブルから読み込み
+    def load_ignore_race_id(self, db_crud: SkylarkCrud):
+        self.ignore_race_id |= db_crud.get_ignore_race_ids()
+
+        filepath = os.path.join(self.args.temp, getattr(self.args, "ignore_race_file", "ignore_race_list.txt"))
+        if os.path.isfile(filepath) == True:
+            with open(filepath, "r") as file:
+                for line in file:
+                    value = line.split("#", 1)[0].strip()
+                    if value != "":
+                        self.ignore_race_id.add(int(value))
+
+        self.logger.info("ignore race: %d", len(self.ignore_race_id))
+
+    # 無視するレースと取り込み済みのレースをレース結果URLリストから除く
+    def filter_race_url_list(self, db_crud: SkylarkCrud):
+        pattern = re.compile(r"^/race/([0-9]+)/$")
+        race_ids = {}
+        for url_path in self.race_url_list:
+            matchese: re.Match|None = pattern.match(url_path)
+            if matchese:
+                race_ids[url_path] = int(matchese.group(1))
+
+        ingested_race_id: set[int] = set()
+        if getattr(self.args, "reingest", False) == False:
+            ingested_race_id = db_crud.get_ingested_race_ids(list(race_ids.values()))
+
+        count = len(self.race_url_list)
+        self.race_url_list = [
+            url_path for url_path, race_id in race_ids.items()
+            if race_id not in self.ignore_race_id and race_id not in ingested_race_id
+        ]
+        self.logger.info("race list: %d of %d races scheduled, %d already ingested", len(self.race_url_list), count, len(ingested_race_id))
+
+    # レース結果URLリストを自分のシャード分に絞り込み
+    def shard_race_url_list(self):
+        if self.shard is None:
+            return
+
+        shard_index, shard_count = self.shard
+        pattern = re.compile(r"^/race/([0-9]+)/$")
+        race_url_list = sorted([url_path for url_path in self.race_url_list if pattern.match(url_path)])
+
+        if getattr(self.args, "shard_by", "hash") == "meeting":
+            # race_id の先頭10桁(年、場所、回、日)が同じ開催のレースは同じシャードにし、開催キーの順で連続した範囲に分割する
+            # (開催キーは年、場所の順に並ぶため、暦日の順ではない)
+            kaisai_keys = sorted({url_path[6:16] for url_path in race_url_list})
+            kaisai_shard = {
+                key: idx * shard_count // len(kaisai_keys) + 1
+                for idx, key in enumerate(kaisai_keys)
+            }
+            self.race_url_list = [
+                url_path for url_path in race_url_list
+                if kaisai_shard[url_path[6:16]] == shard_index
+            ]
+        else:
+            # プロセスやホストが違っても同じ結果になるハッシュで分割する
+            self.race_url_list = [
+                url_path for url_path in race_url_list
+                if zlib.crc32(url_path.encode("ascii")) % shard_count + 1 == shard_index
+            ]
+
+        self.logger.info("shard %d/%d: %d of %d races", shard_index, shard_count, len(self.race_url_list), len(race_url_list))
+
+    # シャードごとのキャッシュをtempディレクトリにまとめる
+    def merge_shards(self):
+        pattern = re.compile(r"^shard-[0-9]+-of-[0-9]+$")
+        backfill = SkylarkBackfill(self.db_url, args=self.args, logger=self.logger)
+
+        for name in sorted(os.listdir(self.args.temp)):
+            shard_dir = os.path.join(self.args.temp, name)
+            if pattern.match(name) is None or os.path.isdir(shard_dir) == False:
+                continue
+
+            count = 0
+            for filename in os.listdir(shard_dir):
+                if filename.startswith("race.") and filename.endswith(".html.zst"):
+                    os.replace(os.path.join(shard_dir, filename), os.path.join(self.args.temp, filename))
+                    count += 1
+
+            backfill_dir = os.path.join(shard_dir, "backfill")
+            if os.path.isdir(backfill_dir) == True:
+                backfill.merge(backfill_dir)
+                shutil.rmtree(backfill_dir)
+
+            self.logger.info("merge %s: %d files", name, count)
+            try:
+                os.rmdir(shard_dir)
+            except OSError as ex:
+                self.logger.warning(ex)
+
+        # シャードで書き出したTSVはまとめてロードする
+        self.load_backfill(backfill)
+
     def set_race_url_list(self, race_ids):
         [self.race_url_list.append(f"/race/{race_id}/") for race_id in race_ids]
         self.logger.debug(self.race_url_list)
@@ -162,407 +308,634 @@ class SkylarkScraperDb:
 
     # ダウンロード実行
     def download(self):
-        if len(self.race_url_list) == 0:
+        with SkylarkCrud(self.db_url, logger=self.logger) as db_crud:
+            self.load_ignore_race_id(db_crud)
+            self.filter_race_url_list(db_crud)
+
+        if self.crawl_state == True:
+            if len(self.race_url_list) > 0:
+                self.enqueue_race_url_list()
+        elif len(self.race_url_list) == 0:
             return
 
         with httpx.Client(http2=True) as client:
             result = self.login(client)
             self.logger.info("login: %s", result)
 
+        total = len(self.race_url_list)
+        with SkylarkCrud(self.db_url, logger=self.logger) as db_crud:
+            self.entity_cache.load(db_crud)
+
+            if self.crawl_state == True:
+                # 異常終了したプロセスが取得中のまま残したレースを戻す
+                count = db_crud.reset_crawl_claims(int(os.environ.get("CRAWL_CLAIM_TIMEOUT", 1800)))
+                self.logger.info("crawl state: reset %d stale claims", count)
+
+                done, pending = db_crud.reset_parsed_crawl_races(self.get_backfill_race_ids())
+                self.logger.info("crawl state: %d parsed races done, %d parsed races reset", done, pending)
+
+                counts = db_crud.get_crawl_status_counts()
+                total = counts.get("pending", 0) + counts.get("failed", 0)
+
         asyncio.run(
-            self.download_concurrently(
-                max_concurrent_requests=int(os.environ.get("MAX_CONCURRENT_REQUESTS", 4))
+            self.download_all(
+                max_concurrent_requests=int(os.environ.get("MAX_CONCURRENT_REQUESTS", 4)),
+                total=total
             )
         )
 
-    async def download_concurrently(self, max_concurrent_requests=4):
-        pattern = re.compile(r"^/race/([0-9]+)/$")
+        if self.backfill is not None and self.shard is not None:
+            # 他のシャードとステージングテーブルが衝突しないよう、ロードは --merge-shards で行う
+            self.backfill.close()
+        elif self.backfill is not None:
+            self.load_backfill(self.backfill)
+
+    def get_backfill_race_ids(self) -> set[int]:
+        """
+        tempディレクトリとシャードごとのディレクトリでロード待ちのレースIDを返します。
+        """
+        race_ids = SkylarkBackfill.read_race_ids(os.path.join(self.args.temp, "backfill"))
+        pattern = re.compile(r"^shard-[0-9]+-of-[0-9]+$")
+        for name in os.listdir(self.args.temp) if os.path.isdir(self.args.temp) else []:
+            if pattern.match(name) is not None:
+                race_ids |= SkylarkBackfill.read_race_ids(os.path.join(self.args.temp, name, "backfill"))
+        return race_ids
+
+    def load_backfill(self, backfill: SkylarkBackfill) -> None:
+        """
+        TSVをロードし、ロードしたレースのクロール状態を parsed から done にします。
+        """
+        backfill.close()
+        race_ids = SkylarkBackfill.read_race_ids(backfill.directory)
+
+        self.logger.info("Start backfill load")
+        backfill.load()
+        self.logger.info("End backfill load")
+
+        with SkylarkCrud(self.db_url, logger=self.logger) as db_crud:
+            count = db_crud.update_crawl_status(list(race_ids), "done")
+        if count > 0:
+            self.logger.info("crawl state: %d parsed races done", count)
+
+    async def download_all(self, max_concurrent_requests=4, total: int | None = None):
+        self.progress = SkylarkProgress(
+            self.logger,
+            total=total,
+            interval=float(os.environ.get("PROGRESS_INTERVAL", 10))
+        )
+        self.stop_event = asyncio.Event()
+        self.db_crud = SkylarkCrudAsync(
+            self.db_url,
+            logger=self.logger,
+            pool_size=max_concurrent_requests
+        )
 
-        async with httpx.AsyncClient(http2=True) as client:
-            semaphore = asyncio.Semaphore(max_concurrent_requests)  # 並行数を制御
-            tasks = []
+        # Ctrl+C では処理中のレースを終えてから停止する(2回目で強制終了)
+        loop = asyncio.get_running_loop()
+
+        def request_stop():
+            self.logger.warning("SIGINT received, finishing in-flight races (press again to abort)")
+            self.stop_event.set()
+            loop.remove_signal_handler(signal.SIGINT)
+
+        try:
+            loop.add_signal_handler(signal.SIGINT, request_stop)
+        except (NotImplementedError, RuntimeError, ValueError) as ex:
+            self.logger.debug(ex)
+
+        try:
+            if self.crawl_state == False:
+                await self.download_concurrently(max_concurrent_requests)
+                return
 
-            async def limited_download(idx: int, url: str, filepath: str):
-                async with semaphore:
-                    race_id = int(url.rsplit("/", 2)[1])
+            # クロール状態テーブルから少しずつ取得して処理する
+            while self.stop_event.is_set() == False:
+                race_ids = await self.db_crud.claim_crawl_races(
+                    limit=max_concurrent_requests * 16,
+                    max_attempts=self.args.max_attempts
+                )
+                if len(race_ids) == 0:
+                    break
+
+                self.race_url_list = [f"/race/{race_id}/" for race_id in race_ids]
+                await self.download_concurrently(max_concurrent_requests)
+        finally:
+            try:
+                loop.remove_signal_handler(signal.SIGINT)
+            except (NotImplementedError, RuntimeError, ValueError) as ex:
+                self.logger.debug(ex)
+
+            self.progress.summary()
 
+            # 接続はこのイベントループに紐づくため閉じておく
+            await self.db_crud.dispose()
+            self.db_crud = None
+
+    async def finish_crawl_race(self, race_id: int, status: str, last_error: str | None = None,
+                                fetched_at: datetime.datetime | None = None,
+                                parsed_at: datetime.datetime | None = None) -> None:
+        if self.crawl_state == False:
+            return
+
+        try:
+            await self.db_crud.update_crawl_race(race_id, status, last_error, fetched_at, parsed_at)
+        except Exception as ex:
+            self.logger.error(ex)
+
+    async def download_concurrently(self, max_concurrent_requests=4):
+        """
+        固定数のワーカーが上限付きのキューからレースを取り出して処理します。
+        レース数によらずメモリ使用量は一定になります。
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=max_concurrent_requests * 2)
+        # 停止により処理しなかったレース
+        pending_url_list: list[str] = []
+
+        async with httpx.AsyncClient(http2=True) as client:
+            async def worker():
+                while True:
+                    item = await queue.get()
                     try:
-                        self.ignore_race_id.index(race_id)
-                        self.logger.warning("[%5d] race_id: %d, url: %s, reject[ignore_race_id]", idx, race_id, url)
-                        return
-                    except ValueError as ex:
-                        self.logger.debug("[%5d] race_id: %d, url: %s, start", idx, race_id, url)
+                        if item is None:
+                            return
 
-                    html = None
+                        idx, url_path = item
+                        if self.stop_event.is_set() == True:
+                            pending_url_list.append(url_path)
+                            continue
 
-                    if os.path.isfile(filepath) == False:
                         try:
-                            response = await client.get(
-                                url,
-                                timeout=float(os.environ.get("HTTP_TIMEOUT", 5))
-                            )
-                            response.raise_for_status()
-
-                            try:
-                                # EUC-JPエンコーディングでデコードし、UTF-8に変換
-                                html = response.content.decode("euc-jp", errors="replace")
-                            except UnicodeDecodeError:
-                                # 既にUTF-8または他のエンコーディングの場合
-                                html = response.text
-
+                            status, error = await self.download_race(client, idx, url_path)
                         except Exception as ex:
-                            self.logger.warning(ex)
-                            return
+                            self.logger.error(ex)
+                            status, error = "failed", str(ex)
+                        self.progress.add(status, url_path, error)
+                    finally:
+                        queue.task_done()
+
+            workers = [asyncio.create_task(worker()) for _ in range(max_concurrent_requests)]
+            try:
+                for idx, url_path in enumerate(self.race_url_list):
+                    if self.stop_event.is_set() == True:
+                        pending_url_list.extend(self.race_url_list[idx:])
+                        break
+                    await queue.put((idx, url_path))
 
-                        with open(filepath, 'wb') as fp:
-                            fp.write(zstd.compress(html.encode("utf-8"), 3))
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            except BaseException:
+                for task in workers:
+                    task.cancel()
+                raise
 
-                        self.logger.info("[%5d] race_id: %d, url: %s, download finish", idx, race_id, url)
+        # 取得中にしたレースを未取得に戻す
+        pattern = re.compile(r"^/race/([0-9]+)/$")
+        for url_path in pending_url_list:
+            matchese: re.Match|None = pattern.match(url_path)
+            if matchese:
+                await self.finish_crawl_race(int(matchese.group(1)), "pending")
 
-                    else:
-                        self.logger.info("[%5d] race_id: %d, url: %s, downloaded", idx, race_id, url)
+    async def download_race(self, client: httpx.AsyncClient, idx: int, url_path: str) -> tuple[str, str | None]:
+        """
+        1レース分をダウンロード(またはキャッシュから読み込み)して保存し、(状態, エラー内容)を返します。
+        """
+        matchese: re.Match|None = re.match(r"^/race/([0-9]+)/$", url_path)
+        if not matchese:
+            return ("skipped", None)
 
-                        with open(filepath, 'rb') as fp:
-                            html = zstd.decompress(fp.read()).decode("utf-8")
+        race_id = int(matchese.group(1))
+        url = self.url_db + url_path
 
-                    if html == None:
-                        self.logger.warning("[%5d] race_id: %d, url: %s, no data", idx, race_id, url)
-                    else:
-                        self.scraping_html(race_id, html)
+        if race_id in self.ignore_race_id:
+            self.logger.warning("[%5d] race_id: %d, url: %s, reject[ignore_race_id]", idx, race_id, url)
+            await self.finish_crawl_race(race_id, "skipped")
+            return ("skipped", None)
 
-                    self.logger.debug("[%5d] url: %s, done", idx, url)
+        self.logger.debug("[%5d] race_id: %d, url: %s, start", idx, race_id, url)
 
-            for idx, url_path in enumerate(self.race_url_list):
-                matchese: re.Match|None = pattern.match(url_path)
-                if not matchese:
-                    continue
+        # マージ済みのキャッシュがなければシャードのキャッシュを使う
+        filepath = os.path.join(self.args.temp, "race." + matchese.group(1) + ".html.zst")
+        if os.path.isfile(filepath) == False:
+            filepath = os.path.join(self.cache_dir, "race." + matchese.group(1) + ".html.zst")
 
-                url = self.url_db + url_path
-                filepath = os.path.join(self.args.temp, "race." + matchese.group(1) + ".html.zst")
+        html = None
 
-                tasks.append(limited_download(idx, url, filepath))
+        if os.path.isfile(filepath) == False:
+            try:
+                response = await client.get(
+                    url,
+                    timeout=float(os.environ.get("HTTP_TIMEOUT", 5))
+                )
+                response.raise_for_status()
 
-            results = await asyncio.gather(*tasks)
-            return results
+                try:
+                    # EUC-JPエンコーディングでデコードし、UTF-8に変換
+                    html = response.content.decode("euc-jp", errors="replace")
+                except UnicodeDecodeError:
+                    # 既にUTF-8または他のエンコーディングの場合
+                    html = response.text
 
-    def scraping_html(self, race_id, html):
-        db_crud: SkylarkCrud = SkylarkCrud(self.db_url, logger = self.logger)
-        try:
-            dataset_horse :list   = []
-            dataset_jockey :list  = []
-            dataset_trainer :list = []
-            dataset_owner :list   = []
-            dataset_result :list  = []
-            dataset_payoff :list  = []
+            except Exception as ex:
+                self.logger.warning(ex)
+                await self.finish_crawl_race(race_id, "failed", last_error=str(ex))
+                return ("failed", str(ex))
 
-            dom = pq(html)
-            race_head = dom("html body div#page div#main div.race_head")
+            with open(filepath, 'wb') as fp:
+                fp.write(zstd.compress(html.encode("utf-8"), 3))
 
-            # init
-            data_race_name = None
-            data_distance = None
-            data_weather = None
-            data_post_time = None
-            data_race_number = None
-            data_track_surface = None
-            data_track_condition = None
-            data_track_condition_org = None
-            data_track_condition_score = None
-            data_run_direction = None
-            data_track_surface_org = None
-            data_place_detail = None
-            data_class = None
-            data_date = None
-
-            data_race_number_text = str(race_head("dl.racedata dt").text())
-            if data_race_number_text:
-                data_race_number = int(data_race_number_text.split(" ", 1)[0])
-            else:
-                data_race_number = None
+            self.logger.info("[%5d] race_id: %d, url: %s, download finish", idx, race_id, url)
 
-            data_race_name = race_head("dl.racedata dd h1").text()
+        else:
+            self.logger.info("[%5d] race_id: %d, url: %s, downloaded", idx, race_id, url)
 
-            # track_surface, distance, weather, track_condition, post_time
-            race_info_text = str(race_head("dl.racedata dd p span").text())
-            matchese: re.Match | None = re.match(
-                r'^([^\d ]+).*?(\d{4})m\s*/\s*天候 : (\w+)\s*/\s*(.+)\s+/\s+発走 : (\d{1,2}:\d{1,2})',
-                race_info_text,
-                re.U
-            )
-            if matchese:
-                data_track_surface_org = matchese.group(1)
-                if re.search(r'^芝', data_track_surface_org):
-                    data_track_surface = "芝"
-                elif re.search(r'^ダ', data_track_surface_org):
-                    data_track_surface = "ダート"
-                elif re.search(r'^障', data_track_surface_org):
-                    data_track_surface = "障害"
-
-                if re.search(r'^.*左', data_track_surface_org):
-                    data_run_direction = "左"
-                elif re.search(r'^.*右', data_track_surface_org):
-                    data_run_direction = "右"
-                elif re.search(r'^.*直線', data_track_surface_org):
-                    data_run_direction = "直線"
-
-                if data_run_direction is not None and re.search(r'^.*外$', data_track_surface_org):
-                    data_run_direction = data_run_direction + " 外"
-
-                data_distance = int(matchese.group(2))
-
-                data_weather = matchese.group(3)
-
-                data_track_condition_org = matchese.group(4)
-                matchese_condition = re.match(r'^.*?\s*:\s*(\w+)\s*', data_track_condition_org, re.U)
-                if matchese_condition:
-                    data_track_condition = matchese_condition.group(1)
-
-                data_post_time = matchese.group(5)
-
-            # date, place_detail, class
-            text_value = str(race_head("div.mainrace_data p").eq(1).text())
-            matchese = re.match(r'^(\d{4})年\s*(\d{1,2})月\s*(\d{1,2})日\s*([^ ]+)\s+(.+)', text_value)
-            if matchese:
-                data_date = matchese.group(1) + "-" + matchese.group(2) + "-" + matchese.group(3)
-                data_place_detail = matchese.group(4)
-                data_class = matchese.group(5)
-
-            race_head = None
-
-            dataset_info: dict = {
-                "id":race_id,
-                "race_name":data_race_name,
-                "distance":data_distance,
-                "weather":data_weather,
-                "post_time":data_post_time,
-                "race_number":data_race_number,
-                "run_direction":data_run_direction,
-                "track_surface":data_track_surface,
-                "track_condition":data_track_condition,
-                "track_condition_score":data_track_condition_score,
-                "date":data_date,
-                "place_detail":data_place_detail,
-                "race_grade":SkylarkUtil.convertToClass2Int(data_class),
-                "race_class":data_class
-            }
+            with open(filepath, 'rb') as fp:
+                html = zstd.decompress(fp.read()).decode("utf-8")
 
-            db_crud.upsert_race_info(dataset_info)
+        fetched_at = datetime.datetime.now()
 
-            race_result = dom("html body div#page div#contents_liquid table tr")
-            for result_row in race_result[1:]:
-                columns = pq(result_row).find("td")
+        if html == None:
+            self.logger.warning("[%5d] race_id: %d, url: %s, no data", idx, race_id, url)
+            await self.finish_crawl_race(race_id, "failed", last_error="no data", fetched_at=fetched_at)
+            return ("failed", "no data")
 
-                #着順
-                order_of_finish = str(columns.eq(0).text())
-                try:
-                    order_of_finish = int(order_of_finish)
-                except ValueError as ex:
-                    #self.logger.warning(ex)
-                    order_of_finish = None
+        error = await self.scraping_html(race_id, html)
+        if error is None:
+            # 一括取り込みモードではTSVのロード後に done にする
+            status = "parsed" if self.backfill is not None else "done"
+            await self.finish_crawl_race(race_id, status, fetched_at=fetched_at, parsed_at=datetime.datetime.now())
+        else:
+            await self.finish_crawl_race(race_id, "failed", last_error=error, fetched_at=fetched_at)
 
-                #枠番
-                bracket_number = str(columns.eq(1).text())
-                try:
-                    bracket_number = int(bracket_number)
-                except ValueError as ex:
-                    self.logger.warning(ex)
+        self.logger.debug("[%5d] url: %s, done", idx, url)
+        return ("done", None) if error is None else ("failed", error)
 
-                #馬番
-                horse_number = str(columns.eq(2).text())
-                try:
-                    horse_number = int(horse_number)
-                except ValueError as ex:
-                    self.logger.warning(ex)
+    async def scraping_html(self, race_id, html) -> str | None:
+        """
+        レース結果ページを解析して保存します。失敗した場合はエラー内容を返します。
+        """
+        try:
+            # 解析はCPU処理のためスレッドで行い、ダウンロードと重ねる
+            dataset = await asyncio.to_thread(self.parse_race_html, race_id, html)
 
-                #馬ID
-                horse_id = str(columns.eq(3).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
-                try:
-                    horse_id = int(horse_id)
-                except ValueError as ex:
-                    self.logger.warning(ex)
-
-                #馬名
-                horse_name = str(columns.eq(3).find("a").eq(0).text())
-
-                #性別、年齢
-                sex = None
-                age = 0
-                matchese = None
-                matchese = re.match(r'^(.)(\d+)$', str(columns.eq(4).text()))
-                if matchese:
-                    sex = matchese.group(1)
-                    age = int(matchese.group(2))
-
-                #斤量
-                basis_weight = float(str(columns.eq(5).text()))
-
-                #騎手
-                jockey_id = str(columns.eq(6).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
-                try:
-                    jockey_id = int(jockey_id)
-                except ValueError as ex:
-                    self.logger.warning(ex)
-                jockey_name = columns.eq(6).find("a").eq(0).text()
+            # 新規または名前が変わったものだけを書き込む
+            for key in self.entity_cache.entity_list:
+                dataset[key] = self.entity_cache.filter(key, dataset[key])
 
-                #タイム
-                finishing_time = None
-                matchese = re.match(r'^(\d+:\d+\.\d+)$', str(columns.eq(7).text()))
-                if matchese:
-                    finishing_time = '00:'+matchese.group(1)
+            if self.backfill is not None:
+                self.backfill.write(dataset)
+            else:
+                await self.db_crud.upsert_race(
+                    dataset["race_info"],
+                    dataset["horse"],
+                    dataset["jockey"],
+                    dataset["trainer"],
+                    dataset["owner"],
+                    dataset["result"],
+                    dataset["payoff"],
+                    dataset["summary"]
+                )
+
+            for key in self.entity_cache.entity_list:
+                self.entity_cache.update(key, dataset[key])
+        except Exception as ex:
+            self.logger.error(ex)
+            return str(ex)
 
-                #着差
-                margin = str(columns.eq(8).text())
+        return None
 
-                #タイム指数(有料)
-                try:
-                    speed_figure = int(str(columns.eq(9).text()))
-                except ValueError as ex:
-                    #self.logger.warning(ex)
-                    speed_figure =  None
+    def parse_race_html(self, race_id, html) -> dict:
+        """
+        レース結果ページを解析し、テーブルごとのデータセットを返します。
+        """
+        dataset_horse :list   = []
+        dataset_jockey :list  = []
+        dataset_trainer :list = []
+        dataset_owner :list   = []
+        dataset_result :list  = []
+        dataset_payoff :list  = []
+
+        dom = pq(html)
+        race_head = dom("html body div#page div#main div.race_head")
+
+        # init
+        data_race_name = None
+        data_distance = None
+        data_weather = None
+        data_post_time = None
+        data_race_number = None
+        data_track_surface = None
+        data_track_condition = None
+        data_track_condition_org = None
+        data_track_condition_score = None
+        data_run_direction = None
+        data_track_surface_org = None
+        data_place_detail = None
+        data_class = None
+        data_date = None
+
+        data_race_number_text = str(race_head("dl.racedata dt").text())
+        if data_race_number_text:
+            data_race_number = int(data_race_number_text.split(" ", 1)[0])
+        else:
+            data_race_number = None
 
-                #通過
-                passing_rank = str(columns.eq(10).text())
+        data_race_name = race_head("dl.racedata dd h1").text()
 
-                #上りタイム
-                last_phase = str(columns.eq(11).text())
-                try:
-                    last_phase = float(last_phase)
-                except ValueError as ex:
-                    #self.logger.warning(ex)
-                    last_phase = None
+        # track_surface, distance, weather, track_condition, post_time
+        race_info_text = str(race_head("dl.racedata dd p span").text())
+        matchese: re.Match | None = re.match(
+            r'^([^\d ]+).*?(\d{4})m\s*/\s*天候 : (\w+)\s*/\s*(.+)\s+/\s+発走 : (\d{1,2}:\d{1,2})',
+            race_info_text,
+            re.U
+        )
+        if matchese:
+            data_track_surface_org = matchese.group(1)
+            if re.search(r'^芝', data_track_surface_org):
+                data_track_surface = "芝"
+            elif re.search(r'^ダ', data_track_surface_org):
+                data_track_surface = "ダート"
+            elif re.search(r'^障', data_track_surface_org):
+                data_track_surface = "障害"
+
+            if re.search(r'^.*左', data_track_surface_org):
+                data_run_direction = "左"
+            elif re.search(r'^.*右', data_track_surface_org):
+                data_run_direction = "右"
+            elif re.search(r'^.*直線', data_track_surface_org):
+                data_run_direction = "直線"
+
+            if data_run_direction is not None and re.search(r'^.*外$', data_track_surface_org):
+                data_run_direction = data_run_direction + " 外"
+
+            data_distance = int(matchese.group(2))
+
+            data_weather = matchese.group(3)
+
+            data_track_condition_org = matchese.group(4)
+            matchese_condition = re.match(r'^.*?\s*:\s*(\w+)\s*', data_track_condition_org, re.U)
+            if matchese_condition:
+                data_track_condition = matchese_condition.group(1)
+
+            data_post_time = SkylarkUtil.parsePostTime(matchese.group(5))
+
+        # date, place_detail, class
+        text_value = str(race_head("div.mainrace_data p").eq(1).text())
+        matchese = re.match(r'^(\d{4})年\s*(\d{1,2})月\s*(\d{1,2})日\s*([^ ]+)\s+(.+)', text_value)
+        if matchese:
+            data_date = datetime.date(int(matchese.group(1)), int(matchese.group(2)), int(matchese.group(3)))
+            data_place_detail = matchese.group(4)
+            data_class = matchese.group(5)
+
+        race_head = None
+
+        dataset_info: dict = {
+            "id":race_id,
+            "race_name":data_race_name,
+            "distance":data_distance,
+            "weather":data_weather,
+            "post_time":data_post_time,
+            "race_number":data_race_number,
+            "run_direction":data_run_direction,
+            "track_surface":data_track_surface,
+            "track_condition":data_track_condition,
+            "track_condition_score":data_track_condition_score,
+            "date":data_date,
+            "place_detail":data_place_detail,
+            "race_grade":SkylarkUtil.convertToClass2Int(data_class),
+            "race_class":data_class
+        }
+
+
+        race_result = dom("html body div#page div#contents_liquid table tr")
+        for result_row in race_result[1:]:
+            columns = pq(result_row).find("td")
+
+            #着順
+            order_of_finish = str(columns.eq(0).text())
+            try:
+                order_of_finish = int(order_of_finish)
+            except ValueError as ex:
+                #self.logger.warning(ex)
+                order_of_finish = None
 
-                #単勝オッズ
-                odds = str(columns.eq(12).text())
-                try:
-                    odds = float(odds)
-                except ValueError as ex:
-                    #self.logger.warning(ex)
-                    odds = None
+            #枠番
+            bracket_number = str(columns.eq(1).text())
+            try:
+                bracket_number = int(bracket_number)
+            except ValueError as ex:
+                self.logger.warning(ex)
 
-                #人気
-                popularity = str(columns.eq(13).text())
-                try:
-                    popularity = int(popularity)
-                except ValueError as ex:
-                    #self.logger.warning(ex)
-                    popularity = None
-
-                #馬体重
-                horse_weight = None
-                horse_weight_diff = None
-                matchese = None
-                matchese = re.match(r'^(\d+)\(\+?(\-?\d+)\)$', str(columns.eq(14).text()))
-                if matchese:
-                    horse_weight = matchese.group(1)
-                    horse_weight_diff = matchese.group(2)
-
-                #備考
-                remark = columns.eq(17).text()
-                if remark == "":
-                    remark = None
-
-                # 厩舎
-                stable = '不明'
-                matchese = None
-                matchese = re.match(r'\[(.)\]', str(columns.eq(18).text()))
-                if matchese:
-                    stable = matchese.group(1)
-
-                #調教師
-                trainer_id = str(columns.eq(18).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
-                try:
-                    trainer_id = int(trainer_id)
-                except ValueError as ex:
-                    self.logger.warning(ex)
-                trainer_name = columns.eq(18).find("a").eq(0).text()
+            #馬番
+            horse_number = str(columns.eq(2).text())
+            try:
+                horse_number = int(horse_number)
+            except ValueError as ex:
+                self.logger.warning(ex)
 
-                #馬主
-                owner_id = str(columns.eq(19).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
-                owner_name = columns.eq(19).find("a").eq(0).text()
+            #馬ID
+            horse_id = str(columns.eq(3).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
+            try:
+                horse_id = int(horse_id)
+            except ValueError as ex:
+                self.logger.warning(ex)
+
+            #馬名
+            horse_name = str(columns.eq(3).find("a").eq(0).text())
+
+            #性別、年齢
+            sex = None
+            age = 0
+            matchese = None
+            matchese = re.match(r'^(.)(\d+)$', str(columns.eq(4).text()))
+            if matchese:
+                sex = matchese.group(1)
+                age = int(matchese.group(2))
 
-                #賞金
-                earning_money = str(columns.eq(20).text()).replace(",", "")
-                try:
-                    earning_money = float(earning_money)
-                except ValueError as ex:
-                    #self.logger.warning(ex)
-                    earning_money = 0
-
-                dataset_horse.append({
-                    "horse_id":horse_id,
-                    "horse_name":horse_name
-                })
+            #斤量
+            basis_weight = float(str(columns.eq(5).text()))
 
-                dataset_jockey.append({
-                    "jockey_id":jockey_id,
-                    "jockey_name":jockey_name
-                })
+            #騎手
+            jockey_id = str(columns.eq(6).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
+            try:
+                jockey_id = int(jockey_id)
+            except ValueError as ex:
+                self.logger.warning(ex)
+            jockey_name = columns.eq(6).find("a").eq(0).text()
+
+            #タイム
+            finishing_time = None
+            matchese = re.match(r'^(\d+:\d+\.\d+)$', str(columns.eq(7).text()))
+            if matchese:
+                finishing_time = SkylarkUtil.convertToTime(SkylarkUtil.parseFinishingTime(matchese.group(1)))
 
-                dataset_trainer.append({
-                    "trainer_id":trainer_id,
-                    "trainer_name":trainer_name
-                })
+            #着差
+            margin = str(columns.eq(8).text())
 
-                dataset_owner.append({
-                    "owner_id":owner_id,
-                    "owner_name":owner_name
-                })
+            #タイム指数(有料)
+            try:
+                speed_figure = int(str(columns.eq(9).text()))
+            except ValueError as ex:
+                #self.logger.warning(ex)
+                speed_figure =  None
+
+            #通過
+            passing_rank = str(columns.eq(10).text())
+            corners = SkylarkUtil.parseCorners(passing_rank)
 
-                dataset_result.append({
+            #上りタイム
+            last_phase = str(columns.eq(11).text())
+            try:
+                last_phase = float(last_phase)
+            except ValueError as ex:
+                #self.logger.warning(ex)
+                last_phase = None
+
+            #単勝オッズ
+            odds = str(columns.eq(12).text())
+            try:
+                odds = float(odds)
+            except ValueError as ex:
+                #self.logger.warning(ex)
+                odds = None
+
+            #人気
+            popularity = str(columns.eq(13).text())
+            try:
+                popularity = int(popularity)
+            except ValueError as ex:
+                #self.logger.warning(ex)
+                popularity = None
+
+            #馬体重
+            horse_weight = None
+            horse_weight_diff = None
+            matchese = None
+            matchese = re.match(r'^(\d+)\(\+?(\-?\d+)\)$', str(columns.eq(14).text()))
+            if matchese:
+                horse_weight = matchese.group(1)
+                horse_weight_diff = matchese.group(2)
+
+            #備考
+            remark = columns.eq(17).text()
+            if remark == "":
+                remark = None
+
+            # 厩舎
+            stable = '不明'
+            matchese = None
+            matchese = re.match(r'\[(.)\]', str(columns.eq(18).text()))
+            if matchese:
+                stable = matchese.group(1)
+
+            #調教師
+            trainer_id = str(columns.eq(18).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
+            try:
+                trainer_id = int(trainer_id)
+            except ValueError as ex:
+                self.logger.warning(ex)
+            trainer_name = columns.eq(18).find("a").eq(0).text()
+
+            #馬主
+            owner_id = str(columns.eq(19).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
+            owner_name = columns.eq(19).find("a").eq(0).text()
+
+            #賞金
+            earning_money = str(columns.eq(20).text()).replace(",", "")
+            try:
+                earning_money = float(earning_money)
+            except ValueError as ex:
+                #self.logger.warning(ex)
+                earning_money = 0
+
+            dataset_horse.append({
+                "horse_id":horse_id,
+                "horse_name":horse_name
+            })
+
+            dataset_jockey.append({
+                "jockey_id":jockey_id,
+                "jockey_name":jockey_name
+            })
+
+            dataset_trainer.append({
+                "trainer_id":trainer_id,
+                "trainer_name":trainer_name
+            })
+
+            dataset_owner.append({
+                "owner_id":owner_id,
+                "owner_name":owner_name
+            })
+
+            dataset_result.append({
+                "race_id":race_id,
+                "horse_number":horse_number,
+                "order_of_finish":order_of_finish,
+                "bracket_number":bracket_number,
+                "horse_id":horse_id,
+                "sex":sex,
+                "age":age,
+                "basis_weight":basis_weight,
+                "jockey_id":jockey_id,
+                "finishing_time":finishing_time,
+                "margin":margin,
+                "speed_figure":speed_figure,
+                "passing_rank":passing_rank,
+                "last_phase":last_phase,
+                "odds":odds,
+                "popularity":popularity,
+                "horse_weight":horse_weight,
+                "horse_weight_diff":horse_weight_diff,
+                "remark":remark,
+                "stable":stable,
+                "trainer_id":trainer_id,
+                "owner_id":owner_id,
+                "earning_money":earning_money,
+                "race_date":data_date,
+                "finishing_time_sec":SkylarkUtil.parseFinishingTime(finishing_time),
+                "corner_1":corners[0],
+                "corner_2":corners[1],
+                "corner_3":corners[2],
+                "corner_4":corners[3],
+                "margin_length":0.0 if order_of_finish == 1 else SkylarkUtil.parseMargin(margin)
+            })
+
+        race_result = None
+
+        pay_block = dom("html body div#page div#contents dl.pay_block tr")
+        for pay_result in pay_block:
+            columns = pq(pay_result).find("th")
+            ticket_type = SkylarkUtil.convertToTicketType2Int(columns.eq(0).text())
+
+            # 複勝、ワイドなどは <br> 区切りで複数行(pyquery は <br/> で出力する)
+            columns = pq(pay_result).find("td")
+            horse_numbers_list = re.split(r"<br\s*/?>", str(columns.eq(0).html()))
+            payoff_list = re.split(r"<br\s*/?>", str(columns.eq(1).html()))
+            popularity_list = re.split(r"<br\s*/?>", str(columns.eq(2).html()))
+
+            idx = 0
+            while idx < len(horse_numbers_list):
+                horse_numbers = horse_numbers_list[idx].replace(" ", "").replace("→", "->")
+                dataset_payoff.append({
                     "race_id":race_id,
-                    "horse_number":horse_number,
-                    "order_of_finish":order_of_finish,
-                    "bracket_number":bracket_number,
-                    "horse_id":horse_id,
-                    "sex":sex,
-                    "age":age,
-                    "basis_weight":basis_weight,
-                    "jockey_id":jockey_id,
-                    "finishing_time":finishing_time,
-                    "margin":margin,
-                    "speed_figure":speed_figure,
-                    "passing_rank":passing_rank,
-                    "last_phase":last_phase,
-                    "odds":odds,
-                    "popularity":popularity,
-                    "horse_weight":horse_weight,
-                    "horse_weight_diff":horse_weight_diff,
-                    "remark":remark,
-                    "stable":stable,
-                    "trainer_id":trainer_id,
-                    "owner_id":owner_id,
-                    "earning_money":earning_money
+                    "ticket_type":ticket_type,
+                    "horse_numbers":horse_numbers,
+                    "payoff":int(payoff_list[idx].replace(",", "")),
+                    "popularity":int(popularity_list[idx]),
+                    "combination_key":SkylarkUtil.encodeCombination(horse_numbers)
                 })
-
-            race_result = None
-            db_crud.upsert_horses(dataset_horse)
-            db_crud.upsert_jockeys(dataset_jockey)
-            db_crud.upsert_trainers(dataset_trainer)
-            db_crud.upsert_owners(dataset_owner)
-            db_crud.upsert_race_results(dataset_result)
-
-            pay_block = dom("html body div#page div#contents dl.pay_block tr")
-            for pay_result in pay_block:
-                columns = pq(pay_result).find("th")
-                ticket_type = SkylarkUtil.convertToTicketType2Int(columns.eq(0).text())
-
-                columns = pq(pay_result).find("td")
-                horse_numbers_list = str(columns.eq(0).html()).split("<br />")
-                payoff_list = str(columns.eq(1).html()).split("<br />")
-                popularity_list = str(columns.eq(2).html()).split("<br />")
-
-                idx = 0
-                while idx < len(horse_numbers_list):
-                    dataset_payoff.append({
-                        "race_id":race_id,
-                        "ticket_type":ticket_type,
-                        "horse_numbers":horse_numbers_list[idx].replace(" ", "").replace("→", "->"),
-                        "payoff":int(payoff_list[idx].replace(",", "")),
-                        "popularity":int(popularity_list[idx])
-                    })
-                    idx = idx + 1
-
-            pay_block = None
-            db_crud.upsert_payoffs(dataset_payoff)
-        except Exception as ex:
-            self.logger.error(ex)
+                idx = idx + 1
+
+        pay_block = None
+
+        return {
+            "race_info": dataset_info,
+            "horse": dataset_horse,
+            "jockey": dataset_jockey,
+            "trainer": dataset_trainer,
+            "owner": dataset_owner,
+            "result": dataset_result,
+            "payoff": dataset_payoff,
+            "summary": SkylarkRaceSummary.make(race_id, dataset_result),
+        }
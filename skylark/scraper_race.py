@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from argparse import Namespace
+import asyncio
+import datetime
+from logging import Logger
+import os
+import re
+from typing import TYPE_CHECKING, Any, Awaitable, Callable
+
+# playwright はブラウザを起動するときだけ読み込む(静的メソッドのみ使う webui.py の起動を軽くするため)
+if TYPE_CHECKING:
+    from playwright.async_api import Browser
+
+from skylark.crud import SkylarkCrud
+from skylark.util import SkylarkUtil
+
+class SkylarkScraperRace:
+    """
+    race.netkeiba.com から開催日、レース一覧、出馬表を取得する
+    1つのブラウザを共有し、ページ単位で並行に取得する
+    """
+
+    def __init__(self, db_url: str, args: Namespace | None, logger: Logger):
+        self.db_url = db_url
+        self.args = args
+        self.logger = logger
+
+        self.url_race: str = "https://race.netkeiba.com"
+
+    def __enter__(self):
+        return self
+
+    async def with_browser(self, func: Callable[["Browser"], Awaitable[Any]]) -> Any:
+        from playwright.async_api import async_playwright
+
+        async with async_playwright() as pw:
+            browser = await pw.chromium.launch(headless=True)
+            try:
+                return await func(browser)
+            finally:
+                await browser.close()
+
+    def run(self, func: Callable[["Browser"], Awaitable[Any]]) -> Any:
+        """
+        ブラウザを起動して func(browser) を実行します。
+        """
+        return asyncio.run(self.with_browser(func))
+
+    async def fetch_race_dates(self, browser: "Browser", today) -> list:
+        page = await browser.new_page()
+        try:
+            await page.goto(self.url_race + "/top/race_list.html", wait_until="domcontentloaded")
+            await page.wait_for_selector("ul#date_list_sub", timeout=10000)
+            date_buttons = []
+            for btn in await page.query_selector_all("ul#date_list_sub a"):
+                date_text = (await btn.inner_text()).strip()
+                href = await btn.get_attribute("href")
+                if date_text and href:
+                    kaisai_date: datetime.date | None = self.extract_kaisai_date_from_url(href)
+                    if kaisai_date and kaisai_date < today:
+                        # 開催日が今日以降のもののみを対象とする
+                        continue
+                    date_buttons.append({"text": date_text, "href": href, "kaisai_date": kaisai_date})
+            return date_buttons
+        finally:
+            await page.close()
+
+    async def fetch_race_list_for_date(self, browser: "Browser", link: str) -> list:
+        if link.startswith("http"):
+            url = link
+        else:
+            url = self.url_race + "/top/" + link.lstrip("/")
+
+        page = await browser.new_page()
+        try:
+            await page.goto(url, wait_until="domcontentloaded")
+            await page.wait_for_selector("dl.RaceList_DataList", timeout=10000)
+            race_list = []
+            for dl in await page.query_selector_all("dl.RaceList_DataList"):
+                # 開催場名
+                course_name_p_tag = await dl.query_selector("p.RaceList_DataTitle")
+                course_name = (await course_name_p_tag.inner_text()).strip() if course_name_p_tag else ""
+                for li in await dl.query_selector_all("li.RaceList_DataItem"):
+                    # レース名
+                    race_num_div = await li.query_selector("div.Race_Num")
+                    race_number = (await race_num_div.inner_text()).strip() if race_num_div else ""
+                    title_span = await li.query_selector("div.RaceList_ItemTitle span.ItemTitle")
+                    race_name = (await title_span.inner_text()).strip() if title_span else "（名称不明）"
+                    # 発走時刻
+                    time_span = await li.query_selector("span.RaceList_Itemtime")
+                    matches = re.search(r"(\d{1,2}):(\d{1,2})", await time_span.inner_text()) if time_span else None
+                    post_time = datetime.time(hour=int(matches.group(1)), minute=int(matches.group(2))) if matches else None
+                    # レース詳細ページへのリンク
+                    a_tag = await li.query_selector("a")
+                    href = await a_tag.get_attribute("href") if a_tag else None
+                    if race_name and href and "/race/" in href:
+                        race_list.append({
+                            "race_id": self.extract_race_id_from_url(href),
+                            "course_name": course_name,
+                            "race_number": race_number,
+                            "race_name": race_name,
+                            "post_time": post_time,
+                            "text": f"{course_name} - {race_number:3s} - {race_name}",
+                            "href": href
+                        })
+            return race_list
+        finally:
+            await page.close()
+
+    async def fetch_race_information(self, browser: "Browser", link: str) -> tuple[dict, dict]:
+        if link.startswith("http"):
+            url = link
+        else:
+            url = self.url_race + link.lstrip(".")
+
+        race_id = self.extract_race_id_from_url(url)
+
+        page = await browser.new_page()
+        try:
+            await page.goto(url, wait_until="domcontentloaded")
+            await page.wait_for_selector("table.Shutuba_Table tbody tr.HorseList", timeout=20000)
+
+            race_name = await page.query_selector("#page > div.RaceColumn01 > div > div.RaceMainColumn > div.RaceList_NameBox > div.RaceList_Item02 > h1")
+
+            race_number = await page.query_selector("#page > div.RaceColumn01 > div > div.RaceMainColumn > div.RaceList_NameBox > div.RaceList_Item01 > span.RaceNum")
+            race_number = re.search(r"^(\d+)R", (await race_number.inner_text()).strip() if race_number else "")
+            race_number = int(race_number.group(1)) if race_number else None
+
+            race_data1 = await page.query_selector("div.RaceData01")
+            race_data1 = (await race_data1.inner_text()).strip() if race_data1 else ""
+
+            matches = re.search(r"(\d{1,2}):(\d{1,2})発走", race_data1)
+            post_time = None
+            if matches:
+                post_time = datetime.time(
+                    hour=int(matches.group(1)),
+                    minute=int(matches.group(2))
+                )
+
+            matches = re.search(r"(芝|ダ|障)(\d+)m\s+\((左|右|直線).*\)", race_data1)
+            distance = None
+            track_surface = None
+            run_direction = None
+            if matches:
+                if matches.group(1) == "芝":
+                    track_surface = "芝"
+                elif matches.group(1) == "ダ":
+                    track_surface = "ダート"
+                elif matches.group(1) == "障":
+                    track_surface = "障害"
+
+                distance = int(matches.group(2))
+                run_direction = matches.group(3)
+
+            matches = re.search(r"天候:([^\s]+)", race_data1)
+            weather = None
+            if matches:
+                weather = matches.group(1).strip()
+
+            matches = re.search(r"馬場:([^\s]+)", race_data1)
+            track_condition = None
+            if matches:
+                track_condition = matches.group(1).strip()
+
+            race_data2 = await page.query_selector("div.RaceData02")
+            race_data2 = (await race_data2.inner_text()).strip() if race_data2 else ""
+
+            race_grade = SkylarkUtil.convertToClass2Int(race_data2)
+            race_data2_list = race_data2.split(" ")
+
+            race_info_dict = {
+                "id": race_id,
+                "race_name": (await race_name.inner_text()).strip() if race_name else None,
+                "distance": distance,
+                "weather": weather,
+                "post_time": post_time,
+                "race_number": race_number,
+                "run_direction": run_direction,
+                "track_surface": track_surface,
+                "track_condition": track_condition,
+                "track_condition_score": None,
+                "date": None, # 開催日（URLから抽出し、後ほど代入）
+                "place_detail": "", # 後ほど代入
+                "race_grade": race_grade,
+                "race_class": " ".join(race_data2_list[3:5]),
+            }
+
+            horses_dict = {}
+            horse_trs = await page.query_selector_all("table.Shutuba_Table tbody tr.HorseList")
+
+            for horse in horse_trs:
+
+                horse_number_elem = await horse.query_selector("td.Umaban1")
+                horse_number = int((await horse_number_elem.inner_text()).strip()) if horse_number_elem else None
+
+                waku_number_elem = await horse.query_selector("td.Waku1")
+                waku_number = int((await waku_number_elem.inner_text()).strip()) if waku_number_elem else None
+
+                horse_name_elem = await horse.query_selector("span.HorseName > a")
+                horse_id = None
+                horse_db_url = await horse_name_elem.get_attribute("href") if horse_name_elem else None
+                matches = re.search(r"/(\d+)$", horse_db_url) if horse_db_url else None
+                if matches:
+                    horse_id = int(matches.group(1))
+                horse_name = (await horse_name_elem.inner_text()).strip() if horse_name_elem else None
+
+                jockey_name_elem = await horse.query_selector("td.Jockey > a")
+                jockey_id = None
+                jockey_db_url = await jockey_name_elem.get_attribute("href") if jockey_name_elem else None
+                matches = re.search(r"/(\d+)/$", jockey_db_url) if jockey_db_url else None
+                if matches:
+                    jockey_id = int(matches.group(1))
+                jockey_name = (await jockey_name_elem.inner_text()).strip() if jockey_name_elem else None
+
+                barei_elem = await horse.query_selector("td.Barei")
+                barei = (await barei_elem.inner_text()).strip() if barei_elem else None
+
+                # 斤量は性齢の次のセル(td.Txt_C は他の列にもある)
+                basis_weight_elem = await horse.query_selector("td.Barei + td.Txt_C")
+                basis_weight = None
+                matches = re.search(r"\d+(?:\.\d+)?", await basis_weight_elem.inner_text()) if basis_weight_elem else None
+                if matches:
+                    basis_weight = float(matches.group(0))
+
+                trainer_name_elem = await horse.query_selector("td.Trainer > a")
+                trainer_id = None
+                trainer_db_url = await trainer_name_elem.get_attribute("href") if trainer_name_elem else None
+                matches = re.search(r"/(\d+)/$", trainer_db_url) if trainer_db_url else None
+                if matches:
+                    trainer_id = int(matches.group(1))
+                trainer_name = (await trainer_name_elem.inner_text()).strip() if trainer_name_elem else None
+
+                # 馬体重 "478(+2)"、発表前や計不は None
+                horse_weight_elem = await horse.query_selector("td.Weight")
+                horse_weight: int | None = None
+                horse_weight_diff: int | None = None
+                matches = SkylarkScraperRace.parse_horse_weight(await horse_weight_elem.inner_text()) if horse_weight_elem else None
+                if matches is not None:
+                    horse_weight, horse_weight_diff = matches
+
+                odds_elem = await horse.query_selector("td.Txt_R > span")
+                odds = float((await odds_elem.inner_text()).strip()) if odds_elem else None
+
+                popularity_elem = await horse.query_selector("td.Popular > span")
+                popularity = float((await popularity_elem.inner_text()).strip()) if popularity_elem else None
+
+                horses_dict[horse_number] = {
+                    "horse_id": horse_id, # 馬ID
+                    "horse_number": horse_number, # 馬番
+                    "waku_number": waku_number, # 枠番
+                    "horse_name": horse_name, # 馬名
+                    "barei": barei, # 馬齢
+                    "basis_weight": basis_weight, # 斤量
+                    "jockey_id": jockey_id, # 騎手ID
+                    "jockey_name": jockey_name, # 騎手名
+                    "trainer_id": trainer_id, # 調教師ID
+                    "trainer_name": trainer_name, # 調教師名
+                    "odds": odds, # オッズ
+                    "popularity": popularity, # 人気
+                    "horse_weight": horse_weight, # 馬体重
+                    "horse_weight_diff": horse_weight_diff, # 馬体重増減
+                }
+
+            return race_info_dict, horses_dict
+        finally:
+            await page.close()
+
+    async def fetch_race_card(self, browser: "Browser", race: dict, kaisai_date: datetime.date | None) -> tuple[dict, dict]:
+        """
+        レース一覧の1件から出馬表を取得し、開催日と開催場を補完します。
+        """
+        race_info_dict, horses_dict = await self.fetch_race_information(browser, race["href"])
+        race_info_dict["date"] = kaisai_date
+        race_info_dict["place_detail"] = race["course_name"]
+        return race_info_dict, horses_dict
+
+    # 開催日の全レースの出馬表を取得してDBに保存
+    def download_race_card(self, kaisai_date: datetime.date) -> None:
+        race_card_list = self.run(
+            lambda browser: self.fetch_race_card_concurrently(
+                browser,
+                kaisai_date,
+                max_concurrent_requests=int(os.environ.get("MAX_CONCURRENT_REQUESTS", 4))
+            )
+        )
+        if len(race_card_list) == 0:
+            self.logger.warning("race card not found: %s", kaisai_date)
+            return
+
+        dataset = self.make_race_card_dataset(race_card_list)
+        with SkylarkCrud(self.db_url, logger=self.logger) as db_crud:
+            db_crud.upsert_race_entries(
+                dataset["race_info"],
+                dataset["horse"],
+                dataset["jockey"],
+                dataset["trainer"],
+                dataset["entry"]
+            )
+        self.logger.info("saved: %d races, %d entries", len(dataset["race_info"]), len(dataset["entry"]))
+
+    async def fetch_race_card_concurrently(self, browser: "Browser", kaisai_date: datetime.date,
+                                           max_concurrent_requests=4) -> list[tuple[dict, dict]]:
+        race_list = await self.fetch_race_list_for_date(
+            browser,
+            "race_list.html?kaisai_date=" + kaisai_date.strftime("%Y%m%d")
+        )
+        self.logger.info("kaisai_date: %s, %d races", kaisai_date, len(race_list))
+
+        return await self.fetch_race_cards(browser, race_list, kaisai_date, max_concurrent_requests)
+
+    async def fetch_race_cards(self, browser: "Browser", race_list: list, kaisai_date: datetime.date | None,
+                               max_concurrent_requests=4) -> list[tuple[dict, dict]]:
+        semaphore = asyncio.Semaphore(max_concurrent_requests)  # 並行数を制御
+
+        async def limited_fetch(race: dict) -> tuple[dict, dict] | None:
+            async with semaphore:
+                try:
+                    race_card = await self.fetch_race_card(browser, race, kaisai_date)
+                    self.logger.info("race_id: %s, %s, fetch finish", race["race_id"], race["text"])
+                    return race_card
+                except Exception as ex:
+                    self.logger.warning("race_id: %s, %s", race["race_id"], ex)
+                    return None
+
+        results = await asyncio.gather(*[limited_fetch(race) for race in race_list])
+        return [result for result in results if result is not None]
+
+    @staticmethod
+    def make_race_card_dataset(race_card_list: list[tuple[dict, dict]]) -> dict[str, list]:
+        """
+        fetch_race_informationの結果(レース情報, 出走馬)のリストをテーブルごとのデータセットに変換する
+        """
+        dataset: dict[str, list] = {
+            "race_info": [],
+            "horse": [],
+            "jockey": [],
+            "trainer": [],
+            "entry": [],
+        }
+        # 複数レースに出る騎手、調教師などは1行にまとめる(1文のUPSERTで主キーが重複しないように)
+        horse_dict: dict[int, dict] = {}
+        jockey_dict: dict[int, dict] = {}
+        trainer_dict: dict[int, dict] = {}
+
+        for race_info_dict, horses_dict in race_card_list:
+            if not race_info_dict or race_info_dict.get("id") is None:
+                continue
+            dataset["race_info"].append(race_info_dict)
+
+            for horse in horses_dict.values():
+                if horse["horse_number"] is None or horse["horse_id"] is None:
+                    continue
+
+                horse_dict[horse["horse_id"]] = {"horse_id": horse["horse_id"], "horse_name": horse["horse_name"]}
+                if horse["jockey_id"] is not None:
+                    jockey_dict[horse["jockey_id"]] = {"jockey_id": horse["jockey_id"], "jockey_name": horse["jockey_name"]}
+                if horse["trainer_id"] is not None:
+                    trainer_dict[horse["trainer_id"]] = {"trainer_id": horse["trainer_id"], "trainer_name": horse["trainer_name"]}
+
+                dataset["entry"].append({
+                    "race_id": race_info_dict["id"],
+                    "horse_number": horse["horse_number"],
+                    "bracket_number": horse["waku_number"],
+                    "horse_id": horse["horse_id"],
+                    "basis_weight": horse["basis_weight"],
+                    "jockey_id": horse["jockey_id"],
+                    "trainer_id": horse["trainer_id"],
+                    "odds": horse["odds"],
+                    "popularity": int(horse["popularity"]) if horse["popularity"] is not None else None,
+                    "horse_weight": horse["horse_weight"],
+                    "horse_weight_diff": horse["horse_weight_diff"],
+                })
+
+        dataset["horse"] = list(horse_dict.values())
+        dataset["jockey"] = list(jockey_dict.values())
+        dataset["trainer"] = list(trainer_dict.values())
+        return dataset
+
+    @staticmethod
+    def parse_horse_weight(text: str) -> tuple[int, int | None] | None:
+        """
+        馬体重のセル("478(+2)", "478(0)", "478(前計不)" など)を(馬体重, 増減)に変換する。発表前は None
+        """
+        matches = re.search(r"(\d+)\s*(?:\(([+-]?\d+)\))?", text or "")
+        if not matches:
+            return None
+        return int(matches.group(1)), int(matches.group(2)) if matches.group(2) is not None else None
+
+    @staticmethod
+    def extract_race_id_from_url(url: str) -> int|None:
+        """
+        URLからrace_idを抽出する
+        """
+        matches = re.search(r"race_id=(\d+)", url)
+        if matches:
+            return int(matches.group(1))
+        return None
+
+    @staticmethod
+    def extract_kaisai_date_from_url(url: str) -> datetime.date | None:
+        """
+        URLからkaisai_dateを抽出する
+        """
+        matches = re.search(r"kaisai_date=([\d]{4})([\d]{2})([\d]{2})", url)
+        if matches:
+            return datetime.date(
+                year=int(matches.group(1)),
+                month=int(matches.group(2)),
+                day=int(matches.group(3))
+            )
+        return None
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import datetime
+from logging import Logger
+import os
+import shutil
+
+from sqlalchemy import Column, MetaData, String, Table, bindparam, delete, func, insert, not_, select, update
+
+from skylark.crud import SkylarkCrud
+from skylark.models import Base, Feature, FormFeature, OddsSnapshot, ParTime, RaceInfo, RaceResult, RaceSummary
+
+class SkylarkSnapshot:
+    """
+    分析用に全テーブルをSQLiteファイルへ書き出す
+    取り込み中のDBから1つの読み取りトランザクションで一貫した時点の内容を読み、
+    2回目以降は前回の最終開催日から days 日前以降のレースのみを差し替える
+    ただし -F などで過去のレースも計算し直す派生テーブルは毎回全件を差し替え、
+    基準タイムが変わった場合は過去のレースの自前のスピード指数も差し替える
+    一時ファイルに書き込んでから置き換えるため、読み手は常に完全なスナップショットを参照する
+    読み手は sqlite:///file:PATH?mode=ro&uri=true で開き、スナップショットに書き込まない
+    """
+
+    # 取り込み側の作業状態やスナップショット側で管理するため書き出さないテーブル
+    exclude_table_list = ("crawl_state_tbl", "schema_migration_tbl")
+
+    # 過去のレースの分も計算し直すため毎回全件を差し替えるテーブル
+    full_table_list = (Feature.__tablename__, FormFeature.__tablename__, ParTime.__tablename__)
+
+    # スナップショットのみに作成するテーブル
+    meta_table = Table(
+        "snapshot_meta_tbl",
+        MetaData(),
+        Column("name", String(64), primary_key=True),
+        Column("value", String(64))
+    )
+
+    def __init__(self, db_url: str, logger: Logger, days: int = 7, chunk_size: int = 10000):
+        self.db_url = db_url
+        self.logger = logger
+        # 結果の取り込みが遅れたレースを拾うため、前回の最終開催日から遡って差し替える日数
+        self.days = days
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def remove(filepath: str) -> None:
+        """
+        書きかけの一時ファイルを -wal, -shm ファイルとともに削除します。
+        """
+        for path in (filepath, filepath + "-wal", filepath + "-shm"):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    @staticmethod
+    def begin_snapshot(connection) -> None:
+        """
+        以降の読み取りが同じ時点の内容になるようにトランザクションを開始します。
+        """
+        dialect_name = connection.dialect.name
+        if dialect_name == "mysql":
+            connection.exec_driver_sql("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+        elif dialect_name == "sqlite":
+            connection.exec_driver_sql("BEGIN")
+
+    @staticmethod
+    def make_condition(table: Table, since: datetime.date | None):
+        """
+        差し替える行の条件を返します。None の場合はテーブル全体を差し替えます。
+        """
+        if since is None or table.name in SkylarkSnapshot.full_table_list:
+            return None
+
+        if table.name == RaceInfo.__tablename__:
+            return table.c.date >= since
+        if table.name == OddsSnapshot.__tablename__:
+            return table.c.fetched_at >= datetime.datetime.combine(since, datetime.time())
+        if "race_id" in table.c and any(
+            foreign_key.column.table.name == RaceInfo.__tablename__ for foreign_key in table.c.race_id.foreign_keys
+        ):
+            return table.c.race_id.in_(select(RaceInfo.id).where(RaceInfo.date >= since))
+        return None
+
+    @staticmethod
+    def read_par_times(connection) -> list:
+        return connection.execute(select(ParTime.__table__).order_by(*ParTime.__table__.primary_key.columns)).all()
+
+    def copy_speed_figures(self, source_connection, target_connection, since: datetime.date) -> None:
+        """
+        差し替えなかったレースの自前のスピード指数を書き写します。
+        """
+        result_table = RaceResult.__table__
+        condition = self.make_condition(result_table, since)
+        result = source_connection.execution_options(yield_per=self.chunk_size).execute(
+            select(result_table.c.race_id, result_table.c.horse_number, result_table.c.computed_speed_figure)
+            .where(not_(condition))
+        )
+
+        stmt = (
+            update(result_table)
+            .where(result_table.c.race_id == bindparam("key_race_id"), result_table.c.horse_number == bindparam("key_horse_number"))
+            .values(computed_speed_figure=bindparam("value_computed_speed_figure"))
+        )
+        count = 0
+        for rows in result.partitions():
+            target_connection.execute(stmt, [
+                {"key_race_id": race_id, "key_horse_number": horse_number, "value_computed_speed_figure": figure}
+                for race_id, horse_number, figure in rows
+            ])
+            count += len(rows)
+        self.logger.info("snapshot: %s.computed_speed_figure, %d rows", result_table.name, count)
+
+    def get_since(self, connection) -> datetime.date | None:
+        value = connection.execute(
+            select(self.meta_table.c.value).where(self.meta_table.c.name == "max_race_date")
+        ).scalar()
+        if value is None:
+            return None
+        return datetime.date.fromisoformat(value) - datetime.timedelta(days=self.days)
+
+    def export(self, filepath: str, rebuild: bool = False) -> None:
+        """
+        スナップショットを作成または差分更新します。rebuild の場合は全件を書き出します。
+        """
+        filepath = os.path.abspath(filepath)
+        temp_filepath = filepath + ".tmp"
+        self.remove(temp_filepath)
+        if rebuild == False and os.path.isfile(filepath):
+            shutil.copyfile(filepath, temp_filepath)
+
+        table_list = [table for table in Base.metadata.sorted_tables if table.name not in self.exclude_table_list]
+
+        target_crud = SkylarkCrud("sqlite:///" + temp_filepath, logger=self.logger, shared=False)
+        source_crud = SkylarkCrud(self.db_url, logger=self.logger, shared=False)
+        try:
+            target_crud.create_tables()
+            target_crud.migrate()
+            self.meta_table.create(target_crud.engine, checkfirst=True)
+
+            with source_crud.engine.connect() as source_connection, target_crud.engine.begin() as target_connection:
+                self.begin_snapshot(source_connection)
+
+                since = self.get_since(target_connection)
+                self.logger.info("snapshot: %s", "all races" if since is None else f"races since {since}")
+
+                # 結果が取り込まれた最終開催日(出馬表のみの先のレースは含めない)
+                max_race_date = source_connection.execute(
+                    select(func.max(RaceInfo.date)).join(RaceSummary, RaceSummary.race_id == RaceInfo.id)
+                ).scalar()
+
+                # 基準タイムが変わった場合は差し替えないレースの指数も計算し直されている
+                par_time_changed = since is not None and (
+                    self.read_par_times(source_connection) != self.read_par_times(target_connection)
+                )
+
+                # 子テーブルから削除し、親テーブルから書き込む
+                for table in reversed(table_list):
+                    condition = self.make_condition(table, since)
+                    target_connection.execute(delete(table) if condition is None else delete(table).where(condition))
+
+                for table in table_list:
+                    condition = self.make_condition(table, since)
+                    result = source_connection.execution_options(yield_per=self.chunk_size).execute(
+                        select(table) if condition is None else select(table).where(condition)
+                    )
+                    count = 0
+                    for rows in result.mappings().partitions():
+                        target_connection.execute(insert(table), [dict(row) for row in rows])
+                        count += len(rows)
+                    self.logger.info("snapshot: %s, %d rows", table.name, count)
+
+                if par_time_changed == True:
+                    self.copy_speed_figures(source_connection, target_connection, since)
+
+                target_connection.execute(delete(self.meta_table))
+                target_connection.execute(insert(self.meta_table), [
+                    {"name": "max_race_date", "value": max_race_date.isoformat() if max_race_date is not None else None},
+                    {"name": "exported_at", "value": datetime.datetime.now().isoformat(timespec="seconds")},
+                ])
+
+                source_connection.rollback()
+
+            # 読み手が -wal ファイルなしで開けるように1ファイルに戻す(他の接続があると変更できないため接続を破棄してから行う)
+            target_crud.engine.dispose()
+            with target_crud.engine.connect() as connection:
+                connection.exec_driver_sql("PRAGMA optimize")
+                connection.exec_driver_sql("PRAGMA journal_mode=DELETE")
+        except Exception as ex:
+            target_crud.close()
+            self.remove(temp_filepath)
+            raise ex
+        finally:
+            target_crud.close()
+            source_crud.close()
+
+        # 古いファイルの -wal, -shm が残っていると置き換えたファイルに適用されるため削除する
+        for path in (filepath + "-wal", filepath + "-shm"):
+            if os.path.isfile(path):
+                os.remove(path)
+        os.replace(temp_filepath, filepath)
+        self.logger.info("snapshot: %s, max race date %s", filepath, max_race_date)
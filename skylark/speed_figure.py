@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from logging import Logger
+
+from sqlalchemy import and_, bindparam, delete, func, select, update
+
+from skylark.crud import SkylarkCrud
+from skylark.models import ParTime, RaceInfo, RaceResult
+
+class SkylarkSpeedFigure:
+    """
+    走破タイムから自前のスピード指数を計算する
+    競馬場、馬場、距離、馬場状態ごとの基準タイムを集計し、
+    指数 = 80 + (基準タイム - 走破タイム) x 1000 / 基準タイム + (斤量 - 55) x 2
+    基準タイムは毎回全件を1回のGROUP BYで集計し直し(再取り込みで二重に数えないため)、指数は未計算の行のみ計算する
+    基準タイムが変わった条件の行は指数を計算し直す(計算した時期によって同じ走破タイムの指数が変わらないように)
+    """
+
+    # 基準タイムに必要な件数(満たない場合は条件を緩めた集計を使う)
+    min_count: int = 30
+
+    def __init__(self, logger: Logger):
+        self.logger = logger
+
+    @staticmethod
+    def place_code():
+        return (RaceResult.race_id // 1000000) % 100
+
+    def update(self, db_crud: SkylarkCrud, rebuild: bool = False) -> None:
+        with db_crud.session() as session:
+            try:
+                if rebuild == True:
+                    session.execute(delete(ParTime))
+                    session.execute(update(RaceResult).values(computed_speed_figure=None))
+
+                self.aggregate(session, db_crud)
+                self.resolve(session, db_crud)
+                result = self.apply(session)
+                session.commit()
+            except Exception as ex:
+                session.rollback()
+                raise ex
+
+        self.logger.info("speed figure: %d results updated", result)
+
+    def aggregate(self, session, db_crud: SkylarkCrud) -> None:
+        """
+        全件の走破タイムを条件ごとに1回のGROUP BYで集計し、基準タイムの集計を置き換えます。
+        """
+        key_columns = [
+            self.place_code().label("place_code"),
+            func.coalesce(RaceInfo.track_surface, "").label("track_surface"),
+            RaceInfo.distance.label("distance"),
+            func.coalesce(RaceInfo.track_condition, "").label("track_condition"),
+        ]
+        rows = session.execute(
+            select(*key_columns, func.sum(RaceResult.finishing_time_sec), func.count())
+            .join(RaceInfo, RaceResult.race_id == RaceInfo.id)
+            .where(RaceResult.finishing_time_sec.isnot(None))
+            .group_by(*[column.name for column in key_columns])
+        ).all()
+
+        par_list = {
+            (par.place_code, par.track_surface, par.distance, par.track_condition): par
+            for par in session.query(ParTime).all()
+        }
+
+        dataset_list = []
+        for place_code, track_surface, distance, track_condition, time_sum, time_count in rows:
+            key = (int(place_code), track_surface, distance, track_condition)
+            par = par_list.pop(key, None)
+            if par is not None and par.time_sum == time_sum and par.time_count == time_count:
+                continue
+            dataset_list.append({
+                "place_code": key[0],
+                "track_surface": track_surface,
+                "distance": distance,
+                "track_condition": track_condition,
+                "time_sum": time_sum,
+                "time_count": time_count,
+                "par_time": par.par_time if par is not None else None,
+            })
+
+        # 結果がなくなった条件
+        for par in par_list.values():
+            session.delete(par)
+
+        db_crud.upsert_rows(session, ParTime, dataset_list)
+        session.flush()
+        self.logger.info("speed figure: %d par time keys aggregated", len(dataset_list))
+
+    def resolve(self, session, db_crud: SkylarkCrud) -> None:
+        """
+        件数の少ない条件は (競馬場, 馬場, 距離) -> (馬場, 距離, 馬場状態) -> (馬場, 距離) の順に条件を緩めて基準タイムを決めます。
+        基準タイムが変わった条件の計算済みの指数は NULL に戻します。
+        """
+        par_list = session.query(ParTime).all()
+
+        levels = [
+            lambda par: (par.place_code, par.track_surface, par.distance, par.track_condition),
+            lambda par: (par.place_code, par.track_surface, par.distance),
+            lambda par: (par.track_surface, par.distance, par.track_condition),
+            lambda par: (par.track_surface, par.distance),
+        ]
+        totals: list[dict] = []
+        for level in levels:
+            total: dict = {}
+            for par in par_list:
+                time_sum, time_count = total.get(level(par), (0.0, 0))
+                total[level(par)] = (time_sum + par.time_sum, time_count + par.time_count)
+            totals.append(total)
+
+        dataset_list = []
+        # 計算済みの指数を計算し直す条件
+        par_changed_list: list[dict] = []
+        for par in par_list:
+            par_time = None
+            for level, total in zip(levels, totals):
+                time_sum, time_count = total[level(par)]
+                if time_count >= self.min_count or level is levels[-1]:
+                    par_time = time_sum / time_count
+                    break
+
+            if par.par_time != par_time:
+                if par.par_time is not None:
+                    par_changed_list.append({
+                        "place_code": par.place_code,
+                        "track_surface": par.track_surface,
+                        "distance": par.distance,
+                        "track_condition": par.track_condition,
+                    })
+                dataset_list.append({
+                    "place_code": par.place_code,
+                    "track_surface": par.track_surface,
+                    "distance": par.distance,
+                    "track_condition": par.track_condition,
+                    "time_sum": par.time_sum,
+                    "time_count": par.time_count,
+                    "par_time": par_time,
+                })
+
+        db_crud.upsert_rows(session, ParTime, dataset_list)
+        session.flush()
+        self.reset(session, par_changed_list)
+
+    def reset(self, session, par_list: list[dict]) -> None:
+        """
+        基準タイムが変わった条件の行の指数を NULL に戻し、apply で計算し直す対象にします。
+        """
+        if len(par_list) == 0:
+            return
+
+        info = RaceInfo.__table__
+        result = RaceResult.__table__
+        count = session.execute(
+            update(result)
+            .where(
+                self.place_code() == bindparam("key_place_code"),
+                result.c.computed_speed_figure.isnot(None),
+                result.c.race_id.in_(
+                    select(info.c.id).where(
+                        func.coalesce(info.c.track_surface, "") == bindparam("key_track_surface"),
+                        info.c.distance == bindparam("key_distance"),
+                        func.coalesce(info.c.track_condition, "") == bindparam("key_track_condition")
+                    )
+                )
+            )
+            .values(computed_speed_figure=None)
+            .execution_options(synchronize_session=False),
+            [{"key_" + key: dataset[key] for key in ("place_code", "track_surface", "distance", "track_condition")} for dataset in par_list]
+        ).rowcount
+        self.logger.info("speed figure: %d par times changed, %d results reset", len(par_list), count)
+
+    def apply(self, session) -> int:
+        """
+        未計算の行のスピード指数を1回のUPDATEで計算します。
+        """
+        par = ParTime.__table__
+        info = RaceInfo.__table__
+        result = RaceResult.__table__
+
+        figure = (
+            select(
+                80
+                + (par.c.par_time - result.c.finishing_time_sec) * 1000.0 / par.c.par_time
+                + (result.c.basis_weight - 55) * 2
+            )
+            .select_from(info.join(par, and_(
+                par.c.place_code == self.place_code(),
+                par.c.track_surface == func.coalesce(info.c.track_surface, ""),
+                par.c.distance == info.c.distance,
+                par.c.track_condition == func.coalesce(info.c.track_condition, "")
+            )))
+            .where(info.c.id == result.c.race_id)
+            .scalar_subquery()
+        )
+
+        return session.execute(
+            update(result)
+            .where(result.c.computed_speed_figure.is_(None), result.c.finishing_time_sec.isnot(None))
+            .values(computed_speed_figure=figure)
+        ).rowcount
@@ -5,6 +5,10 @@
 # This software is released under the MIT License.
 #
 
+import datetime
+import os
+import re
+
 class SkylarkUtil:
     ticket_type_list = (
         "単勝",
@@ -26,6 +30,28 @@ class SkylarkUtil:
         "新馬"
     )
 
+    # 距離区分の上限(未満)
+    distance_band_list = (
+        1400,  # 短距離
+        1800,  # マイル
+        2200,  # 中距離
+        2800,  # 中長距離
+    )
+
+    # 着差 -> 馬身
+    margin_length_list = {
+        "同着": 0.0,
+        "ハナ": 0.05,
+        "アタマ": 0.1,
+        "クビ": 0.25,
+        "大": 10.0,
+    }
+
+    # 組番のエンコード(1頭5ビット x 3頭、順序ありは15ビット目を立てる)
+    combination_bits = 5
+    combination_mask = (1 << 5) - 1
+    combination_ordered_flag = 1 << 15
+
     @staticmethod
     def convertToTicketType2Int(strings):
         return SkylarkUtil.ticket_type_list.index(strings)
@@ -39,3 +65,173 @@ class SkylarkUtil:
             count += 1
 
         return count  # 未分類は最後の値を返す
+
+    @staticmethod
+    def convertToDistanceBand(distance):
+        count = 0
+        for value in SkylarkUtil.distance_band_list:
+            if distance < value:
+                return count
+            count += 1
+
+        return count  # 長距離は最後の値を返す
+
+    @staticmethod
+    def getDatabaseUrl(sqlite_path=None):
+        """
+        DB接続URLを返します。SQLiteのファイル、環境変数 DATABASE_URL、環境変数 MYSQL_* の順に使います。
+        """
+        if sqlite_path:
+            return "sqlite:///" + os.path.abspath(sqlite_path)
+
+        database_url = os.getenv("DATABASE_URL")
+        if database_url:
+            return database_url
+
+        db_config: dict = {
+            "protocol": "mysql+pymysql",
+            "username": os.getenv("MYSQL_USERNAME","skylark"),
+            "password": os.getenv("MYSQL_PASSWORD","skylarkpw!"),
+            "hostname": os.getenv("MYSQL_HOSTNAME","localhost"),
+            "port"    : int(os.getenv("MYSQL_PORT", 3306)),
+            "dbname"  : os.getenv("MYSQL_DATABASE","skylark"),
+            "charset" : "utf8mb4"
+        }
+
+        return "{protocol:s}://{username:s}:{password:s}@{hostname:s}:{port:d}/{dbname:s}?charset={charset:s}".\
+            format(**db_config)
+
+    @staticmethod
+    def parseShard(strings):
+        """
+        "K/N" を (K, N) に変換します。Kは1からNまで
+        """
+        shard_index, shard_count = [int(value) for value in strings.split("/", 1)]
+        if shard_count < 1 or shard_index < 1 or shard_index > shard_count:
+            raise ValueError(strings)
+
+        return (shard_index, shard_count)
+
+    @staticmethod
+    def encodeCombination(strings):
+        """
+        "3", "3-7", "3->7->1" の組番を整数に変換します。順序なしの組番は昇順に並べてから詰めます。
+        """
+        horse_numbers = [int(value) for value in re.split(r"->|-", strings.replace(" ", "")) if value != ""]
+        return SkylarkUtil.encodeHorseNumbers(horse_numbers, "->" in strings)
+
+    @staticmethod
+    def encodeHorseNumbers(horse_numbers, ordered=False):
+        """
+        馬番(枠番)のリストを組番の整数に変換します。
+        """
+        if len(horse_numbers) == 0 or len(horse_numbers) > 3:
+            raise ValueError(horse_numbers)
+        if ordered == False:
+            horse_numbers = sorted(horse_numbers)
+
+        key = 0
+        for idx, horse_number in enumerate(horse_numbers):
+            if horse_number < 1 or horse_number > SkylarkUtil.combination_mask:
+                raise ValueError(horse_numbers)
+            key |= horse_number << (SkylarkUtil.combination_bits * idx)
+
+        if ordered == True:
+            key |= SkylarkUtil.combination_ordered_flag
+        return key
+
+    @staticmethod
+    def decodeCombination(key):
+        """
+        encodeCombination の値を (馬番のタプル, 順序あり) に戻します。
+        """
+        horse_numbers = []
+        for idx in range(3):
+            horse_number = (key >> (SkylarkUtil.combination_bits * idx)) & SkylarkUtil.combination_mask
+            if horse_number == 0:
+                break
+            horse_numbers.append(horse_number)
+
+        return (tuple(horse_numbers), (key & SkylarkUtil.combination_ordered_flag) != 0)
+
+    @staticmethod
+    def parsePassingRank(strings):
+        """
+        通過順位 "3-3-2-1" をコーナーごとの順位のリストに変換します。解析できない場合は空のリスト
+        """
+        if strings is None or strings == "":
+            return []
+
+        try:
+            return [int(value) for value in str(strings).split("-")]
+        except ValueError:
+            return []
+
+    @staticmethod
+    def parseCorners(strings):
+        """
+        通過順位を (1コーナー, 2コーナー, 3コーナー, 4コーナー) に変換します。
+        コーナーが4つより少ないコースでは最後の値を4コーナーに揃えます。
+        """
+        passing_rank = SkylarkUtil.parsePassingRank(strings)[-4:]
+        return tuple([None] * (4 - len(passing_rank)) + passing_rank)
+
+    @staticmethod
+    def parseFinishingTime(value):
+        """
+        走破タイム("2:32.2", "00:2:32.2", time, timedelta)を秒に変換します。
+        """
+        if value is None:
+            return None
+        if isinstance(value, datetime.timedelta):
+            return round(value.total_seconds(), 1)
+        if isinstance(value, datetime.time):
+            return round(value.hour * 3600 + value.minute * 60 + value.second + value.microsecond / 1000000, 1)
+
+        matchese = re.match(r"^(?:(\d+):)?(\d+):(\d+(?:\.\d+)?)$", str(value).strip())
+        if not matchese:
+            return None
+        return round(int(matchese.group(1) or 0) * 3600 + int(matchese.group(2)) * 60 + float(matchese.group(3)), 1)
+
+    @staticmethod
+    def parsePostTime(strings):
+        """
+        発走時刻("15:40")を time に変換します。
+        """
+        if strings is None:
+            return None
+        hour, minute = [int(value) for value in str(strings).split(":", 1)]
+        return datetime.time(hour, minute)
+
+    @staticmethod
+    def convertToTime(seconds):
+        """
+        秒を time に変換します。(走破タイムを TIME 列に保存するため)
+        """
+        if seconds is None:
+            return None
+        return (datetime.datetime.min + datetime.timedelta(microseconds=round(seconds * 1000000))).time()
+
+    @staticmethod
+    def parseMargin(strings):
+        """
+        着差("クビ", "1/2", "1.1/4", "3" など)を馬身に変換します。
+        空欄(1着、取消、中止など)は None (1着の0は呼び出し側で設定)
+        """
+        if strings is None:
+            return None
+
+        strings = str(strings).strip()
+        if strings == "":
+            return None
+        if strings in SkylarkUtil.margin_length_list:
+            return SkylarkUtil.margin_length_list[strings]
+
+        matchese = re.match(r"^(?:(\d+)\.)?(?:(\d+)/(\d+))?$|^(\d+)$", strings)
+        if not matchese:
+            return None
+        if matchese.group(4) is not None:
+            return float(matchese.group(4))
+        if matchese.group(2) is None:
+            return None
+        return int(matchese.group(1) or 0) + int(matchese.group(2)) / int(matchese.group(3))
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import logging
+
+import pytest
+
+from skylark.crud import SkylarkCrud
+
+@pytest.fixture
+def db_crud():
+    """
+    テーブルを作成したメモリ上の SQLite
+    """
+    db_crud = SkylarkCrud("sqlite://", logger=logging.getLogger(__name__), shared=False)
+    db_crud.create_tables()
+    db_crud.migrate()
+    yield db_crud
+    db_crud.close()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import datetime
+
+from sqlalchemy import insert
+
+from skylark.models import RaceInfo, RaceResult
+
+# テスト用のレース情報、レース結果の行(必須の列のみ、残りは values で指定)
+
+def make_race_info(race_id: int, date: datetime.date = datetime.date(2025, 1, 5), **values) -> dict:
+    return {
+        "id": race_id,
+        "race_name": "race",
+        "distance": 1600,
+        "post_time": datetime.time(15, 40),
+        "race_number": race_id % 100,
+        "track_surface": "芝",
+        "track_condition": "良",
+        "date": date,
+        "place_detail": "1回中山1日目",
+        "race_class": "",
+    } | values
+
+def make_race_result(race_id: int, horse_number: int = 1, **values) -> dict:
+    return {
+        "race_id": race_id,
+        "horse_number": horse_number,
+        "bracket_number": horse_number,
+        "horse_id": race_id * 100 + horse_number,
+        "sex": "牡",
+        "age": 3,
+        "basis_weight": 55.0,
+        "jockey_id": 1,
+        "margin": "",
+        "passing_rank": "",
+        "stable": "",
+        "trainer_id": 1,
+        "owner_id": "1",
+        "order_of_finish": horse_number,
+    } | values
+
+def insert_races(db_crud, race_ids: list[int], finishing_time_sec: float,
+                 date: datetime.date = datetime.date(2025, 1, 5)) -> None:
+    """
+    1頭立てのレースを同じ条件(中山 芝1600 良)で追加する
+    """
+    with db_crud.engine.begin() as connection:
+        connection.execute(insert(RaceInfo), [make_race_info(race_id, date) for race_id in race_ids])
+        connection.execute(insert(RaceResult), [
+            make_race_result(race_id, horse_id=race_id, finishing_time_sec=finishing_time_sec) for race_id in race_ids
+        ])
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from argparse import Namespace
+import datetime
+import logging
+
+import pytest
+from sqlalchemy import select, update
+
+from skylark.backfill import SkylarkBackfill
+from skylark.crud import SkylarkCrud
+from skylark.models import RaceInfo, RaceResult
+from tests.dataset import make_race_info, make_race_result
+
+@pytest.mark.parametrize("value", [
+    "plain",
+    "tab\there",
+    "line\nbreak\r\n",
+    "back\\slash\\t",
+    "\\N",
+    "",
+    "日本語",
+])
+def test_escape_round_trip(value):
+    escaped = SkylarkBackfill.escape(value)
+    assert "\t" not in escaped and "\n" not in escaped
+    assert SkylarkBackfill.unescape(escaped) == value
+
+def test_escape_null_and_json():
+    assert SkylarkBackfill.escape(None) == "\\N"
+    assert SkylarkBackfill.unescape("\\N") is None
+    assert SkylarkBackfill.escape({"b": 1, "a": "\t"}) == '{"a": "\\\\t", "b": 1}'
+
+def test_convert():
+    columns = RaceInfo.__table__.c
+    assert SkylarkBackfill.convert(columns.id, "202506010101") == 202506010101
+    assert SkylarkBackfill.convert(columns.date, "2025-01-05") == datetime.date(2025, 1, 5)
+    assert SkylarkBackfill.convert(columns.post_time, "15:40") == datetime.time(15, 40)
+    assert SkylarkBackfill.convert(RaceResult.__table__.c.finishing_time, "00:02:32.2") == datetime.time(0, 2, 32, 200000)
+    assert SkylarkBackfill.convert(RaceResult.__table__.c.basis_weight, "55.5") == 55.5
+    assert SkylarkBackfill.convert(columns.race_name, None) is None
+
+def make_dataset(race_id: int, race_name: str) -> dict:
+    return {
+        "race_info": make_race_info(race_id, race_name=race_name),
+        "horse": [{"horse_id": race_id * 100 + 1, "horse_name": "horse\tname"}],
+        "jockey": [{"jockey_id": 1, "jockey_name": "jockey"}],
+        "trainer": [{"trainer_id": 1, "trainer_name": "trainer"}],
+        "owner": [{"owner_id": "1", "owner_name": "owner"}],
+        "result": [make_race_result(race_id, finishing_time_sec=96.5)],
+        "payoff": [],
+        "summary": None,
+    }
+
+def test_merge_and_load(tmp_path):
+    """
+    シャードのTSVをまとめてロードし、再ロードでは更新のみ行い計算済みの列は残すこと
+    """
+    logger = logging.getLogger(__name__)
+    db_url = f"sqlite:///{tmp_path / 'skylark.db'}"
+    db_crud = SkylarkCrud(db_url, logger=logger, shared=False)
+    db_crud.create_tables()
+    db_crud.migrate()
+
+    args = Namespace(temp=str(tmp_path))
+    with SkylarkBackfill(db_url, args, logger, directory=str(tmp_path / "shard-1-of-2" / "backfill")) as shard:
+        shard.write(make_dataset(202506010101, "first"))
+    with SkylarkBackfill(db_url, args, logger, directory=str(tmp_path / "shard-2-of-2" / "backfill")) as shard:
+        shard.write(make_dataset(202506010102, "second"))
+
+    backfill = SkylarkBackfill(db_url, args, logger)
+    backfill.merge(str(tmp_path / "shard-1-of-2" / "backfill"))
+    backfill.merge(str(tmp_path / "shard-2-of-2" / "backfill"))
+    assert SkylarkBackfill.read_race_ids(backfill.directory) == {202506010101, 202506010102}
+    backfill.load()
+
+    try:
+        with db_crud.engine.begin() as connection:
+            assert connection.execute(select(RaceInfo.id, RaceInfo.race_name).order_by(RaceInfo.id)).all() == [
+                (202506010101, "first"),
+                (202506010102, "second"),
+            ]
+            connection.execute(update(RaceResult).values(computed_speed_figure=80.0))
+
+        backfill.write(make_dataset(202506010101, "renamed"))
+        backfill.load()
+
+        with db_crud.engine.connect() as connection:
+            assert connection.execute(select(RaceInfo.race_name).where(RaceInfo.id == 202506010101)).scalar_one() == "renamed"
+            assert connection.execute(
+                select(RaceResult.race_id, RaceResult.finishing_time_sec, RaceResult.computed_speed_figure).order_by(RaceResult.race_id)
+            ).all() == [(202506010101, 96.5, 80.0), (202506010102, 96.5, 80.0)]
+    finally:
+        db_crud.close()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from argparse import Namespace
+import datetime
+import logging
+
+import pytest
+from sqlalchemy import insert
+
+from skylark.backtest import SkylarkBacktest
+from skylark.models import Payoff, RaceInfo, RaceResult
+from skylark.util import SkylarkUtil
+from tests.dataset import make_race_info, make_race_result
+
+@pytest.fixture
+def backtest(db_crud):
+    """
+    3頭立て2レース(人気順は馬番順)
+    1レース目: 1番人気が1着、単勝250円、馬連1-2が500円
+    2レース目: 2番人気が1着、単勝400円、馬連の発売なし
+    """
+    win = SkylarkUtil.convertToTicketType2Int("単勝")
+    quinella = SkylarkUtil.convertToTicketType2Int("馬連")
+
+    with db_crud.engine.begin() as connection:
+        connection.execute(insert(RaceInfo), [
+            make_race_info(202506010101, datetime.date(2025, 1, 5)),
+            make_race_info(202506010201, datetime.date(2025, 1, 6)),
+        ])
+        connection.execute(insert(RaceResult), [
+            make_race_result(race_id, horse_number, popularity=horse_number, odds=float(horse_number * 2))
+            for race_id in (202506010101, 202506010201)
+            for horse_number in (1, 2, 3)
+        ])
+        connection.execute(insert(Payoff), [
+            {"race_id": 202506010101, "ticket_type": win, "horse_numbers": "1", "payoff": 250, "popularity": 1},
+            {"race_id": 202506010101, "ticket_type": quinella, "horse_numbers": "1 - 2", "payoff": 500, "popularity": 1},
+            {"race_id": 202506010201, "ticket_type": win, "horse_numbers": "2", "payoff": 400, "popularity": 2},
+        ])
+
+    backtest = SkylarkBacktest(Namespace(box_max=3, min_bets=1), logging.getLogger(__name__))
+    backtest.load(db_crud)
+    return backtest
+
+@pytest.mark.parametrize("ticket_type, box, returns, cost", [
+    ("単勝", 1, [250.0, 0.0], [100.0, 100.0]),
+    ("単勝", 2, [250.0, 400.0], [200.0, 200.0]),
+    ("馬連", 2, [500.0, 0.0], [100.0, 0.0]),
+    ("馬連", 3, [500.0, 0.0], [300.0, 0.0]),
+    ("三連単", 3, [0.0, 0.0], [0.0, 0.0]),
+])
+def test_evaluate(backtest, ticket_type, box, returns, cost):
+    result = backtest.evaluate(SkylarkUtil.convertToTicketType2Int(ticket_type), box)
+    assert result[0].tolist() == returns
+    assert result[1].tolist() == cost
+
+def test_sweep_roi(backtest):
+    result_list = backtest.sweep()
+    result = {
+        (result["ticket_type"], result["box"], result["odds_low"], result["odds_high"]): result
+        for result in result_list
+    }
+
+    # 予想1位の単勝オッズはどちらも2.0
+    win = result[("単勝", 1, 1.0, float("inf"))]
+    assert (win["bets"], win["hit_rate"], win["roi"], win["profit"]) == (2, 0.5, 1.25, 50.0)
+    assert win["max_drawdown"] == 100.0
+    assert ("単勝", 1, 1.0, 2.0) not in result
+
+    quinella = result[("馬連", 2, 2.0, 3.0)]
+    assert (quinella["bets"], quinella["roi"]) == (1, 5.0)
+
+    assert [result["roi"] for result in result_list] == sorted([result["roi"] for result in result_list], reverse=True)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import logging
+
+from skylark import cache as cache_module
+from skylark.cache import SkylarkCache
+
+def test_expired_entries_and_locks_are_removed(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, "time", lambda: now[0])
+    cache = SkylarkCache(logging.getLogger(__name__))
+
+    assert cache.get_or_fetch("odds", 1, lambda: {1: (2.5, 1)}) == {1: (2.5, 1)}
+    assert cache.get_or_fetch("race_information", 1, lambda: "card") == "card"
+    assert len(cache.fetch_locks) == 0
+
+    # オッズのみ期限切れ
+    now[0] += cache.ttl["odds"] + 1
+    assert cache.get("odds", 1) == (False, None)
+    assert cache.get("race_information", 1) == (True, "card")
+    assert list(cache.entries) == [("race_information", "1")]
+
+    assert cache.get_or_fetch("odds", 1, lambda: {1: (3.0, 2)}) == {1: (3.0, 2)}
+
+def test_entries_are_capped_by_lru():
+    cache = SkylarkCache(logging.getLogger(__name__), maxsize=2)
+    cache.set("race_information", 1, "a")
+    cache.set("race_information", 2, "b")
+    assert cache.get("race_information", 1) == (True, "a")
+
+    cache.set("race_information", 3, "c")
+    assert list(cache.entries) == [("race_information", "1"), ("race_information", "3")]
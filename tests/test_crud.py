@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from tests.dataset import insert_races
+
+def test_get_ingested_race_ids(db_crud):
+    """
+    結果が保存済みのレースのみを、チャンクをまたいでも漏れなく返すこと
+    """
+    insert_races(db_crud, [202006010101, 202206010101, 202506010101], 100.0)
+
+    race_ids = [202006010101, 202106010101, 202206010101, 202406010101, 202506010101]
+    assert db_crud.get_ingested_race_ids(race_ids, chunk_size=2) == {202006010101, 202206010101, 202506010101}
+    assert db_crud.get_ingested_race_ids([]) == set()
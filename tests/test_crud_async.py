@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import asyncio
+import datetime
+import logging
+
+from sqlalchemy import insert, select, update
+
+from skylark.crud_async import SkylarkCrudAsync
+from skylark.models import Base, CrawlState, RaceInfo, RaceResult
+
+def run(coroutine_function):
+    """
+    メモリ上の SQLite(aiosqlite)にテーブルを作成して coroutine_function(db_crud) を実行する
+    """
+    async def main():
+        db_crud = SkylarkCrudAsync("sqlite+aiosqlite://", logger=logging.getLogger(__name__))
+        try:
+            async with db_crud.engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+            return await coroutine_function(db_crud)
+        finally:
+            await db_crud.dispose()
+
+    return asyncio.run(main())
+
+def make_race(race_name: str) -> dict:
+    return {
+        "dataset_info": {
+            "id": 202506010101,
+            "race_name": race_name,
+            "distance": 1600,
+            "post_time": datetime.time(15, 40),
+            "race_number": 1,
+            "date": datetime.date(2025, 1, 5),
+            "place_detail": "1回中山1日目",
+            "race_class": "",
+        },
+        "dataset_horse": [{"horse_id": 1, "horse_name": "horse"}],
+        "dataset_jockey": [{"jockey_id": 1, "jockey_name": "jockey"}],
+        "dataset_trainer": [{"trainer_id": 1, "trainer_name": "trainer"}],
+        "dataset_owner": [{"owner_id": "1", "owner_name": "owner"}],
+        "dataset_result": [{
+            "race_id": 202506010101,
+            "horse_number": 1,
+            "bracket_number": 1,
+            "horse_id": 1,
+            "sex": "牡",
+            "age": 3,
+            "basis_weight": 55.0,
+            "jockey_id": 1,
+            "margin": "",
+            "passing_rank": "",
+            "stable": "",
+            "trainer_id": 1,
+            "owner_id": "1",
+            "order_of_finish": 1,
+        }],
+        "dataset_payoff": [],
+    }
+
+def test_upsert_race_keeps_computed_speed_figure():
+    """
+    再取り込みでレース情報を更新し、計算済みのスピード指数は残すこと
+    """
+    async def main(db_crud: SkylarkCrudAsync):
+        await db_crud.upsert_race(**make_race("before"))
+        async with db_crud.engine.begin() as connection:
+            await connection.execute(update(RaceResult).values(computed_speed_figure=80.0))
+
+        await db_crud.upsert_race(**make_race("after"))
+        async with db_crud.engine.connect() as connection:
+            race_name = (await connection.execute(select(RaceInfo.race_name))).scalar_one()
+            figure = (await connection.execute(select(RaceResult.computed_speed_figure))).scalar_one()
+        return race_name, figure
+
+    assert run(main) == ("after", 80.0)
+
+def test_claim_crawl_races():
+    """
+    未取得と再試行可能なレースのみを、重複なく limit 件ずつ取得中にすること
+    """
+    async def main(db_crud: SkylarkCrudAsync):
+        async with db_crud.engine.begin() as connection:
+            await connection.execute(insert(CrawlState), [
+                {"race_id": 1, "status": "pending", "attempts": 0},
+                {"race_id": 2, "status": "failed", "attempts": 1},
+                {"race_id": 3, "status": "failed", "attempts": 3},
+                {"race_id": 4, "status": "done", "attempts": 1},
+                {"race_id": 5, "status": "pending", "attempts": 0},
+            ])
+
+        claimed = [
+            await db_crud.claim_crawl_races(limit=2, max_attempts=3),
+            await db_crud.claim_crawl_races(limit=2, max_attempts=3),
+            await db_crud.claim_crawl_races(limit=2, max_attempts=3),
+        ]
+        await db_crud.update_crawl_race(1, "done")
+
+        async with db_crud.engine.connect() as connection:
+            states = (await connection.execute(
+                select(CrawlState.race_id, CrawlState.status, CrawlState.attempts).order_by(CrawlState.race_id)
+            )).all()
+        return claimed, states
+
+    claimed, states = run(main)
+    assert claimed == [[1, 2], [5], []]
+    assert states == [(1, "done", 1), (2, "claimed", 2), (3, "failed", 3), (4, "done", 1), (5, "claimed", 1)]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import datetime
+
+from skylark.models import RaceResult
+
+def test_feature_queries_use_idx_horse_date(db_crud):
+    """
+    特徴量計算のクエリが race_result_tbl を idx_horse_date で検索すること
+    """
+    plans = db_crud.explain_feature_queries(horse_id=2019104308, date=datetime.date(2024, 1, 1), distance=1600)
+    assert set(plans) == {"speed_figure", "winner", "disavesr", "distance", "earning_money"}
+
+    for name, plan in plans.items():
+        details = [row["detail"] for row in plan if RaceResult.__tablename__ in row["detail"]]
+        assert len(details) == 1, (name, details)
+        assert details[0].startswith(f"SEARCH {RaceResult.__tablename__} USING ")
+        assert "INDEX idx_horse_date (horse_id=? AND race_date<?)" in details[0], (name, details)
+
+    # 指数はインデックスのみで読めること(COALESCE(speed_figure, computed_speed_figure))
+    details = [row["detail"] for row in plans["speed_figure"]]
+    assert details[0].startswith(f"SEARCH {RaceResult.__tablename__} USING COVERING INDEX idx_horse_date"), details
+
+def test_migrate_recreates_changed_index(db_crud):
+    """
+    列の構成が古い idx_horse_date を migrate で作り直すこと
+    """
+    with db_crud.engine.begin() as connection:
+        connection.exec_driver_sql("DROP INDEX idx_horse_date")
+        connection.exec_driver_sql(
+            f"CREATE INDEX idx_horse_date ON {RaceResult.__tablename__} (horse_id, race_date, speed_figure)"
+        )
+    db_crud.migrate()
+
+    with db_crud.engine.connect() as connection:
+        column_names = [row[2] for row in connection.exec_driver_sql("PRAGMA index_info(idx_horse_date)").all()]
+    assert column_names == ["horse_id", "race_date", "speed_figure", "computed_speed_figure"]
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from argparse import Namespace
+import datetime
+import json
+import logging
+
+from sqlalchemy import insert, select
+
+from skylark.feature import FormAccumulator, SkylarkFormFeature
+from skylark.models import FormFeature, RaceInfo, RaceResult
+from tests.dataset import make_race_info, make_race_result
+
+def test_accumulator_window():
+    accumulator = FormAccumulator(window=3)
+    assert accumulator.get(("jockey", 1)) == (0, None, None)
+
+    for order_of_finish in (1, 2, 5, 4):
+        accumulator.add(("jockey", 1), order_of_finish)
+
+    # 窓から外れた1着は数えない
+    assert accumulator.get(("jockey", 1)) == (3, 0.0, 1 / 3)
+    assert accumulator.get(("jockey", 2)) == (0, None, None)
+
+def test_same_day_races_are_excluded(db_crud):
+    """
+    同じ開催日のレースの成績は含めず、前日までの成績のみを使うこと
+    """
+    with db_crud.engine.begin() as connection:
+        connection.execute(insert(RaceInfo), [
+            make_race_info(202506010101, datetime.date(2025, 1, 5)),
+            make_race_info(202506010102, datetime.date(2025, 1, 5)),
+            make_race_info(202506010201, datetime.date(2025, 1, 6)),
+        ])
+        connection.execute(insert(RaceResult), [
+            make_race_result(202506010101, 1, order_of_finish=1),
+            make_race_result(202506010101, 2, order_of_finish=2, jockey_id=2),
+            make_race_result(202506010102, 1, order_of_finish=3),
+            # 取消は数えない
+            make_race_result(202506010102, 2, order_of_finish=None),
+            make_race_result(202506010201, 1, order_of_finish=1),
+        ])
+
+    form_feature = SkylarkFormFeature(Namespace(form_window=10), logging.getLogger(__name__))
+    assert form_feature.calculate(db_crud) == 5
+
+    with db_crud.engine.connect() as connection:
+        rows = connection.execute(
+            select(FormFeature.race_id, FormFeature.jockey_id, FormFeature.calculation_result_json)
+            .order_by(FormFeature.race_id, FormFeature.horse_id)
+        ).all()
+    results = {(race_id, jockey_id): json.loads(value) for race_id, jockey_id, value in rows}
+
+    assert results[(202506010101, 1)]["jockey_rides"] == 0
+    assert results[(202506010102, 1)]["jockey_rides"] == 0
+    assert results[(202506010102, 1)]["jockey_win_rate"] is None
+
+    assert results[(202506010201, 1)]["jockey_rides"] == 2
+    assert results[(202506010201, 1)]["jockey_win_rate"] == 0.5
+    assert results[(202506010201, 1)]["jockey_place_rate"] == 1.0
+    # 調教師は3頭(取消を除く)
+    assert results[(202506010201, 1)]["trainer_rides"] == 3
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import os
+import subprocess
+import sys
+
+# import app の時点では読み込まない重い依存(各モードで読み込む)
+heavy_module_list = ("sqlalchemy", "httpx", "pyquery", "numpy", "playwright", "streamlit")
+
+def test_import_app_does_not_load_heavy_modules():
+    """
+    他のテストで読み込み済みのモジュールの影響を受けないように別のプロセスで確認する
+    """
+    code = (
+        "import sys\n"
+        "import app\n"
+        f"print(','.join(name for name in {heavy_module_list!r} if name in sys.modules))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    assert result.stdout.strip() == ""
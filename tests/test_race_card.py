@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import datetime
+
+from sqlalchemy import insert, select
+
+from skylark.models import Jockey, RaceEntry, RaceInfo
+from skylark.scraper_race import SkylarkScraperRace
+
+def make_race_card(race_id: int, jockey_id: int) -> tuple[dict, dict]:
+    race_info_dict = {
+        "id": race_id,
+        "race_name": "出馬表のレース名",
+        "distance": 1600,
+        "weather": None,
+        "post_time": datetime.time(15, 40),
+        "race_number": race_id % 100,
+        "run_direction": None,
+        "track_surface": "芝",
+        "track_condition": None,
+        "track_condition_score": None,
+        "date": datetime.date(2025, 1, 5),
+        "place_detail": "1回中山1日目",
+        "race_grade": None,
+        "race_class": "3歳未勝利",
+    }
+    horses_dict = {
+        1: {
+            "horse_id": race_id,
+            "horse_number": 1,
+            "waku_number": 1,
+            "horse_name": f"horse-{race_id}",
+            "barei": "牡3",
+            "basis_weight": 57.0,
+            "jockey_id": jockey_id,
+            "jockey_name": "jockey",
+            "trainer_id": 1,
+            "trainer_name": "trainer",
+            "odds": None,
+            "popularity": None,
+            "horse_weight": None,
+            "horse_weight_diff": None,
+        }
+    }
+    return race_info_dict, horses_dict
+
+def test_parse_horse_weight():
+    assert SkylarkScraperRace.parse_horse_weight("478(+2)") == (478, 2)
+    assert SkylarkScraperRace.parse_horse_weight("480(-10)") == (480, -10)
+    assert SkylarkScraperRace.parse_horse_weight("478(前計不)") == (478, None)
+    assert SkylarkScraperRace.parse_horse_weight("計不") is None
+    assert SkylarkScraperRace.parse_horse_weight("") is None
+
+def test_race_card_keeps_ingested_race_info(db_crud):
+    """
+    同じ騎手が複数レースに乗っても保存でき、保存済みのレース情報は上書きしないこと
+    """
+    with db_crud.engine.begin() as connection:
+        race_info_dict, _ = make_race_card(202506010101, 1)
+        connection.execute(insert(RaceInfo), [race_info_dict | {"race_name": "結果のレース名"}])
+
+    dataset = SkylarkScraperRace.make_race_card_dataset([
+        make_race_card(202506010101, 1),
+        make_race_card(202506010102, 1),
+    ])
+    assert len(dataset["jockey"]) == 1
+    assert len(dataset["trainer"]) == 1
+
+    db_crud.upsert_race_entries(
+        dataset["race_info"], dataset["horse"], dataset["jockey"], dataset["trainer"], dataset["entry"]
+    )
+
+    with db_crud.engine.connect() as connection:
+        assert connection.execute(select(RaceInfo.id, RaceInfo.race_name).order_by(RaceInfo.id)).all() == [
+            (202506010101, "結果のレース名"),
+            (202506010102, "出馬表のレース名"),
+        ]
+        assert connection.execute(select(Jockey.jockey_id)).scalars().all() == [1]
+        assert connection.execute(select(RaceEntry.horse_weight)).scalars().all() == [None, None]
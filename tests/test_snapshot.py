@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import datetime
+import logging
+
+from sqlalchemy import insert, select
+
+from skylark.crud import SkylarkCrud
+from skylark.models import Feature, RaceResult, RaceSummary
+from skylark.snapshot import SkylarkSnapshot
+from skylark.speed_figure import SkylarkSpeedFigure
+from tests.dataset import insert_races
+
+def read_figures(db_crud: SkylarkCrud) -> dict:
+    with db_crud.engine.connect() as connection:
+        return dict(connection.execute(select(RaceResult.race_id, RaceResult.computed_speed_figure)).all())
+
+def test_incremental_snapshot_refreshes_derived_values(tmp_path):
+    """
+    差分更新でも、過去のレースの特徴量と計算し直したスピード指数を書き写すこと
+    """
+    logger = logging.getLogger(__name__)
+    source_url = f"sqlite:///{tmp_path / 'source.db'}"
+    snapshot_path = str(tmp_path / "snapshot.db")
+
+    source_crud = SkylarkCrud(source_url, logger=logger, shared=False)
+    source_crud.create_tables()
+    source_crud.migrate()
+    speed_figure = SkylarkSpeedFigure(logger)
+
+    old_race_ids = [202406010100 + idx for idx in range(30)]
+    insert_races(source_crud, old_race_ids, 100.0, datetime.date(2024, 1, 6))
+    # 差分更新の対象は前回の最終開催日(2025-01-01)の7日前以降
+    insert_races(source_crud, [202506010001], 100.0, datetime.date(2025, 1, 1))
+    with source_crud.engine.begin() as connection:
+        connection.execute(insert(RaceSummary), [{"race_id": 202506010001, "field_size": 1, "starters": 1}])
+    speed_figure.update(source_crud)
+    SkylarkSnapshot(source_url, logger).export(snapshot_path)
+
+    # 新しいレースで基準タイムが変わり、過去のレースの指数と特徴量を計算し直す
+    insert_races(source_crud, [202506010100 + idx for idx in range(30)], 110.0, datetime.date(2025, 1, 5))
+    speed_figure.update(source_crud)
+    with source_crud.engine.begin() as connection:
+        connection.execute(insert(Feature), [{"horse_id": old_race_ids[0], "race_id": old_race_ids[0], "jockey_id": 1, "trainer_id": 1}])
+    SkylarkSnapshot(source_url, logger).export(snapshot_path)
+
+    snapshot_crud = SkylarkCrud(f"sqlite:///file:{snapshot_path}?mode=ro&uri=true", logger=logger, shared=False)
+    try:
+        assert read_figures(snapshot_crud) == read_figures(source_crud)
+        with snapshot_crud.engine.connect() as connection:
+            assert connection.execute(select(Feature.race_id)).scalars().all() == [old_race_ids[0]]
+    finally:
+        snapshot_crud.close()
+        source_crud.close()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import logging
+
+import pytest
+from sqlalchemy import select
+
+from skylark.models import ParTime, RaceResult
+from skylark.speed_figure import SkylarkSpeedFigure
+from tests.dataset import insert_races
+
+def test_recompute_figures_when_par_time_changes(db_crud):
+    """
+    基準タイムが変わった条件は、計算済みの指数も新しい基準タイムで計算し直すこと
+    """
+    speed_figure = SkylarkSpeedFigure(logging.getLogger(__name__))
+
+    insert_races(db_crud, [202506010100 + idx for idx in range(30)], 100.0)
+    speed_figure.update(db_crud)
+    with db_crud.engine.connect() as connection:
+        assert set(connection.execute(select(RaceResult.computed_speed_figure)).scalars().all()) == {80.0}
+
+    insert_races(db_crud, [202506020100 + idx for idx in range(30)], 110.0)
+    speed_figure.update(db_crud)
+    with db_crud.engine.connect() as connection:
+        assert connection.execute(select(ParTime.par_time, ParTime.time_count)).one() == (105.0, 60)
+        figures = dict(connection.execute(
+            select(RaceResult.finishing_time_sec, RaceResult.computed_speed_figure).distinct()
+        ).all())
+    assert figures[100.0] == pytest.approx(80 + 5 * 1000 / 105)
+    assert figures[110.0] == pytest.approx(80 - 5 * 1000 / 105)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import datetime
+
+import pytest
+
+from skylark.util import SkylarkUtil
+
+@pytest.mark.parametrize("strings, horse_numbers, ordered", [
+    ("3", (3,), False),
+    ("7-3", (3, 7), False),
+    ("3 - 7", (3, 7), False),
+    ("7->3", (7, 3), True),
+    ("3->7->1", (3, 7, 1), True),
+    ("18-1-9", (1, 9, 18), False),
+])
+def test_combination_round_trip(strings, horse_numbers, ordered):
+    key = SkylarkUtil.encodeCombination(strings)
+    assert SkylarkUtil.decodeCombination(key) == (horse_numbers, ordered)
+    assert key == SkylarkUtil.encodeHorseNumbers(list(horse_numbers), ordered)
+
+def test_combination_order():
+    # 順序なしは並びが違っても同じ値、順序ありは区別する
+    assert SkylarkUtil.encodeCombination("3-7") == SkylarkUtil.encodeCombination("7-3")
+    assert SkylarkUtil.encodeCombination("3->7") != SkylarkUtil.encodeCombination("7->3")
+    assert SkylarkUtil.encodeCombination("3->7") != SkylarkUtil.encodeCombination("3-7")
+
+@pytest.mark.parametrize("strings", ["", "0", "32", "1-2-3-4"])
+def test_combination_invalid(strings):
+    with pytest.raises(ValueError):
+        SkylarkUtil.encodeCombination(strings)
+
+@pytest.mark.parametrize("strings, expected", [
+    ("ハナ", 0.05),
+    ("アタマ", 0.1),
+    ("クビ", 0.25),
+    ("同着", 0.0),
+    ("大", 10.0),
+    ("1/2", 0.5),
+    ("3/4", 0.75),
+    ("1.1/4", 1.25),
+    ("2.1/2", 2.5),
+    ("3", 3.0),
+    (" 3 ", 3.0),
+    ("", None),
+    (None, None),
+    ("不明", None),
+])
+def test_parse_margin(strings, expected):
+    assert SkylarkUtil.parseMargin(strings) == expected
+
+@pytest.mark.parametrize("strings, expected", [
+    ("3-3-2-1", (3, 3, 2, 1)),
+    ("5-4", (None, None, 5, 4)),
+    ("12", (None, None, None, 12)),
+    ("1-1-1-1-1", (1, 1, 1, 1)),
+    ("", (None, None, None, None)),
+    (None, (None, None, None, None)),
+    ("中-止", (None, None, None, None)),
+])
+def test_parse_corners(strings, expected):
+    assert SkylarkUtil.parseCorners(strings) == expected
+
+@pytest.mark.parametrize("value, expected", [
+    ("2:32.2", 152.2),
+    ("00:2:32.2", 152.2),
+    ("1:08.0", 68.0),
+    ("59.9", None),
+    ("", None),
+    (None, None),
+    (datetime.time(0, 2, 32, 200000), 152.2),
+    (datetime.timedelta(minutes=1, seconds=8), 68.0),
+])
+def test_parse_finishing_time(value, expected):
+    assert SkylarkUtil.parseFinishingTime(value) == expected